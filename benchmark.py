@@ -0,0 +1,442 @@
+"""Micro-benchmarks of the env, counterfactual, replay, learning and aggregation hot paths.
+
+Run the benchmarks (optionally only those whose name contains a filter) and save the
+results as JSON:
+
+    python benchmark.py run -o benchmarks/baseline.json
+    python benchmark.py run -k donut -o current.json
+
+Compare a run against a stored baseline (exits with 1 when a benchmark is slower by
+more than the threshold):
+
+    python benchmark.py compare benchmarks/baseline.json current.json --threshold 0.1
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable
+
+import numpy as np
+import torch
+
+from core.aggregations import (
+    Aggregation,
+    NSW,
+    Utilitarian,
+    Rawlsian,
+    Egalitarian,
+    Gini,
+    RDP,
+    GroupParity,
+)
+from core.agents import DQN
+from core.dataset import DatasetRecorder, OfflineDataset
+from core.utils import ReplayMemory
+from main import (
+    get_parser,
+    get_run_settings,
+    get_space_sizes,
+    make_env,
+    prepare_args,
+    set_seed,
+)
+
+ENVS = ["donut", "lending", "covid"]
+STATE_MODES = ["full", "min", "reset", "none"]
+COUNTERFACTUALS = [1, 8, 32]
+BATCH_SIZES = [32, 64, 128]
+PEOPLE = [100, 1000]
+# Memory encoding and arrival sampling of the large donut configurations
+DONUT_CONFIGS = {
+    "binary": [],
+    "counts-sparse": ["-menc", "counts", "-sparse", "True"],
+    "quantiles-sparse": ["-menc", "quantiles", "-sparse", "True"],
+}
+# Random numbers and groups of the large lending configurations
+LENDING_CONFIGS = {
+    "random": [],
+    "envrng": ["-envrng", "True"],
+    "envrng-10groups": ["-envrng", "True", "-groups", "10"],
+}
+AGGREGATIONS: list[type[Aggregation]] = [
+    NSW,
+    Utilitarian,
+    Rawlsian,
+    Egalitarian,
+    Gini,
+    RDP,
+    GroupParity,
+]
+
+# Name of each benchmark -> setup function returning the function to time
+BENCHMARKS: dict[str, Callable[[], Callable[[], object]]] = {}
+
+
+def benchmark(name: str) -> Callable:
+    """Register a benchmark setup function under a name."""
+
+    def register(setup: Callable[[], Callable[[], object]]) -> Callable:
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def make_args(env_type: str, *argv: str) -> argparse.Namespace:
+    """Get the default arguments of main.py for an env (plus extra arguments)."""
+    args = get_parser().parse_args(["-env", env_type, *argv])
+    prepare_args(args)
+    set_seed(0)
+    return args
+
+
+def make_bench_env(env_type: str, *argv: str):
+    args = make_args(env_type, *argv)
+    max_ep_len, _, _ = get_run_settings(args)
+    return make_env(3, max_ep_len, args, seed=0), args
+
+
+# Env steps per state mode
+def env_step(env_type: str, state_mode: str, *argv: str) -> Callable[[], object]:
+    env, _ = make_bench_env(env_type, "-sm", state_mode, *argv)
+    env.reset()
+
+    def step():
+        _, _, done, _, _ = env.step(env.action_space.sample())
+        if done:
+            env.reset()
+
+    return step
+
+
+# Counterfactual transitions (in the middle of an episode) per number of counterfactuals
+def counterfactuals(
+    env_type: str, n_counterfactuals: int, *argv: str
+) -> Callable[[], object]:
+    env, _ = make_bench_env(env_type, "-cf", "True", *argv)
+    _, info = env.reset()
+    for _ in range(env.current_step + 10):
+        _, _, _, _, info = env.step(env.action_space.sample())
+    state = info["state"].copy()
+    actual_state = env.state.copy()
+    actual_memory = env.memory.copy()
+    action = env.action_space.sample()
+
+    def generate():
+        return env.get_counterfactual_transitions(
+            state,
+            actual_state,
+            action,
+            actual_memory,
+            env.current_step,
+            n_counterfactuals,
+        )
+
+    return generate
+
+
+def make_replay_memory(raw: bool) -> tuple[ReplayMemory, tuple]:
+    env, _ = make_bench_env("donut")
+    num_states, _ = get_space_sizes(env)
+    memory = ReplayMemory(env, 6400, 6400, num_states, "cpu", "cpu", raw=raw)
+    _, info = env.reset()
+    key = "raw_memory" if raw else "memory"
+    state, mem = info["state"].copy(), info[key].copy()
+    _, reward, _, _, info = env.step(0)
+    transition = (state, mem, 0, reward, info["state"], info[key])
+    return memory, transition
+
+
+def replay_store(raw: bool) -> Callable[[], object]:
+    memory, transition = make_replay_memory(raw)
+    return lambda: memory.store_transition(*transition)
+
+
+def replay_sample(raw: bool, batch_size: int) -> Callable[[], object]:
+    memory, _ = make_replay_memory(raw)
+    return lambda: memory.sample(batch_size)
+
+
+def offline_sample(batch_size: int) -> Callable[[], object]:
+    env, _ = make_bench_env("donut")
+    path = tempfile.mkdtemp(prefix="offline-")
+    recorder = DatasetRecorder(path, shard_size=1024)
+    _, info = env.reset()
+    for _ in range(6400):
+        state, memory = info["state"].copy(), info["memory"].copy()
+        action = env.action_space.sample()
+        _, reward, done, _, info = env.step(action)
+        recorder.add([(state, memory, action, reward, info["state"], info["memory"])])
+        if done:
+            _, info = env.reset()
+    recorder.close()
+    dataset = OfflineDataset(path, "cpu")
+    return lambda: dataset.sample(batch_size)
+
+
+def make_dqn(batch_size: int) -> tuple[DQN, np.ndarray]:
+    env, args = make_bench_env("donut", "-bs", str(batch_size))
+    args.epsilon = 0.0
+    num_states, num_actions = get_space_sizes(env)
+    _, memory_capacity, _ = get_run_settings(args)
+    agent = DQN(
+        env,
+        num_states,
+        num_actions,
+        memory_capacity,
+        args.lr,
+        "cpu",
+        args,
+        args.net_arch,
+    )
+    obs, _ = env.reset()
+    return agent, obs
+
+
+def dqn_choose_action() -> Callable[[], object]:
+    agent, obs = make_dqn(64)
+    return lambda: agent.choose_action(obs)
+
+
+def dqn_learn(batch_size: int) -> Callable[[], object]:
+    agent, _ = make_dqn(batch_size)
+    return agent.learn
+
+
+def aggregation_forward(aggregation: type[Aggregation]) -> Callable[[], object]:
+    agg = aggregation()
+    utilities = np.random.randint(0, 20, 2 if aggregation is RDP else 5)
+    utilities = utilities.astype(np.float32)
+    return lambda: agg(utilities.copy())
+
+
+def aggregation_forward_batch(aggregation: type[Aggregation]) -> Callable[[], object]:
+    agg = aggregation()
+    people = 2 if aggregation is RDP else 5
+    utilities = np.random.randint(0, 20, (1024, people)).astype(np.float32)
+    return lambda: agg.forward_batch(utilities)
+
+
+def aggregation_incremental(aggregation: type[Aggregation]) -> Callable[[], object]:
+    people = 2 if aggregation is RDP else 5
+    incremental = aggregation().incremental(1_000_000)
+    incremental.reset(np.zeros(people))
+    counter = iter(range(sys.maxsize))
+
+    def update():
+        incremental.update(next(counter) % people, 1)
+        return incremental.value()
+
+    return update
+
+
+for env_type in ENVS:
+    for state_mode in STATE_MODES:
+        benchmark(f"env/{env_type}/step/{state_mode}")(
+            lambda e=env_type, s=state_mode: env_step(e, s)
+        )
+    for n in COUNTERFACTUALS:
+        benchmark(f"counterfactual/{env_type}/ncf={n}")(
+            lambda e=env_type, n=n: counterfactuals(e, n)
+        )
+for people in PEOPLE:
+    for config, argv in DONUT_CONFIGS.items():
+        argv = ["-people", str(people), *argv]
+        benchmark(f"env/donut/step/people={people}/{config}")(
+            lambda a=argv: env_step("donut", "full", *a)
+        )
+        benchmark(f"counterfactual/donut/people={people}/{config}")(
+            lambda a=argv: counterfactuals("donut", 1, *a)
+        )
+    for config, argv in LENDING_CONFIGS.items():
+        argv = ["-people", str(people), *argv]
+        benchmark(f"env/lending/step/people={people}/{config}")(
+            lambda a=argv: env_step("lending", "full", *a)
+        )
+        benchmark(f"counterfactual/lending/people={people}/{config}/ncf=32")(
+            lambda a=argv: counterfactuals("lending", 32, *a)
+        )
+for raw in [False, True]:
+    mode = "raw" if raw else "encoded"
+    benchmark(f"replay/{mode}/store_transition")(lambda r=raw: replay_store(r))
+    for batch_size in BATCH_SIZES:
+        benchmark(f"replay/{mode}/sample/bs={batch_size}")(
+            lambda r=raw, b=batch_size: replay_sample(r, b)
+        )
+for batch_size in BATCH_SIZES:
+    benchmark(f"offline/sample/bs={batch_size}")(lambda b=batch_size: offline_sample(b))
+benchmark("dqn/choose_action")(dqn_choose_action)
+for batch_size in BATCH_SIZES:
+    benchmark(f"dqn/learn/bs={batch_size}")(lambda b=batch_size: dqn_learn(b))
+for aggregation in AGGREGATIONS:
+    name = aggregation.__name__.lower()
+    benchmark(f"aggregation/{name}/forward")(
+        lambda a=aggregation: aggregation_forward(a)
+    )
+    benchmark(f"aggregation/{name}/forward_batch/1024")(
+        lambda a=aggregation: aggregation_forward_batch(a)
+    )
+    benchmark(f"aggregation/{name}/incremental")(
+        lambda a=aggregation: aggregation_incremental(a)
+    )
+
+
+def measure(fn: Callable[[], object], min_time: float, repeats: int) -> dict:
+    """Time a function.
+
+    The number of calls per repeat is calibrated so that each repeat takes about
+    min_time / repeats seconds.
+
+    Args:
+        fn (Callable[[], object]): The function to time.
+        min_time (float): Approximate total time in seconds.
+        repeats (int): Number of repeats.
+
+    Returns:
+        dict: Median, mean, min and stdev (over repeats) of the time per call in seconds, calls per repeat and calls per second.
+    """
+    # Warm up and calibrate
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / repeats / 10:
+            break
+        calls *= 10
+    calls = max(1, int(calls * (min_time / repeats) / max(elapsed, 1e-9)))
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        times.append((time.perf_counter() - start) / calls)
+
+    median = statistics.median(times)
+    return {
+        "median": median,
+        "mean": statistics.mean(times),
+        "min": min(times),
+        "stdev": statistics.stdev(times) if repeats > 1 else 0.0,
+        "calls": calls,
+        "ops_per_s": 1 / median,
+    }
+
+
+def get_metadata() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "threads": torch.get_num_threads(),
+    }
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.2f} ns"
+
+
+def run_benchmarks(args: argparse.Namespace) -> None:
+    names = [name for name in BENCHMARKS if not args.filter or args.filter in name]
+    results = {}
+    for name in names:
+        fn = BENCHMARKS[name]()
+        results[name] = measure(fn, args.min_time, args.repeats)
+        print(
+            f"{name:45s} {format_time(results[name]['median'])}"
+            f" ± {format_time(results[name]['stdev'])}"
+            f" {results[name]['ops_per_s']:12,.0f} ops/s",
+            flush=True,
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"meta": get_metadata(), "results": results}, f, indent=2)
+        print(f"Saved {len(results)} results to {args.output}")
+
+
+def compare(args: argparse.Namespace) -> int:
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    with open(args.current) as f:
+        current = json.load(f)["results"]
+
+    regressions = []
+    for name in sorted(baseline.keys() & current.keys()):
+        ratio = current[name]["median"] / baseline[name]["median"]
+        flag = ""
+        if ratio > 1 + args.threshold:
+            flag = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / (1 + args.threshold):
+            flag = "faster"
+        print(
+            f"{name:45s} {format_time(baseline[name]['median'])}"
+            f" -> {format_time(current[name]['median'])} {ratio:6.2f}x {flag}"
+        )
+    missing = baseline.keys() - current.keys()
+    if missing:
+        print(f"{len(missing)} benchmark(s) of the baseline not in {args.current}")
+
+    print(
+        f"{len(regressions)} regression(s) slower than {1 + args.threshold:.2f}x the baseline"
+    )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    prs = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Micro-benchmarks of the hot paths",
+    )
+    commands = prs.add_subparsers(dest="command", required=True)
+
+    run_prs = commands.add_parser("run", help="Run the benchmarks")
+    run_prs.add_argument("-o", "--output", type=str, default=None)
+    run_prs.add_argument(
+        "-k", "--filter", type=str, default=None, help="Substring of benchmark names"
+    )
+    run_prs.add_argument(
+        "--min-time", type=float, default=0.5, help="Seconds per benchmark"
+    )
+    run_prs.add_argument("--repeats", type=int, default=5)
+
+    compare_prs = commands.add_parser("compare", help="Compare two result files")
+    compare_prs.add_argument("baseline", type=str)
+    compare_prs.add_argument("current", type=str)
+    compare_prs.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown that counts as a regression",
+    )
+
+    args = prs.parse_args()
+    if args.command == "run":
+        run_benchmarks(args)
+    else:
+        sys.exit(compare(args))
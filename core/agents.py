@@ -1,14 +1,21 @@
+import copy
+import threading
 import torch
 import torch.nn as nn
 import numpy as np
+from torch.func import functional_call, stack_module_state, vmap
 from gym import Env
 from numpy.typing import NDArray
-from stable_baselines3 import SAC as SB3SAC
 from argparse import Namespace
 from abc import ABC, abstractmethod
+from contextlib import nullcontext
+from typing import TYPE_CHECKING
 from core.utils import ReplayMemory
-from core.policies import MLPPolicy, RNNPolicy
-from envs.covid import CovidSEIREnv
+from core.policies import MLPPolicy, RNNPolicy, trace_policy
+
+if TYPE_CHECKING:
+    from core.dataset import OfflineDataset
+    from stable_baselines3.common.vec_env import VecEnv
 
 
 class Agent(ABC):
@@ -50,6 +57,20 @@ class Agent(ABC):
         """
         ...
 
+    def store_transitions(
+        self,
+        transitions: list[
+            tuple[NDArray, NDArray, int | NDArray, float, NDArray, NDArray]
+        ],
+    ) -> None:
+        """Store several transitions in the replay buffer.
+
+        Args:
+            transitions (list[tuple[NDArray, NDArray, int | NDArray, float, NDArray, NDArray]]): The (state, memory, action, reward, next_state, next_memory) tuples.
+        """
+        for transition in transitions:
+            self.store_transition(*transition)
+
     @abstractmethod
     def learn(self) -> float | None:
         """Take a learning step.
@@ -59,6 +80,24 @@ class Agent(ABC):
         """
         ...
 
+    def snapshot(self) -> "Agent":
+        """Get a picklable copy of the current greedy policy (e.g. for evaluation in another process).
+
+        Returns:
+            Agent: The policy snapshot.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support policy snapshots"
+        )
+
+    def replay_bytes(self) -> int:
+        """Get the number of bytes allocated for the replay buffer.
+
+        Returns:
+            int: The size of the replay buffer in bytes.
+        """
+        return 0
+
 
 class DQN(Agent):
     def __init__(
@@ -72,6 +111,7 @@ class DQN(Agent):
         args: Namespace,
         net_arch: list[int],
         normalize: bool = False,
+        replay_memory: "ReplayMemory | OfflineDataset | None" = None,
     ):
         super(DQN, self).__init__()
 
@@ -104,6 +144,14 @@ class DQN(Agent):
 
         self.target_net.load_state_dict(self.eval_net.state_dict())
 
+        # Network used for acting. When actor threads run concurrently with the
+        # learner, they act with a separate copy that is synced periodically.
+        self.acting_net = self.eval_net
+        self.acting_lock: threading.Lock | nullcontext = nullcontext()
+        if args.actors > 0:
+            self.acting_net = copy.deepcopy(self.eval_net)
+            self.acting_lock = threading.Lock()
+
         # Save hyperparameters
         self.num_states = num_states
         self.num_actions = num_actions
@@ -116,27 +164,54 @@ class DQN(Agent):
 
         self.learn_step_counter = 0
         self.memory_counter = 0
-        self.replay_memory = ReplayMemory(
-            env,
-            memory_capacity,
-            memory_capacity,
-            num_states,
-            device,
-            device,
-        )
+        # Offline training samples a recorded dataset instead
+        if replay_memory is None:
+            replay_memory = ReplayMemory(
+                env,
+                memory_capacity,
+                memory_capacity,
+                num_states,
+                device,
+                device,
+                thread_safe=args.actors > 0,
+                raw=args.raw_replay,
+            )
+        self.replay_memory = replay_memory
         self.optimizer = torch.optim.Adam(self.eval_net.parameters(), lr=learning_rate)
         self.loss_func = nn.MSELoss()
 
+        # Optionally trace the eval network for acting (TorchScript has lower
+        # per-call overhead than torch.compile guards for single observations)
+        # and compile the fused learning step (forward, gather, target max,
+        # loss, backward and optimizer step). Inputs are copied into
+        # preallocated tensors so that both always see the same buffers.
+        self.compile = args.compile
+        self.obs_buffer: torch.Tensor | None = None
+        self.batch_buffer: torch.Tensor | None = None
+        if self.compile:
+            self.obs_buffer = torch.zeros((1, num_states), device=self.device)
+            self.batch_buffer = torch.zeros(
+                (self.batch_size, num_states * 2 + 2), device=self.device
+            )
+            self.eval_forward = trace_policy(self.acting_net, num_states)
+            self.learn_step = torch.compile(self._learn_step, dynamic=False)
+        else:
+            self.eval_forward = self.acting_net
+            self.learn_step = self._learn_step
+
     def choose_action(
         self, obs: NDArray, greedy: bool = False, hidden: torch.Tensor | None = None
     ) -> tuple[int, torch.Tensor | None]:
-        obs_t = torch.unsqueeze(torch.FloatTensor(obs), 0).to(self.device)
-        if self.normalize:
-            obs_t = nn.functional.normalize(obs_t, p=2, dim=1)
-
         if greedy or np.random.uniform() >= self.epsilon:  # greedy policy
-            with torch.no_grad():
-                action_value, hidden = self.eval_net.forward(obs_t, prev_hidden=hidden)
+            with torch.no_grad(), self.acting_lock:
+                if self.obs_buffer is not None:
+                    obs_t = self.obs_buffer
+                    obs_t.copy_(torch.as_tensor(obs, dtype=torch.float32).unsqueeze(0))
+                else:
+                    obs_t = torch.unsqueeze(torch.FloatTensor(obs), 0).to(self.device)
+                if self.normalize:
+                    obs_t = nn.functional.normalize(obs_t, p=2, dim=1)
+                action_value, hidden = self.eval_forward(obs_t, prev_hidden=hidden)
                 action = torch.max(action_value.cpu(), 1)[1].data.numpy()
             action = action[0]
 
@@ -144,6 +219,36 @@ class DQN(Agent):
             action = np.random.randint(self.num_actions)
         return action, None
 
+    def greedy_actions(self, obs: NDArray) -> NDArray:
+        """Get the greedy actions for a batch of observations.
+
+        Args:
+            obs (NDArray): The observations, one row each.
+
+        Returns:
+            NDArray: The greedy actions.
+        """
+        obs_t = torch.as_tensor(obs, dtype=torch.float32, device=self.device)
+        if self.normalize:
+            obs_t = nn.functional.normalize(obs_t, p=2, dim=1)
+        with torch.no_grad(), self.acting_lock:
+            action_value, _ = self.acting_net(obs_t)
+        return torch.max(action_value, 1)[1].cpu().numpy()
+
+    def snapshot(self) -> "DQNSnapshot":
+        with self.acting_lock:
+            net = copy.deepcopy(self.acting_net).cpu()
+        return DQNSnapshot(net, self.normalize)
+
+    def replay_bytes(self) -> int:
+        return self.replay_memory.nbytes
+
+    def sync_acting_net(self) -> None:
+        """Copy the current weights of the eval network to the acting network."""
+        if self.acting_net is not self.eval_net:
+            with self.acting_lock:
+                self.acting_net.load_state_dict(self.eval_net.state_dict())
+
     def store_transition(
         self,
         state: NDArray,
@@ -164,8 +269,30 @@ class DQN(Agent):
         self.learn_step_counter += 1
 
         batch_obs, batch_action, batch_reward, batch_next_obs = (
-            self.replay_memory.sample(self.batch_size)
+            self.replay_memory.sample(self.batch_size, out=self.batch_buffer)
         )
+        loss = self.learn_step(batch_obs, batch_action, batch_reward, batch_next_obs)
+
+        return loss.item()
+
+    def _learn_step(
+        self,
+        batch_obs: torch.Tensor,
+        batch_action: torch.Tensor,
+        batch_reward: torch.Tensor,
+        batch_next_obs: torch.Tensor,
+    ) -> torch.Tensor:
+        """Take a gradient step on a sampled batch.
+
+        Args:
+            batch_obs (torch.Tensor): The batch of observations.
+            batch_action (torch.Tensor): The batch of actions.
+            batch_reward (torch.Tensor): The batch of rewards.
+            batch_next_obs (torch.Tensor): The batch of next observations.
+
+        Returns:
+            torch.Tensor: The (detached) loss.
+        """
 
         if self.normalize:
             batch_obs = nn.functional.normalize(batch_obs, p=2, dim=1)
@@ -186,7 +313,76 @@ class DQN(Agent):
         loss.backward()
         self.optimizer.step()
 
-        return loss.item()
+        return loss.detach()
+
+
+class DQNSnapshot(Agent):
+    """Greedy policy of a DQN eval network frozen at some point in training."""
+
+    def __init__(self, net: nn.Module, normalize: bool = False):
+        self.net = net
+        self.normalize = normalize
+
+    def choose_action(
+        self, obs: NDArray, greedy: bool = True, hidden: torch.Tensor | None = None
+    ) -> tuple[int, torch.Tensor | None]:
+        obs_t = torch.unsqueeze(torch.FloatTensor(obs), 0)
+        if self.normalize:
+            obs_t = nn.functional.normalize(obs_t, p=2, dim=1)
+        with torch.no_grad():
+            action_value, hidden = self.net(obs_t, prev_hidden=hidden)
+            action = torch.max(action_value, 1)[1].data.numpy()
+        return action[0], None
+
+    def store_transition(
+        self,
+        state: NDArray,
+        memory: NDArray,
+        action: int | NDArray,
+        reward: float,
+        next_state: NDArray,
+        next_memory: NDArray,
+    ) -> None:
+        pass
+
+    def learn(self) -> float:
+        return 0
+
+
+class SACSnapshot(Agent):
+    """Deterministic policy of a SAC actor frozen at some point in training."""
+
+    def __init__(self, actor: nn.Module, low: NDArray, high: NDArray, squash: bool):
+        self.actor = actor
+        self.low = low
+        self.high = high
+        self.squash = squash
+
+    def choose_action(
+        self, obs: NDArray, greedy: bool = True, hidden: torch.Tensor | None = None
+    ) -> tuple[NDArray, torch.Tensor | None]:
+        obs_t = torch.as_tensor(obs, dtype=torch.float32).unsqueeze(0)
+        with torch.no_grad():
+            action = self.actor(obs_t, deterministic=True)
+        action = action.numpy().reshape(self.low.shape)
+        if self.squash:
+            # As SB3's unscale_action
+            action = self.low + 0.5 * (action + 1.0) * (self.high - self.low)
+        return action, None
+
+    def store_transition(
+        self,
+        state: NDArray,
+        memory: NDArray,
+        action: int | NDArray,
+        reward: float,
+        next_state: NDArray,
+        next_memory: NDArray,
+    ) -> None:
+        pass
+
+    def learn(self) -> float:
+        return 0
 
 
 class SAC(Agent):
@@ -199,14 +395,20 @@ class SAC(Agent):
         learning_rate: float,
         device: torch.device | str,
         net_arch: list[int],
+        vec_env: "VecEnv | None" = None,
     ):
         self.env = env
         self.device = device
         self.batch_size = args.batch_size
+        # Column of the next transition in the current row of a multi-env buffer
+        self.buffer_column = 0
         policy_kwargs = dict(activation_fn=nn.ReLU, net_arch=net_arch, n_critics=2)
+        # Imported here so that DQN runs do not pay for importing stable_baselines3
+        from stable_baselines3 import SAC as SB3SAC
+
         self.model = SB3SAC(
             "MlpPolicy",
-            env,
+            vec_env if vec_env is not None else env,
             verbose=0,
             policy_kwargs=policy_kwargs,
             device=device,
@@ -222,16 +424,68 @@ class SAC(Agent):
         )
         self.model._setup_learn(env.max_steps * args.episodes)
 
+        # Cached observation tensor for acting without SB3's predict() overhead
+        self.obs_buffer = torch.zeros(
+            (1, *env.observation_space.shape), device=self.model.device
+        )
+
     def choose_action(
         self, obs: NDArray, greedy: bool = False, hidden: torch.Tensor | None = None
     ) -> tuple[NDArray, torch.Tensor | None]:
-        self.model.policy.set_training_mode(False)
+        # Equivalent to model.predict() for a single Box observation, but calls
+        # the actor directly on the cached observation tensor
+        policy = self.model.policy
+        if policy.training:
+            policy.set_training_mode(False)
+        self.obs_buffer.copy_(torch.as_tensor(obs).reshape(self.obs_buffer.shape))
+        with torch.no_grad():
+            action = self.model.actor(self.obs_buffer, deterministic=greedy)
+        action = action.cpu().numpy().reshape(self.env.action_space.shape)
+        if policy.squash_output:
+            action = policy.unscale_action(action)
+        return action, None
+
+    def choose_actions(self, obs: NDArray, greedy: bool = False) -> NDArray:
+        """Choose the actions of a batch of observations (e.g. one per env of a vectorized env).
+
+        Args:
+            obs (NDArray): The observations, one row each.
+            greedy (bool, optional): Whether to use a greedy policy. Defaults to False.
+
+        Returns:
+            NDArray: The chosen actions.
+        """
+        policy = self.model.policy
+        if policy.training:
+            policy.set_training_mode(False)
         with torch.no_grad():
-            return self.model.predict(obs, deterministic=greedy)[0], None
+            actions = self.model.actor(
+                torch.as_tensor(obs, device=self.model.device), deterministic=greedy
+            )
+        actions = actions.cpu().numpy().reshape(len(obs), *self.env.action_space.shape)
+        if policy.squash_output:
+            actions = policy.unscale_action(actions)
+        return actions
 
     def learn(self) -> None:
         self.model.train(gradient_steps=1, batch_size=self.batch_size)
 
+    def snapshot(self) -> SACSnapshot:
+        policy = self.model.policy
+        actor = copy.deepcopy(self.model.actor).cpu()
+        actor.set_training_mode(False)
+        space = policy.action_space
+        return SACSnapshot(actor, space.low, space.high, policy.squash_output)
+
+    def replay_bytes(self) -> int:
+        # Sum of the preallocated arrays (observations, actions, rewards, dones, ...)
+        buffer = self.model.replay_buffer
+        return sum(
+            value.nbytes
+            for value in vars(buffer).values()
+            if isinstance(value, np.ndarray)
+        )
+
     def store_transition(
         self,
         state: NDArray,
@@ -242,6 +496,11 @@ class SAC(Agent):
         next_memory: NDArray,
     ) -> None:
         assert self.model.replay_buffer is not None, "Replay buffer is not initialized"
+        if self.model.replay_buffer.n_envs > 1:
+            self.store_transitions(
+                [(state, memory, action, reward, next_state, next_memory)]
+            )
+            return
         obs = np.concatenate([state, memory])
         next_obs = np.concatenate([next_state, next_memory])
         action_a = np.array([action])
@@ -249,6 +508,249 @@ class SAC(Agent):
         done_a = np.array([False])
         self.model.replay_buffer.add(obs, next_obs, action_a, reward_a, done_a, [{}])
 
+    def store_transitions(
+        self,
+        transitions: list[
+            tuple[NDArray, NDArray, int | NDArray, float, NDArray, NDArray]
+        ],
+    ) -> None:
+        n = len(transitions)
+        if n == 0:
+            return
+        states, memories, actions, rewards, next_states, next_memories = zip(
+            *transitions
+        )
+        self.store_arrays(
+            np.concatenate([np.stack(states), np.stack(memories)], axis=1),
+            np.stack(actions),
+            np.asarray(rewards),
+            np.concatenate([np.stack(next_states), np.stack(next_memories)], axis=1),
+        )
+
+    def store_arrays(
+        self, obs: NDArray, actions: NDArray, rewards: NDArray, next_obs: NDArray
+    ) -> None:
+        """Store a batch of transitions (one row each) in the SB3 buffer arrays at once.
+
+        With several envs, the (rows, envs) buffer arrays are filled as one flat array;
+        the position of the buffer only counts complete rows, so SB3 only samples
+        transitions that were stored.
+
+        Args:
+            obs (NDArray): The observations (state followed by memory).
+            actions (NDArray): The actions.
+            rewards (NDArray): The rewards.
+            next_obs (NDArray): The next observations.
+        """
+        buffer = self.model.replay_buffer
+        assert buffer is not None, "Replay buffer is not initialized"
+        assert (
+            not buffer.optimize_memory_usage
+        ), "Bulk insertion needs next_observations"
+        n = len(obs)
+        if n == 0:
+            return
+        n_envs = buffer.n_envs
+        capacity = buffer.buffer_size * n_envs
+        if n > capacity:
+            obs, actions = obs[-capacity:], actions[-capacity:]
+            rewards, next_obs = rewards[-capacity:], next_obs[-capacity:]
+            n = capacity
+
+        start = buffer.pos * n_envs + self.buffer_column
+        rows, columns = np.divmod((start + np.arange(n)) % capacity, n_envs)
+        buffer.observations[rows, columns] = obs
+        buffer.next_observations[rows, columns] = next_obs
+        buffer.actions[rows, columns] = np.asarray(actions).reshape(
+            n, buffer.action_dim
+        )
+        buffer.rewards[rows, columns] = rewards
+        buffer.dones[rows, columns] = False
+        if buffer.handle_timeout_termination:
+            buffer.timeouts[rows, columns] = False
+
+        if start + n >= capacity:
+            buffer.full = True
+        buffer.pos, self.buffer_column = divmod((start + n) % capacity, n_envs)
+
+
+class EnsembleDQN:
+    """An ensemble of independent DQN agents (one per seed) trained in lockstep.
+
+    The parameters of all members are stacked and a single vmapped call runs the
+    forward and backward passes of every member at once. Each member keeps its own
+    environment, replay memory and exploration rate; the summed loss yields the same
+    per-member gradients (and elementwise Adam updates) as training them separately.
+    Given the seeds, every member starts from the weights of a DQN with its seed; the
+    exploration and env draws of the members share the global random state.
+    """
+
+    def __init__(
+        self,
+        envs: list[Env],
+        num_states: int,
+        num_actions: int,
+        memory_capacity: int,
+        learning_rate: float,
+        device: torch.device | str,
+        args: Namespace,
+        net_arch: list[int],
+        seeds: list[int] | None = None,
+    ):
+        assert args.net_type == "linear", "Ensembles only support linear policies"
+        assert seeds is None or len(seeds) == len(envs), "One seed per member"
+
+        def init_weights(m: nn.Module) -> None:
+            if type(m) == nn.Linear:
+                torch.nn.init.kaiming_normal_(m.weight, nonlinearity="relu")
+                m.bias.data.fill_(0.0)
+
+        # Initialize the member policies. With seeds, each member starts from the
+        # same weights as a DQN run with its seed (which also creates its target
+        # network before initializing the weights)
+        self.device = device
+        self.members = len(envs)
+        policies = []
+        for m in range(self.members):
+            if seeds is not None:
+                torch.manual_seed(seeds[m])
+            policy = MLPPolicy(num_states, num_actions, net_arch)
+            if seeds is not None:
+                MLPPolicy(num_states, num_actions, net_arch)
+            policies.append(policy.to(self.device).apply(init_weights))
+
+        # Stack the member parameters and keep a stateless copy of the architecture
+        params, buffers = stack_module_state(policies)
+        self.params = {
+            name: nn.Parameter(param.detach()) for name, param in params.items()
+        }
+        self.buffers = buffers
+        self.target_params = {
+            name: param.detach().clone() for name, param in self.params.items()
+        }
+        self.base_net = copy.deepcopy(policies[0]).to("meta")
+
+        def member_forward(params, buffers, x):
+            return functional_call(self.base_net, (params, buffers), (x,))[0]
+
+        self.forward = vmap(member_forward)
+
+        # Save hyperparameters
+        self.num_states = num_states
+        self.num_actions = num_actions
+        self.memory_capacity = memory_capacity
+        self.epsilon = np.full(self.members, args.epsilon)
+        self.q_network_iterations = args.q_network_iterations
+        self.batch_size = args.batch_size
+        self.gamma = args.gamma
+
+        self.learn_step_counter = 0
+        self.replay_memories = [
+            ReplayMemory(
+                env,
+                memory_capacity,
+                memory_capacity,
+                num_states,
+                device,
+                device,
+                raw=args.raw_replay,
+            )
+            for env in envs
+        ]
+        self.optimizer = torch.optim.Adam(self.params.values(), lr=learning_rate)
+
+    def choose_action(self, obs: NDArray, greedy: bool = False) -> NDArray:
+        """Choose an action for every member.
+
+        Args:
+            obs (NDArray): The observations, one row per member.
+            greedy (bool, optional): Whether to use a greedy policy. Defaults to False.
+
+        Returns:
+            NDArray: The chosen actions, one per member.
+        """
+        obs_t = torch.as_tensor(
+            np.asarray(obs), dtype=torch.float32, device=self.device
+        ).unsqueeze(1)
+        with torch.no_grad():
+            action_value = self.forward(self.params, self.buffers, obs_t)
+        actions = action_value[:, 0].argmax(dim=1).cpu().numpy()
+
+        if not greedy:
+            explore = np.random.uniform(size=self.members) < self.epsilon
+            random_actions = np.random.randint(self.num_actions, size=self.members)
+            actions = np.where(explore, random_actions, actions)
+        return actions
+
+    def store_transition(
+        self,
+        member: int,
+        state: NDArray,
+        memory: NDArray,
+        action: int | NDArray,
+        reward: float,
+        next_state: NDArray,
+        next_memory: NDArray,
+    ) -> None:
+        """Store a transition in the replay buffer of a member.
+
+        Args:
+            member (int): The index of the member.
+            state (NDArray): The current state.
+            memory (NDArray): The current memory.
+            action (int): The action taken.
+            reward (float): The reward received.
+            next_state (NDArray): The next state.
+            next_memory (NDArray): The next memory.
+        """
+        self.replay_memories[member].store_transition(
+            state, memory, int(action), reward, next_state, next_memory
+        )
+
+    def learn(self) -> NDArray:
+        """Take a learning step for every member.
+
+        Returns:
+            NDArray: The loss of each member.
+        """
+        if self.learn_step_counter % self.q_network_iterations == 0:
+            for name, param in self.params.items():
+                self.target_params[name].copy_(param.detach())
+        self.learn_step_counter += 1
+
+        batches = [memory.sample(self.batch_size) for memory in self.replay_memories]
+        batch_obs, batch_action, batch_reward, batch_next_obs = (
+            torch.stack(tensors) for tensors in zip(*batches)
+        )
+
+        q_eval = self.forward(self.params, self.buffers, batch_obs)
+        q_eval = q_eval.gather(2, batch_action)
+
+        with torch.no_grad():
+            q_next = self.forward(self.target_params, self.buffers, batch_next_obs)
+            max_q_next = q_next.max(2, keepdim=True)[0]
+
+        q_target = batch_reward + self.gamma * max_q_next
+        losses = ((q_eval - q_target) ** 2).mean(dim=(1, 2))
+
+        self.optimizer.zero_grad()
+        losses.sum().backward()
+        self.optimizer.step()
+
+        return losses.detach().cpu().numpy()
+
+    def replay_bytes(self) -> int:
+        """Get the number of bytes allocated for the replay buffers of all members.
+
+        Returns:
+            int: The size of the replay buffers in bytes.
+        """
+        return sum(memory.nbytes for memory in self.replay_memories)
+
+    def decay_epsilon(self) -> None:
+        """Decay the exploration rate of every member (as DQN does after each episode)."""
+        self.epsilon = np.where(self.epsilon > 0.01, self.epsilon * 0.999, self.epsilon)
+
 
 class Random(Agent):
     def __init__(self, env: Env):
@@ -272,3 +774,7 @@ class Random(Agent):
 
     def learn(self) -> float:
         return 0
+
+    def snapshot(self) -> "Random":
+        # Stateless, so the agent itself is the snapshot
+        return self
@@ -1,8 +1,18 @@
+import sys
+import heapq
+import math
 from abc import ABC, abstractmethod
+from typing import Any
 from numpy.typing import NDArray
 import numpy as np
 
 
+def is_tensor(x: Any) -> bool:
+    """Check whether x is a torch tensor (without importing torch)."""
+    torch = sys.modules.get("torch")
+    return torch is not None and isinstance(x, torch.Tensor)
+
+
 class Aggregation(ABC):
     """Abstract class for aggregation functions."""
 
@@ -12,6 +22,48 @@ class Aggregation(ABC):
     @abstractmethod
     def forward(self, utilities: NDArray) -> float: ...
 
+    def forward_batch(self, utilities: Any) -> Any:
+        """Aggregate a batch of utility vectors.
+
+        NumPy arrays are aggregated with NumPy and torch tensors with torch (on their
+        own device); both give the same result as `forward` on each row.
+
+        Args:
+            utilities (NDArray | torch.Tensor): The utilities, shape [B, n].
+
+        Returns:
+            NDArray | torch.Tensor: The aggregated utilities, shape [B].
+        """
+        if is_tensor(utilities):
+            return self._forward_batch_torch(utilities)
+        return self._forward_batch_numpy(np.asarray(utilities))
+
+    def incremental(self, max_value: int) -> "IncrementalAggregation":
+        """Create a stateful version that is updated one coordinate at a time.
+
+        Args:
+            max_value (int): Largest utility that can be reached (for order statistics).
+
+        Returns:
+            IncrementalAggregation: The incremental aggregation.
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no incremental version")
+
+    def _forward_batch_numpy(self, utilities: NDArray) -> NDArray:
+        # Default for subclasses that only define `forward`, the built-in
+        # aggregations override it with a vectorized version
+        return np.array([self.forward(u) for u in utilities], dtype=np.float64)
+
+    def _forward_batch_torch(self, utilities: Any) -> Any:
+        # Default for subclasses that only define `forward` (on NumPy arrays)
+        torch = sys.modules["torch"]
+        rows = utilities.detach().cpu().numpy()
+        return torch.as_tensor(
+            self._forward_batch_numpy(rows),
+            dtype=utilities.dtype,
+            device=utilities.device,
+        )
+
 
 class NSW(Aggregation):
     """Nash Social Welfare"""
@@ -22,6 +74,15 @@ class NSW(Aggregation):
     def forward(self, utilities: NDArray) -> float:
         return np.log(utilities + 1 + self.epsilon).sum()
 
+    def incremental(self, max_value: int) -> "IncrementalNSW":
+        return IncrementalNSW(self)
+
+    def _forward_batch_numpy(self, utilities: NDArray) -> NDArray:
+        return np.log(utilities + 1 + self.epsilon).sum(axis=-1)
+
+    def _forward_batch_torch(self, utilities: Any) -> Any:
+        return (utilities + 1 + self.epsilon).log().sum(dim=-1)
+
 
 class Utilitarian(Aggregation):
     """Utilitarian Welfare"""
@@ -29,6 +90,15 @@ class Utilitarian(Aggregation):
     def forward(self, utilities: NDArray) -> float:
         return utilities.sum()
 
+    def incremental(self, max_value: int) -> "IncrementalUtilitarian":
+        return IncrementalUtilitarian(self)
+
+    def _forward_batch_numpy(self, utilities: NDArray) -> NDArray:
+        return utilities.sum(axis=-1)
+
+    def _forward_batch_torch(self, utilities: Any) -> Any:
+        return utilities.sum(dim=-1)
+
 
 class Rawlsian(Aggregation):
     """Rawlsian Welfare"""
@@ -36,14 +106,32 @@ class Rawlsian(Aggregation):
     def forward(self, utilities: NDArray) -> float:
         return utilities.min()
 
+    def incremental(self, max_value: int) -> "IncrementalRawlsian":
+        return IncrementalRawlsian(self)
+
+    def _forward_batch_numpy(self, utilities: NDArray) -> NDArray:
+        return utilities.min(axis=-1)
+
+    def _forward_batch_torch(self, utilities: Any) -> Any:
+        return utilities.min(dim=-1).values
+
 
 class Egalitarian(Aggregation):
     """Egalitarian Welfare"""
 
     def forward(self, utilities: NDArray) -> float:
-        mean_reward = sum(utilities) / len(utilities)
-        diff_sum = sum(abs(x - mean_reward) for x in utilities)
-        return -diff_sum
+        return self._forward_batch_numpy(np.asarray(utilities))
+
+    def incremental(self, max_value: int) -> "IncrementalEgalitarian":
+        return IncrementalEgalitarian(self, max_value)
+
+    def _forward_batch_numpy(self, utilities: NDArray) -> NDArray:
+        mean_reward = utilities.mean(axis=-1, keepdims=True)
+        return -np.abs(utilities - mean_reward).sum(axis=-1)
+
+    def _forward_batch_torch(self, utilities: Any) -> Any:
+        mean_reward = utilities.mean(dim=-1, keepdim=True)
+        return -(utilities - mean_reward).abs().sum(dim=-1)
 
 
 class Gini(Aggregation):
@@ -55,8 +143,8 @@ class Gini(Aggregation):
     def forward(self, utilities: NDArray) -> float:
         # Calculate the Gini coefficient of a list of values. Based on: http://www.statsdirect.com/help/default.htm#nonparametric_methods/gini.htm
         if np.amin(utilities) < 0:
-            utilities -= np.amin(utilities)
-        utilities += self.epsilon
+            utilities = utilities - np.amin(utilities)
+        utilities = utilities + self.epsilon
         sorted_values = np.sort(utilities)
         index = np.arange(1, utilities.size + 1)
         n = utilities.size
@@ -67,6 +155,29 @@ class Gini(Aggregation):
         # Calculate the Gini reward
         return 1 - gini
 
+    def incremental(self, max_value: int) -> "IncrementalGini":
+        return IncrementalGini(self, max_value)
+
+    def _forward_batch_numpy(self, utilities: NDArray) -> NDArray:
+        shift = np.minimum(utilities.min(axis=-1, keepdims=True), 0)
+        sorted_values = np.sort(utilities - shift + self.epsilon, axis=-1)
+        n = utilities.shape[-1]
+        index = np.arange(1, n + 1)
+        gini = ((2 * index - n - 1) * sorted_values).sum(axis=-1) / (
+            n * sorted_values.sum(axis=-1)
+        )
+        return 1 - gini
+
+    def _forward_batch_torch(self, utilities: Any) -> Any:
+        shift = utilities.min(dim=-1, keepdim=True).values.clamp(max=0)
+        sorted_values = (utilities - shift + self.epsilon).sort(dim=-1).values
+        n = utilities.shape[-1]
+        index = sys.modules["torch"].arange(1, n + 1, device=utilities.device)
+        gini = ((2 * index - n - 1) * sorted_values).sum(dim=-1) / (
+            n * sorted_values.sum(dim=-1)
+        )
+        return 1 - gini
+
 
 class RDP(Aggregation):
     """Relaxed Demographic Parity"""
@@ -74,3 +185,256 @@ class RDP(Aggregation):
     def forward(self, utilities: NDArray) -> float:
         assert len(utilities) == 2
         return -np.abs(utilities[0] - utilities[1])
+
+    def incremental(self, max_value: int) -> "IncrementalRDP":
+        return IncrementalRDP(self)
+
+    def _forward_batch_numpy(self, utilities: NDArray) -> NDArray:
+        assert utilities.shape[-1] == 2
+        return -np.abs(utilities[..., 0] - utilities[..., 1])
+
+    def _forward_batch_torch(self, utilities: Any) -> Any:
+        assert utilities.shape[-1] == 2
+        return -(utilities[..., 0] - utilities[..., 1]).abs()
+
+
+class GroupParity(Aggregation):
+    """Demographic Parity over any number of groups (minus the gap between the most and the least served group, RDP for two groups)"""
+
+    def forward(self, utilities: NDArray) -> float:
+        return -(np.max(utilities) - np.min(utilities))
+
+    def incremental(self, max_value: int) -> "IncrementalGroupParity":
+        return IncrementalGroupParity(self)
+
+    def _forward_batch_numpy(self, utilities: NDArray) -> NDArray:
+        return -(utilities.max(axis=-1) - utilities.min(axis=-1))
+
+    def _forward_batch_torch(self, utilities: Any) -> Any:
+        return -(utilities.max(dim=-1).values - utilities.min(dim=-1).values)
+
+
+class IncrementalAggregation(ABC):
+    """Aggregation of a utility vector that changes one coordinate at a time.
+
+    Instead of aggregating the whole vector again after every change, the summary
+    statistics of the aggregation are updated with the change.
+    """
+
+    def __init__(self, aggregation: Aggregation) -> None:
+        self.aggregation = aggregation
+        self.utilities: list[float] = []
+
+    def reset(self, utilities: NDArray) -> None:
+        """Start tracking a utility vector.
+
+        Args:
+            utilities (NDArray): The utilities.
+        """
+        self.utilities = [float(u) for u in utilities]
+        self._reset()
+
+    def update(self, index: int, delta: float) -> None:
+        """Change one utility.
+
+        Args:
+            index (int): The index of the utility.
+            delta (float): The change of the utility.
+        """
+        old = self.utilities[index]
+        self.utilities[index] = old + delta
+        self._update(index, old, old + delta)
+
+    @abstractmethod
+    def value(self) -> float:
+        """Get the aggregation of the current utilities.
+
+        Returns:
+            float: The aggregated utilities.
+        """
+        ...
+
+    @abstractmethod
+    def _reset(self) -> None: ...
+
+    @abstractmethod
+    def _update(self, index: int, old: float, new: float) -> None: ...
+
+
+class IncrementalNSW(IncrementalAggregation):
+    """Nash Social Welfare as a running sum of logs, O(1) per update"""
+
+    aggregation: NSW
+
+    def _log(self, utility: float) -> float:
+        return math.log(utility + 1 + self.aggregation.epsilon)
+
+    def _reset(self) -> None:
+        self.total = sum(self._log(u) for u in self.utilities)
+
+    def _update(self, index: int, old: float, new: float) -> None:
+        self.total += self._log(new) - self._log(old)
+
+    def value(self) -> float:
+        return self.total
+
+
+class IncrementalUtilitarian(IncrementalAggregation):
+    """Utilitarian Welfare as a running sum, O(1) per update"""
+
+    def _reset(self) -> None:
+        self.total = sum(self.utilities)
+
+    def _update(self, index: int, old: float, new: float) -> None:
+        self.total += new - old
+
+    def value(self) -> float:
+        return self.total
+
+
+class IncrementalRawlsian(IncrementalAggregation):
+    """Rawlsian Welfare with a lazily cleaned min-heap, O(log n) per update"""
+
+    def _reset(self) -> None:
+        self.heap = [(u, i) for i, u in enumerate(self.utilities)]
+        heapq.heapify(self.heap)
+
+    def _update(self, index: int, old: float, new: float) -> None:
+        heapq.heappush(self.heap, (new, index))
+        if len(self.heap) > 4 * len(self.utilities):
+            self._reset()
+
+    def value(self) -> float:
+        # Drop entries of utilities that have changed since they were pushed
+        while self.heap[0][0] != self.utilities[self.heap[0][1]]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0]
+
+
+class _ValueTree:
+    """Fenwick tree over integer values in [0, size) holding their count and sum."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.counts = [0] * (size + 1)
+        self.sums = [0.0] * (size + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float, count: int) -> None:
+        assert value == int(value) and 0 <= value < self.size, "Invalid utility"
+        self.count += count
+        self.total += count * value
+        i = int(value) + 1
+        while i <= self.size:
+            self.counts[i] += count
+            self.sums[i] += count * value
+            i += i & -i
+
+    def prefix(self, value: float) -> tuple[int, float]:
+        # Count and sum of the values <= value
+        i = min(math.floor(value) + 1, self.size)
+        count, total = 0, 0.0
+        while i > 0:
+            count += self.counts[i]
+            total += self.sums[i]
+            i -= i & -i
+        return count, total
+
+    def absolute_deviation(self, center: float) -> float:
+        # Sum of |value - center| over all values
+        count_low, total_low = self.prefix(center)
+        count_high, total_high = self.count - count_low, self.total - total_low
+        return center * count_low - total_low + total_high - center * count_high
+
+
+class IncrementalEgalitarian(IncrementalAggregation):
+    """Egalitarian Welfare with a Fenwick tree over (integer) utilities, O(log max_value) per update"""
+
+    def __init__(self, aggregation: Aggregation, max_value: int) -> None:
+        super().__init__(aggregation)
+        self.max_value = max_value
+
+    def _reset(self) -> None:
+        self.tree = _ValueTree(self.max_value + 1)
+        for u in self.utilities:
+            self.tree.add(u, 1)
+
+    def _update(self, index: int, old: float, new: float) -> None:
+        self.tree.add(old, -1)
+        self.tree.add(new, 1)
+
+    def value(self) -> float:
+        mean_reward = self.tree.total / self.tree.count
+        return -self.tree.absolute_deviation(mean_reward)
+
+
+class IncrementalGini(IncrementalAggregation):
+    """Gini Coefficient based Social Welfare with a Fenwick tree over (non-negative integer) utilities.
+
+    The Gini numerator equals the sum of absolute differences over all pairs, which
+    changes by the difference of the absolute deviations around the old and the new
+    value of the updated utility, O(log max_value) per update.
+    """
+
+    aggregation: Gini
+
+    def __init__(self, aggregation: Aggregation, max_value: int) -> None:
+        super().__init__(aggregation)
+        self.max_value = max_value
+
+    def _reset(self) -> None:
+        self.tree = _ValueTree(self.max_value + 1)
+        self.pair_differences = 0.0
+        for u in self.utilities:
+            self.pair_differences += self.tree.absolute_deviation(u)
+            self.tree.add(u, 1)
+
+    def _update(self, index: int, old: float, new: float) -> None:
+        self.tree.add(old, -1)
+        self.pair_differences += self.tree.absolute_deviation(
+            new
+        ) - self.tree.absolute_deviation(old)
+        self.tree.add(new, 1)
+
+    def value(self) -> float:
+        n = self.tree.count
+        total = self.tree.total + n * self.aggregation.epsilon
+        return 1 - self.pair_differences / (n * total)
+
+
+class IncrementalRDP(IncrementalAggregation):
+    """Relaxed Demographic Parity, O(1) per update"""
+
+    def _reset(self) -> None:
+        assert len(self.utilities) == 2
+
+    def _update(self, index: int, old: float, new: float) -> None:
+        pass
+
+    def value(self) -> float:
+        return -abs(self.utilities[0] - self.utilities[1])
+
+
+class IncrementalGroupParity(IncrementalAggregation):
+    """Demographic Parity over any number of groups with lazily cleaned min- and max-heaps, O(log n) per update"""
+
+    def _reset(self) -> None:
+        self.low = [(u, i) for i, u in enumerate(self.utilities)]
+        self.high = [(-u, i) for i, u in enumerate(self.utilities)]
+        heapq.heapify(self.low)
+        heapq.heapify(self.high)
+
+    def _update(self, index: int, old: float, new: float) -> None:
+        heapq.heappush(self.low, (new, index))
+        heapq.heappush(self.high, (-new, index))
+        if len(self.low) > 4 * len(self.utilities):
+            self._reset()
+
+    def value(self) -> float:
+        # Drop entries of utilities that have changed since they were pushed
+        while self.low[0][0] != self.utilities[self.low[0][1]]:
+            heapq.heappop(self.low)
+        while -self.high[0][0] != self.utilities[self.high[0][1]]:
+            heapq.heappop(self.high)
+        return -(-self.high[0][0] - self.low[0][0])
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from typing import Callable
+import numpy as np
+from numpy.typing import NDArray
+
+
+class EncodingCache:
+    """Bounded LRU memo of encoded (transformed/binarized) memories.
+
+    Entries are keyed by the bytes of the raw memory (with its dtype and shape) and
+    the state mode, so the same small count vectors that come up again and again in
+    counterfactual generation are encoded once. The cached arrays are read-only and
+    shared between callers.
+    """
+
+    def __init__(self, maxsize: int = 4096) -> None:
+        """Create an empty cache.
+
+        Args:
+            maxsize (int, optional): Maximum number of entries (0 disables caching). Defaults to 4096.
+        """
+        self.maxsize = maxsize
+        self.entries: OrderedDict[tuple, NDArray] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(
+        self, memory: NDArray, state_mode: str, encode: Callable[[NDArray], NDArray]
+    ) -> NDArray:
+        """Get the encoding of a memory, computing it on a miss.
+
+        Args:
+            memory (NDArray): The raw memory.
+            state_mode (str): The state mode of the encoding.
+            encode (Callable[[NDArray], NDArray]): Computes the encoding of a memory.
+
+        Returns:
+            NDArray: The (read-only) encoded memory.
+        """
+        key = (state_mode, memory.dtype.str, memory.shape, memory.tobytes())
+        encoded = self.entries.get(key)
+        if encoded is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return encoded
+
+        self.misses += 1
+        encoded = np.asarray(encode(memory))
+        encoded.setflags(write=False)
+        if self.maxsize > 0:
+            self.entries[key] = encoded
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return encoded
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self) -> dict:
+        """Get the counters of the cache.
+
+        Returns:
+            dict: Hits, misses, hit rate and number of entries.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "size": len(self.entries),
+        }
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,166 @@
+import copy
+import multiprocessing
+import random
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from numpy.typing import NDArray
+from typing import Any, Callable
+from gym import Env
+
+# Env attributes that change during an episode and that the counterfactual
+# transitions depend on (copied to the worker env of each job)
+SYNCED_ATTRIBUTES = ("prob", "prob_tracker", "arrivals")
+
+# The env of the current worker (one per thread or process)
+_local = threading.local()
+
+
+def _init_worker(env_fn: Callable[[], Env], own_process: bool) -> None:
+    _local.env = env_fn()
+    _local.own_process = own_process
+
+
+def _generate(
+    env_state: dict[str, Any],
+    seed: int,
+    args: tuple,
+    n_counterfactuals: int,
+    cf_kwargs: dict,
+) -> list[tuple]:
+    env = _local.env
+    for name, value in env_state.items():
+        setattr(env, name, value)
+    if getattr(env, "rng", None) is not None:
+        env.rng = np.random.default_rng(seed)
+    elif _local.own_process:
+        # Envs without their own generator draw from the global random state, which
+        # is private to a process worker
+        random.seed(seed)
+        np.random.seed(seed)
+    return env.get_counterfactual_transitions(*args, n_counterfactuals, **cf_kwargs)
+
+
+class CounterfactualProducer:
+    """Generates counterfactual transitions in a pool of workers.
+
+    Each worker has its own copy of the env. A job carries the arguments of
+    `get_counterfactual_transitions` plus the episode state of the env (see
+    `SYNCED_ATTRIBUTES`), so the training loop only submits jobs and stores the
+    finished batches as they complete instead of waiting on them.
+
+    The transitions follow the same dynamics as in the training loop but draw other
+    random numbers. Each job is seeded from the run seed and its index: envs with
+    their own generator are reseeded, otherwise process workers reseed the global
+    random state. Thread workers share the global random state with the training
+    loop, so they are only reproducible for envs with their own generator.
+    """
+
+    def __init__(
+        self,
+        env_fn: Callable[[], Env],
+        n_counterfactuals: int,
+        cf_kwargs: dict | None = None,
+        workers: int = 1,
+        executor: str = "process",
+        seed: int = 42,
+        max_pending: int | None = None,
+    ) -> None:
+        """Start the workers.
+
+        Args:
+            env_fn (Callable[[], Env]): Picklable function creating the env of a worker.
+            n_counterfactuals (int): Number of counterfactual transitions per job.
+            cf_kwargs (dict | None, optional): Keyword arguments of `get_counterfactual_transitions`. Defaults to None.
+            workers (int, optional): Number of workers. Defaults to 1.
+            executor (str, optional): "process" or "thread" workers. Defaults to "process".
+            seed (int, optional): Seed of the job seeds. Defaults to 42.
+            max_pending (int | None, optional): Maximum number of unfinished jobs before `submit` waits (4 per worker if None). Defaults to None.
+        """
+        self.n_counterfactuals = n_counterfactuals
+        self.cf_kwargs = cf_kwargs or {}
+        self.seed = seed
+        self.max_pending = 4 * workers if max_pending is None else max_pending
+        self.pending: deque[Future] = deque()
+        self.jobs = 0
+        self.executor: Executor
+        if executor == "process":
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(env_fn, True),
+            )
+        elif executor == "thread":
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(env_fn, False)
+            )
+        else:
+            raise ValueError(f"Unknown executor {executor!r}")
+
+    def submit(
+        self,
+        env: Env,
+        state: NDArray,
+        actual_state: NDArray,
+        action: int | NDArray,
+        actual_memory: NDArray,
+        schedule_step: int,
+    ) -> None:
+        """Submit the counterfactual transitions of a step.
+
+        Args:
+            env (Env): The env of the step (after the step).
+            state (NDArray): The state before the step.
+            actual_state (NDArray): The state of the env before the step.
+            action (int | NDArray): The action taken.
+            actual_memory (NDArray): The memory of the env before the step.
+            schedule_step (int): The step of the schedule.
+        """
+        if len(self.pending) >= self.max_pending:
+            # Let the workers catch up
+            self.pending[0].result()
+        env_state = {
+            name: copy.deepcopy(getattr(env, name))
+            for name in SYNCED_ATTRIBUTES
+            if hasattr(env, name)
+        }
+        seed = int(np.random.SeedSequence([self.seed, self.jobs]).generate_state(1)[0])
+        args = (state, actual_state, action, actual_memory, schedule_step)
+        self.pending.append(
+            self.executor.submit(
+                _generate,
+                env_state,
+                seed,
+                args,
+                self.n_counterfactuals,
+                self.cf_kwargs,
+            )
+        )
+        self.jobs += 1
+
+    def collect(self, wait: bool = False) -> list[tuple]:
+        """Get the transitions of the jobs that have finished since the last call.
+
+        Args:
+            wait (bool, optional): Whether to wait for all the submitted jobs. Defaults to False.
+
+        Returns:
+            list[tuple]: The counterfactual transitions.
+        """
+        transitions = []
+        for future in [f for f in self.pending if wait or f.done()]:
+            transitions += future.result()
+            self.pending.remove(future)
+        return transitions
+
+    def close(self) -> list[tuple]:
+        """Wait for the submitted jobs and stop the workers.
+
+        Returns:
+            list[tuple]: The counterfactual transitions of the jobs that were still pending.
+        """
+        transitions = self.collect(wait=True)
+        self.executor.shutdown()
+        return transitions
@@ -0,0 +1,254 @@
+import json
+import os
+import numpy as np
+import torch
+from numpy.typing import NDArray
+from gym import Env
+
+# Name of the description of a dataset (layout and shards) in its directory
+META_FILE = "meta.json"
+
+
+class DatasetRecorder:
+    """Records the transitions of a run in memory-mapped `.npy` shards.
+
+    Each row holds `state, memory, action, reward, next_state, next_memory` and a
+    flag that is 1 for counterfactual transitions. The rows are written to a shard
+    mapped with `np.lib.format.open_memmap` until it holds `shard_size` rows, then the
+    next shard is started; the last shard is truncated to its rows on `close`. The
+    layout and the finished shards are listed in `meta.json`, which is rewritten after
+    every shard, so an interrupted recording can still be loaded.
+    """
+
+    def __init__(
+        self, path: str, shard_size: int = 65_536, meta: dict | None = None
+    ) -> None:
+        """Create the directory of the dataset.
+
+        Args:
+            path (str): Directory of the dataset.
+            shard_size (int, optional): Number of rows per shard. Defaults to 65_536.
+            meta (dict | None, optional): Extra description of the dataset (e.g. the env and state mode). Defaults to None.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shard_size = shard_size
+        self.meta = dict(meta or {})
+        self.meta["shards"] = []
+        self.shard: np.memmap | None = None
+        self.rows = 0
+        self.actual = 0
+
+    def _layout(self, transition: tuple) -> None:
+        state, memory, action, _, _, _ = transition
+        self.meta["state_length"] = int(np.size(state))
+        self.meta["memory_length"] = int(np.size(memory))
+        self.meta["action_length"] = int(np.size(action))
+        self.meta["row_length"] = (
+            2 * (self.meta["state_length"] + self.meta["memory_length"])
+            + self.meta["action_length"]
+            + 2
+        )
+
+    def _open_shard(self) -> None:
+        name = f"shard_{len(self.meta['shards']):05d}.npy"
+        self.shard = np.lib.format.open_memmap(
+            os.path.join(self.path, name),
+            mode="w+",
+            dtype=np.float32,
+            shape=(self.shard_size, self.meta["row_length"]),
+        )
+        self.meta["shards"].append({"file": name, "rows": 0, "actual": 0})
+        self.rows = 0
+        self.actual = 0
+
+    def _close_shard(self) -> None:
+        assert self.shard is not None
+        info = self.meta["shards"][-1]
+        info["rows"], info["actual"] = self.rows, self.actual
+        file = os.path.join(self.path, info["file"])
+        if self.rows < self.shard_size:
+            # Truncate the last shard to its rows
+            rows = np.array(self.shard[: self.rows])
+            del self.shard
+            np.save(file, rows)
+        else:
+            self.shard.flush()
+            del self.shard
+        self.shard = None
+        self.write_meta()
+
+    def write_meta(self) -> None:
+        with open(os.path.join(self.path, META_FILE), "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    def add(
+        self,
+        transitions: list[
+            tuple[NDArray, NDArray, int | NDArray, float, NDArray, NDArray]
+        ],
+        counterfactual: bool = False,
+    ) -> None:
+        """Record transitions.
+
+        Args:
+            transitions (list[tuple[NDArray, NDArray, int | NDArray, float, NDArray, NDArray]]): The (state, memory, action, reward, next_state, next_memory) tuples.
+            counterfactual (bool, optional): Whether the transitions are counterfactual. Defaults to False.
+        """
+        if not transitions:
+            return
+        if "row_length" not in self.meta:
+            self._layout(transitions[0])
+        flag = float(counterfactual)
+        rows = np.array(
+            [np.hstack((*transition, flag)) for transition in transitions],
+            dtype=np.float32,
+        )
+        start = 0
+        while start < len(rows):
+            if self.shard is None:
+                self._open_shard()
+            assert self.shard is not None
+            count = min(len(rows) - start, self.shard_size - self.rows)
+            self.shard[self.rows : self.rows + count] = rows[start : start + count]
+            self.rows += count
+            if not counterfactual:
+                self.actual += count
+            start += count
+            if self.rows == self.shard_size:
+                self._close_shard()
+
+    def close(self) -> None:
+        if self.shard is not None:
+            self._close_shard()
+        else:
+            self.write_meta()
+
+
+class OfflineDataset:
+    """Samples batches of recorded transitions (see `DatasetRecorder`) for DQN.
+
+    The shards are memory-mapped, so only the sampled rows are read. Rows are
+    sampled in blocks of `block_batches` batches: the indices of a block are sorted
+    per shard so the reads are sequential, and the block is converted to a tensor
+    once and then handed out batch by batch. Raw memories (recorded in raw replay
+    mode) are encoded by the env at sample time.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        device: torch.device | str,
+        counterfactuals: bool = True,
+        block_batches: int = 64,
+        env: Env | None = None,
+    ) -> None:
+        """Open the shards of a dataset.
+
+        Args:
+            path (str): Directory of the dataset.
+            device (torch.device | str): Device of the sampled batches.
+            counterfactuals (bool, optional): Whether to sample the counterfactual transitions too. Defaults to True.
+            block_batches (int, optional): Number of batches loaded at once. Defaults to 64.
+            env (Env | None, optional): The env encoding raw memories (only needed for raw datasets). Defaults to None.
+        """
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        assert self.meta["shards"], f"No transitions recorded in {path}"
+        self.device = device
+        self.block_batches = block_batches
+        self.env = env
+        self.raw = self.meta.get("memory_key") == "raw_memory"
+        assert not self.raw or env is not None, "Raw datasets need the env to encode"
+        assert self.meta["action_length"] == 1, "Only discrete actions are supported"
+
+        self.shards: list[NDArray] = []
+        # Sampled rows of each shard (None for all the rows)
+        self.rows: list[NDArray | None] = []
+        sizes = []
+        for info in self.meta["shards"]:
+            shard = np.load(os.path.join(path, info["file"]), mmap_mode="r")
+            shard = shard[: info["rows"]]
+            rows = None
+            if not counterfactuals:
+                rows = np.flatnonzero(shard[:, -1] == 0)
+            self.shards.append(shard)
+            self.rows.append(rows)
+            sizes.append(info["rows"] if rows is None else len(rows))
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self.size = int(self.offsets[-1])
+        assert self.size > 0, f"No transitions to sample in {path}"
+
+        self.state_length = self.meta["state_length"]
+        self.memory_length = self.meta["memory_length"]
+        self.block: tuple[torch.Tensor, ...] | None = None
+        self.block_size = 0
+        self.position = 0
+        self.batch_size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        if self.block is None:
+            return 0
+        return sum(t.element_size() * t.nelement() for t in self.block)
+
+    def _load_block(self, n: int) -> NDArray:
+        index = np.random.randint(self.size, size=n)
+        shard_ids = np.searchsorted(self.offsets, index, side="right") - 1
+        block = np.empty((n, self.meta["row_length"]), dtype=np.float32)
+        for shard_id in np.unique(shard_ids):
+            positions = np.flatnonzero(shard_ids == shard_id)
+            local = index[positions] - self.offsets[shard_id]
+            rows = self.rows[shard_id]
+            if rows is not None:
+                local = rows[local]
+            order = np.argsort(local, kind="stable")
+            block[positions[order]] = self.shards[shard_id][local[order]]
+        return block
+
+    def _split(self, block: NDArray) -> tuple[torch.Tensor, ...]:
+        s, m = self.state_length, self.memory_length
+        state = block[:, :s]
+        memory = block[:, s : s + m]
+        action = block[:, s + m].astype(np.int64)
+        reward = block[:, s + m + 1]
+        next_state = block[:, s + m + 2 : 2 * s + m + 2]
+        next_memory = block[:, 2 * s + m + 2 : 2 * (s + m) + 2]
+        if self.raw:
+            assert self.env is not None
+            encoded = self.env.encode_memories(np.concatenate([memory, next_memory]))
+            memory, next_memory = encoded[: len(block)], encoded[len(block) :]
+        obs = np.concatenate([state, memory], axis=1)
+        next_obs = np.concatenate([next_state, next_memory], axis=1)
+        return tuple(
+            torch.from_numpy(np.ascontiguousarray(array)).to(self.device)
+            for array in (obs, action[:, None], reward[:, None], next_obs)
+        )
+
+    def sample(
+        self, batch_size: int, out: torch.Tensor | None = None
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Sample a batch of transitions (uniformly, with replacement).
+
+        Args:
+            batch_size (int): The batch size.
+            out (torch.Tensor | None, optional): Unused (the batches are views of the loaded block). Defaults to None.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]: The observations, actions, rewards and next observations.
+        """
+        if (
+            self.block is None
+            or batch_size != self.batch_size
+            or self.position + batch_size > self.block_size
+        ):
+            self.batch_size = batch_size
+            self.block_size = batch_size * self.block_batches
+            self.block = self._split(self._load_block(self.block_size))
+            self.position = 0
+        batch = tuple(t[self.position : self.position + batch_size] for t in self.block)
+        self.position += batch_size
+        return batch
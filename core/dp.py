@@ -0,0 +1,286 @@
+import numpy as np
+from numpy.typing import NDArray
+from itertools import product
+from typing import Callable
+from envs.donut import Donut
+
+
+class DonutDP:
+    """Exact finite-horizon dynamic programming for the Donut environment.
+
+    Arrivals are independent Bernoulli draws and the reward only depends on the
+    memory (donuts allocated so far), so the optimal value-to-go before the arrivals
+    are seen is a function of the step and the memory alone. The expectation over
+    the 2^n arrival patterns is computed in closed form: the best person present is
+    person j with probability p_j times the probability that every better person is
+    absent.
+
+    When every person has the same arrival probabilities, memories are reduced to
+    sorted vectors (all aggregations are symmetric), which shrinks the state space
+    from all count vectors to partitions of at most `people` parts.
+    """
+
+    def __init__(self, env: Donut, max_states: int = 20_000_000) -> None:
+        assert not env.dynamic_prob, "Dynamic probabilities are not supported"
+
+        self.env = env
+        self.people = env.people
+        self.horizon = env.episode_length
+        self.aggregation = env.aggregation
+        self.state_mode = env.state_mode
+        self.reset_equal = env.state_mode == "reset"
+
+        # Arrival probabilities of the customers seen at each decision step
+        self.probs = np.array([self.arrival_probs(t) for t in range(self.horizon)])
+        self.symmetric = bool(np.allclose(self.probs, self.probs[:, :1]))
+
+        # Enumerate the memories (sorted by number of allocated donuts)
+        self.base = self.horizon + 1
+        assert self.base**self.people < 2**63, "Too many people for int64 keys"
+        self.memories = self._enumerate_memories(max_states)
+        self.count_le = np.searchsorted(
+            self.memories.sum(axis=1), np.arange(self.horizon + 1), side="right"
+        )
+        keys = self._keys(self.memories)
+        self.key_order = np.argsort(keys)
+        self.sorted_keys = keys[self.key_order]
+
+        # Reward of reaching each memory
+        self.rewards = self.aggregation.forward_batch(
+            self.memories.astype(np.float32)
+        ).astype(np.float64)
+
+        self.next_values: list[NDArray] | None = None
+        self.optimal_return: float | None = None
+        self.pruned_mass = 0.0
+
+    def arrival_probs(self, t: int) -> NDArray:
+        """Arrival probabilities of the customers seen at decision t (0-indexed).
+
+        Args:
+            t (int): The decision step.
+
+        Returns:
+            NDArray: The arrival probability of each person.
+        """
+        env = self.env
+        if t == 0 or env.distribution is None:
+            return np.array(env.prob, dtype=np.float64)
+
+        prob_fn = {
+            "logistic": env.logistic_prob,
+            "bell": env.bell_prob,
+            "uniform-interval": env.uniform_interval_prob,
+        }[env.distribution]
+        return np.array(
+            [prob_fn(t, env.d_param1[i], env.d_param2[i]) for i in range(self.people)],
+            dtype=np.float64,
+        )
+
+    def _enumerate_memories(self, max_states: int) -> NDArray:
+        rows = np.zeros((1, 0), dtype=np.int64)
+        for _ in range(self.people):
+            upper = self.horizon - rows.sum(axis=1)
+            if self.symmetric and rows.shape[1] > 0:
+                upper = np.minimum(upper, rows[:, -1])
+            counts = upper + 1
+            if counts.sum() > max_states:
+                raise ValueError(
+                    f"More than {max_states:,} memories, the problem is too large"
+                )
+            parent = np.repeat(np.arange(len(rows)), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            rows = np.concatenate([rows[parent], offsets[:, None]], axis=1)
+
+        order = np.argsort(rows.sum(axis=1), kind="stable")
+        return rows[order]
+
+    def _keys(self, memory: NDArray) -> NDArray:
+        return memory @ (self.base ** np.arange(self.people, dtype=np.int64))
+
+    def _canonical(self, memory: NDArray, reset: bool = False) -> NDArray:
+        if self.symmetric:
+            memory = -np.sort(-memory, axis=1)
+        if reset:
+            memory = self._reset(memory)
+        return memory
+
+    def _reset(self, memory: NDArray) -> NDArray:
+        if not self.reset_equal:
+            return memory
+        equal = np.all(memory == memory[:, :1], axis=1)
+        return np.where(equal[:, None], 0, memory)
+
+    def _index(self, memory: NDArray) -> NDArray:
+        return self.key_order[np.searchsorted(self.sorted_keys, self._keys(memory))]
+
+    def _successors(self, memory: NDArray) -> tuple[NDArray, NDArray, NDArray]:
+        # Indices of the memory reached by giving a donut to each person (before and
+        # after a reset) and of the memory kept when the donut is dropped
+        successors = memory[:, None, :] + np.eye(self.people, dtype=np.int64)[None]
+        successors = successors.reshape(-1, self.people)
+        reached = self._index(self._canonical(successors)).reshape(len(memory), -1)
+        kept = self._index(self._canonical(successors, reset=self.reset_equal)).reshape(
+            len(memory), -1
+        )
+        dropped = self._index(self._canonical(memory, reset=self.reset_equal))
+        return reached, kept, dropped
+
+    def _action_values(
+        self,
+        successors: tuple[NDArray, NDArray, NDArray],
+        next_values: NDArray,
+    ) -> tuple[NDArray, NDArray]:
+        # Value of giving a donut to each person (reward + value-to-go) and of dropping it
+        reached, kept, dropped = successors
+        values = self.rewards[reached] + next_values[kept]
+        return values, next_values[dropped]
+
+    def _expected_max(self, values: NDArray, drop: NDArray, probs: NDArray) -> NDArray:
+        # E[max(drop, max of values of present people)] for independent arrivals
+        best = np.maximum(values, drop[:, None])
+        order = np.argsort(-best, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        present = probs[order]
+        all_absent = np.cumprod(1 - present, axis=1)
+        first = present * np.concatenate(
+            [np.ones((len(best), 1)), all_absent[:, :-1]], axis=1
+        )
+        expected = (first * best).sum(axis=1) + all_absent[:, -1] * drop
+
+        # Dropping the donut requires choosing someone who is absent
+        max_value = values.max(axis=1)
+        expected += np.prod(probs) * (max_value - np.maximum(max_value, drop))
+        return expected
+
+    def solve(self) -> float:
+        """Run finite-horizon value iteration.
+
+        Returns:
+            float: The optimal expected (undiscounted) episode return.
+        """
+        # The memories reachable at each step are a prefix of the table, so the
+        # successors are computed once for the longest prefix
+        reached, kept, dropped = self._successors(
+            self.memories[: self.count_le[self.horizon - 1]]
+        )
+
+        next_values = np.zeros(self.count_le[self.horizon])
+        self.next_values = [np.empty(0)] * self.horizon
+        for t in range(self.horizon - 1, -1, -1):
+            self.next_values[t] = next_values
+            size = self.count_le[t]
+            values, drop = self._action_values(
+                (reached[:size], kept[:size], dropped[:size]), next_values
+            )
+            next_values = self._expected_max(values, drop, self.probs[t])
+
+        self.optimal_return = float(next_values[0])
+        return self.optimal_return
+
+    def optimal_action(self, t: int, state: NDArray, memory: NDArray) -> int:
+        """Get the optimal action at a decision step (requires `solve`).
+
+        Args:
+            t (int): The decision step (0-indexed).
+            state (NDArray): The customers at the counter.
+            memory (NDArray): The memory of the env (number of donuts given to each person).
+
+        Returns:
+            int: The optimal action.
+        """
+        assert self.next_values is not None, "Call solve() first"
+        memory = np.asarray(memory, dtype=np.int64)[None]
+        values, drop = self._action_values(
+            self._successors(memory), self.next_values[t]
+        )
+        values = np.where(np.asarray(state) == 1, values[0], -np.inf)
+        if drop[0] > values.max() and not np.all(state == 1):
+            return int(np.argmin(state))
+        return int(np.argmax(values))
+
+    def encode_memory(self, memory: NDArray) -> NDArray:
+        """Vectorized equivalent of `Donut.get_transformed_memory` for a batch of memories.
+
+        Args:
+            memory (NDArray): The memories, one row each.
+
+        Returns:
+            NDArray: The transformed (binarized) memories.
+        """
+        return self.env.encode_memories(memory)
+
+    def evaluate_policy(
+        self,
+        policy: Callable[[NDArray], NDArray],
+        tol: float = 1e-12,
+        chunk_size: int = 65_536,
+    ) -> float:
+        """Compute the expected (undiscounted) return of a deterministic policy.
+
+        The distribution over memories is propagated forward under the policy, so the
+        cost scales with the number of memories the policy actually reaches. Almost
+        every memory is reachable with some (vanishingly small) probability, so memories
+        with less than `tol` probability are pruned; the total pruned probability is
+        stored in `pruned_mass` and bounds the error (times the largest return).
+
+        Args:
+            policy (Callable[[NDArray], NDArray]): Maps a batch of observations (customers followed by the transformed memory) to actions.
+            tol (float, optional): Probability below which memories are pruned (0 for exact). Defaults to 1e-12.
+            chunk_size (int, optional): Maximum number of observations per policy call. Defaults to 65,536.
+
+        Returns:
+            float: The expected episode return.
+        """
+        patterns = np.array(list(product([0, 1], repeat=self.people)), dtype=np.int64)
+        memories = np.zeros((1, self.people), dtype=np.int64)
+        mass = np.ones(1)
+        expected = 0.0
+        self.pruned_mass = 0.0
+
+        for t in range(self.horizon):
+            # Probability of each arrival pattern
+            probs = self.probs[t]
+            pattern_probs = np.prod(np.where(patterns == 1, probs, 1 - probs), axis=1)
+            possible = pattern_probs > 0
+
+            # Act in every (memory, arrival pattern) pair
+            arrivals = np.tile(patterns[possible], (len(memories), 1))
+            memory = np.repeat(memories, possible.sum(), axis=0)
+            weights = np.repeat(mass, possible.sum()) * np.tile(
+                pattern_probs[possible], len(memories)
+            )
+            obs = np.concatenate(
+                [arrivals.astype(np.float32), self.encode_memory(memory)], axis=1
+            )
+            actions = np.concatenate(
+                [
+                    np.asarray(policy(obs[i : i + chunk_size]), dtype=np.int64)
+                    for i in range(0, len(obs), chunk_size)
+                ]
+            )
+
+            # Transition and reward (the memory is reset before the transition)
+            served = arrivals[np.arange(len(arrivals)), actions] == 1
+            new_memory = self._reset(memory)
+            new_memory[served, actions[served]] += 1
+            rewards = np.where(
+                served, self.rewards[self._index(self._canonical(new_memory))], 0.0
+            )
+            expected += float((weights * rewards).sum())
+
+            # Merge identical memories
+            _, first, inverse = np.unique(
+                self._keys(new_memory), return_index=True, return_inverse=True
+            )
+            memories = new_memory[first]
+            mass = np.bincount(inverse.ravel(), weights=weights)
+
+            # Prune unlikely memories
+            keep = mass >= tol
+            self.pruned_mass += float(mass[~keep].sum())
+            memories, mass = memories[keep], mass[keep]
+
+        return expected
@@ -0,0 +1,248 @@
+import json
+import os
+import pickle
+import socket
+import threading
+import time
+from typing import Any
+
+# Directories of the jobs in each state
+STATES = ("pending", "running", "done", "failed")
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    # Write to a temporary file next to the target and rename it over the target, so
+    # readers (on any host) never see a partial file
+    tmp = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class JobQueue:
+    """A job queue in a (shared) directory, coordinated by atomic renames.
+
+    Each job is a JSON file that moves between the `pending`, `running`, `done` and
+    `failed` directories. A worker claims a job by renaming it from `pending` to
+    `running`: the rename only succeeds for one worker, on one host or several
+    sharing the directory over NFS (unlike SQLite, whose locks are unreliable on
+    NFS). While a job runs its worker touches the file as a heartbeat, and a job
+    whose heartbeat is older than `timeout` seconds is moved back to `pending` (or
+    to `failed` after `max_attempts` claims) by any worker. The results of the jobs
+    are pickled in `results`.
+    """
+
+    def __init__(self, path: str, timeout: float = 600.0, max_attempts: int = 3):
+        """Create the directories of the queue (if needed).
+
+        Args:
+            path (str): Directory of the queue.
+            timeout (float, optional): Seconds without a heartbeat after which a running job is requeued. Defaults to 600.0.
+            max_attempts (int, optional): Number of claims of a job before it fails. Defaults to 3.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        for name in [*STATES, "results", "locks"]:
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+
+    def _file(self, state: str, job_id: str) -> str:
+        return os.path.join(self.path, state, f"{job_id}.json")
+
+    def _read(self, path: str) -> dict:
+        with open(path) as f:
+            return json.load(f)
+
+    def _write(self, path: str, job: dict) -> None:
+        _write_atomic(path, json.dumps(job, indent=2).encode())
+
+    def jobs(self, state: str) -> list[str]:
+        """Get the ids of the jobs in a state.
+
+        Args:
+            state (str): The state.
+
+        Returns:
+            list[str]: The (sorted) job ids.
+        """
+        return sorted(
+            name[: -len(".json")]
+            for name in os.listdir(os.path.join(self.path, state))
+            if name.endswith(".json")
+        )
+
+    def job(self, state: str, job_id: str) -> dict:
+        return self._read(self._file(state, job_id))
+
+    def state(self, job_id: str) -> str | None:
+        # A job with a result is done, even if a requeued copy still runs elsewhere
+        for state in ("done", *STATES):
+            if os.path.exists(self._file(state, job_id)):
+                return state
+        return None
+
+    def counts(self) -> dict[str, int]:
+        return {state: len(self.jobs(state)) for state in STATES}
+
+    def submit(self, job: dict) -> bool:
+        """Add a job (unless a job with the same id is already in the queue).
+
+        Args:
+            job (dict): The job, with a unique "id".
+
+        Returns:
+            bool: Whether the job was added.
+        """
+        if self.state(job["id"]) is not None:
+            return False
+        self._write(self._file("pending", job["id"]), {"attempts": 0, **job})
+        return True
+
+    def claim(self, worker: str) -> dict | None:
+        """Claim a pending job.
+
+        Args:
+            worker (str): Name of the worker.
+
+        Returns:
+            dict | None: The job, or None if no job is pending.
+        """
+        for job_id in self.jobs("pending"):
+            running = self._file("running", job_id)
+            try:
+                os.rename(self._file("pending", job_id), running)
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
+            job = self._read(running)
+            job["attempts"] += 1
+            job["worker"] = worker
+            job["started"] = time.time()
+            self._write(running, job)
+            return job
+        return None
+
+    def heartbeat(self, job_id: str) -> bool:
+        """Mark a running job as alive.
+
+        Args:
+            job_id (str): The job.
+
+        Returns:
+            bool: Whether the job is still running (False if it was requeued).
+        """
+        try:
+            os.utime(self._file("running", job_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _finish(self, job: dict, state: str) -> None:
+        job["finished"] = time.time()
+        self._write(self._file(state, job["id"]), job)
+        running = self._file("running", job["id"])
+        try:
+            # Only remove the running file of this worker: if the job was requeued
+            # while it ran and claimed again, the file belongs to the other worker
+            if self._read(running).get("worker") == job["worker"]:
+                os.remove(running)
+        except FileNotFoundError:
+            # Requeued while it ran, the results are the same
+            pass
+
+    def complete(self, job: dict, result: Any) -> None:
+        """Save the result of a job and mark it as done.
+
+        Args:
+            job (dict): The job.
+            result (Any): The (picklable) result.
+        """
+        path = os.path.join(self.path, "results", f"{job['id']}.pkl")
+        _write_atomic(path, pickle.dumps(result))
+        self._finish(job, "done")
+        try:
+            # Drop the copy that was requeued while the job ran (if not claimed yet)
+            os.remove(self._file("pending", job["id"]))
+        except FileNotFoundError:
+            pass
+
+    def fail(self, job: dict, error: str) -> None:
+        job["error"] = error
+        self._finish(job, "failed")
+
+    def result(self, job_id: str) -> Any:
+        with open(os.path.join(self.path, "results", f"{job_id}.pkl"), "rb") as f:
+            return pickle.load(f)
+
+    def requeue_stale(self) -> list[str]:
+        """Requeue the running jobs whose heartbeat is older than the timeout.
+
+        Returns:
+            list[str]: The requeued (or failed) jobs.
+        """
+        requeued = []
+        now = time.time()
+        for job_id in self.jobs("running"):
+            running = self._file("running", job_id)
+            try:
+                # The ctime changes on the claim (rename) and on every heartbeat
+                if now - os.stat(running).st_ctime < self.timeout:
+                    continue
+                # Take the job out of the running jobs (only one worker succeeds)
+                stale = os.path.join(self.path, "locks", f"{job_id}.stale")
+                os.rename(running, stale)
+            except FileNotFoundError:
+                continue
+            job = self._read(stale)
+            state = "failed" if job["attempts"] >= self.max_attempts else "pending"
+            if state == "failed":
+                job["error"] = f"No heartbeat for {self.timeout:.0f} s"
+            self._write(self._file(state, job_id), job)
+            os.remove(stale)
+            requeued.append(job_id)
+        return requeued
+
+    def lock(self, name: str) -> bool:
+        """Take a named lock once (e.g. to merge the results of a group of jobs).
+
+        Args:
+            name (str): Name of the lock.
+
+        Returns:
+            bool: Whether this call took the lock (False if it was already taken).
+        """
+        try:
+            fd = os.open(
+                os.path.join(self.path, "locks", name),
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+            )
+        except FileExistsError:
+            return False
+        os.close(fd)
+        return True
+
+
+class Heartbeat:
+    """Touches a running job periodically in a background thread (context manager)."""
+
+    def __init__(self, queue: JobQueue, job_id: str, interval: float) -> None:
+        self.queue = queue
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _beat(self) -> None:
+        while not self.stopped.wait(self.interval):
+            if not self.queue.heartbeat(self.job_id):
+                break
+
+    def __enter__(self) -> "Heartbeat":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stopped.set()
+        self.thread.join()
@@ -1,6 +1,7 @@
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
+from typing import Callable
 
 
 class MLPPolicy(nn.Module):
@@ -49,3 +50,40 @@ class RNNPolicy(nn.Module):
         x, hidden = self.rnn(x, prev_hidden)
         x = self.out_layer(x)
         return x, hidden
+
+
+def trace_policy(
+    policy: nn.Module, states: int
+) -> Callable[..., tuple[torch.Tensor, torch.Tensor | None]]:
+    """Trace a policy with TorchScript for low-overhead single-observation inference.
+
+    The traced graph shares its parameters with the policy, so weight updates are
+    picked up without retracing.
+
+    Args:
+        policy (nn.Module): The policy (MLPPolicy or RNNPolicy).
+        states (int): The observation size.
+
+    Returns:
+        Callable[..., tuple[torch.Tensor, torch.Tensor | None]]: A function with the same signature as the policy's forward.
+    """
+    device = next(policy.parameters()).device
+    example = torch.zeros((1, states), device=device)
+
+    if isinstance(policy, RNNPolicy):
+        initial_hidden = torch.zeros([1, policy.hidden_size], device=device)
+        traced_rnn = torch.jit.trace(policy, (example, initial_hidden))
+
+        def forward_rnn(x, prev_hidden=None):
+            if prev_hidden is None:
+                prev_hidden = initial_hidden
+            return traced_rnn(x, prev_hidden)
+
+        return forward_rnn
+
+    traced_mlp = torch.jit.trace(policy.model, (example,))
+
+    def forward_mlp(x, prev_hidden=None):
+        return traced_mlp(x), None
+
+    return forward_mlp
@@ -0,0 +1,67 @@
+"""Registry of the envs, agents and aggregations that can be selected by name.
+
+Each entry maps a name to a "module:attribute" path that is only imported when the
+name is resolved, so a run only imports what it uses (e.g. a donut DQN run does not
+import the covid env or stable_baselines3).
+"""
+
+from importlib import import_module
+from typing import Any
+
+ENVS: dict[str, str] = {
+    "donut": "envs.donut:Donut",
+    "lending": "envs.lending:Lending",
+    "covid": "envs.covid:CovidSEIREnv",
+}
+
+AGENTS: dict[str, str] = {
+    "dqn": "core.agents:DQN",
+    "sac": "core.agents:SAC",
+    "random": "core.agents:Random",
+    "random_cont": "core.agents:Random",
+}
+
+AGGREGATIONS: dict[str, str] = {
+    "nsw": "core.aggregations:NSW",
+    "utilitarian": "core.aggregations:Utilitarian",
+    "rawlsian": "core.aggregations:Rawlsian",
+    "egalitarian": "core.aggregations:Egalitarian",
+    "gini": "core.aggregations:Gini",
+    "rdp": "core.aggregations:RDP",
+    "parity": "core.aggregations:GroupParity",
+}
+
+REGISTRIES: dict[str, dict[str, str]] = {
+    "env": ENVS,
+    "agent": AGENTS,
+    "aggregation": AGGREGATIONS,
+}
+
+
+def register(kind: str, name: str, target: str) -> None:
+    """Register (or replace) an entry.
+
+    Args:
+        kind (str): The kind of entry ("env", "agent" or "aggregation").
+        name (str): The name used to select the entry.
+        target (str): The "module:attribute" path of the class.
+    """
+    assert ":" in target, "The target must be a 'module:attribute' path"
+    REGISTRIES[kind][name] = target
+
+
+def resolve(kind: str, name: str) -> Any:
+    """Import and return the class registered under a name.
+
+    Args:
+        kind (str): The kind of entry ("env", "agent" or "aggregation").
+        name (str): The registered name.
+
+    Returns:
+        Any: The registered class.
+    """
+    registry = REGISTRIES[kind]
+    if name not in registry:
+        raise ValueError(f"Unknown {kind} {name!r}, choose from {sorted(registry)}")
+    module, attribute = registry[name].split(":")
+    return getattr(import_module(module), attribute)
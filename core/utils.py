@@ -1,34 +1,247 @@
+import cProfile
+import sys
+import threading
+import time
 import numpy as np
+from contextlib import nullcontext
 from numpy.typing import NDArray
 import torch
 
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def peak_rss_bytes() -> int | None:
+    """Get the peak resident set size of the process (None if unavailable).
+
+    Returns:
+        int | None: The peak RSS in bytes.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def object_bytes(obj) -> int:
+    """Get the (approximate) size in bytes of nested lists, tuples and dicts of values and arrays.
+
+    Args:
+        obj: The object.
+
+    Returns:
+        int: The size in bytes.
+    """
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) if obj.base is None else obj.nbytes
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(object_bytes(k) + object_bytes(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(object_bytes(v) for v in obj)
+    return size
+
+
+def format_bytes(size: float | None) -> str:
+    if size is None:
+        return "n/a"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return f"{size:,.1f} {unit}"
+
+
+class _Phase:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer: "PhaseTimer", name: str) -> None:
+        self.timer = timer
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        self.timer.totals[self.name] += time.perf_counter() - self.start
+        self.timer.counts[self.name] += 1
+
+
+class PhaseTimer:
+    """Accumulates the (monotonic) wall-clock time spent in each phase of a loop.
+
+    Use `with timer.phase("name"):` around each phase. When disabled, `phase` returns a
+    shared no-op context manager, so the instrumentation costs about one method call.
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.totals: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+        self.phases: dict[str, _Phase] = {}
+        self.steps = 0
+        self.start = time.perf_counter()
+
+    def phase(self, name: str) -> _Phase | nullcontext:
+        if not self.enabled:
+            return _NO_PHASE
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = _Phase(self, name)
+            self.totals[name] = 0.0
+            self.counts[name] = 0
+        return phase
+
+    def summary(self) -> dict:
+        """Get the total time, number of calls and share of the wall time of each phase.
+
+        Returns:
+            dict: The timing summary.
+        """
+        wall = time.perf_counter() - self.start
+        phases = {
+            name: {
+                "seconds": total,
+                "calls": self.counts[name],
+                "fraction": total / wall,
+            }
+            for name, total in self.totals.items()
+        }
+        other = wall - sum(self.totals.values())
+        phases["other"] = {"seconds": other, "calls": 0, "fraction": other / wall}
+        return {
+            "wall_seconds": wall,
+            "steps": self.steps,
+            "steps_per_second": self.steps / wall,
+            "phases": phases,
+        }
+
+    def describe(self) -> str:
+        """Get a short description of the throughput and phase breakdown (for tqdm)."""
+        wall = time.perf_counter() - self.start
+        phases = " ".join(
+            f"{name} {total / wall:.0%}" for name, total in self.totals.items()
+        )
+        return f"{self.steps / wall:,.0f} steps/s | {phases}"
+
+
+_NO_PHASE = nullcontext()
+
+
+class EpisodeProfiler:
+    """Profiles a window of episodes with cProfile or torch.profiler.
+
+    Call `start_episode(i)` and `end_episode(i)` around every episode. The profile of
+    the window is written to `{path}.prof` (cProfile, open with pstats or snakeviz) or
+    `{path}.json` (torch.profiler Chrome trace, open in chrome://tracing or Perfetto).
+    """
+
+    def __init__(self, kind: str, path: str, start: int = 0, episodes: int = 1) -> None:
+        assert kind in ["cprofile", "torch"], f"Invalid profiler {kind}"
+        self.kind = kind
+        self.path = path
+        self.start = start
+        self.end = start + episodes - 1
+        self.profiler: cProfile.Profile | torch.profiler.profile | None = None
+
+    def start_episode(self, episode: int) -> None:
+        if episode != self.start:
+            return
+        if self.kind == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities)
+            self.profiler.start()
+
+    def end_episode(self, episode: int) -> None:
+        if episode == self.end:
+            self.close()
+
+    def close(self) -> None:
+        """Stop profiling (if the window is still open) and write the profile."""
+        if self.profiler is None:
+            return
+        if isinstance(self.profiler, cProfile.Profile):
+            self.profiler.disable()
+            self.profiler.dump_stats(f"{self.path}.prof")
+        else:
+            self.profiler.stop()
+            self.profiler.export_chrome_trace(f"{self.path}.json")
+        self.profiler = None
+
 
 class ReplayMemory:
-    def __init__(self, env, min_size, max_size, obs_length, device, storage_devie):
+    def __init__(
+        self,
+        env,
+        min_size,
+        max_size,
+        obs_length,
+        device,
+        storage_devie,
+        thread_safe=False,
+        raw=False,
+    ):
         self.device = device
         self.storage_device = storage_devie
-        self.memory = torch.zeros((max_size, obs_length * 2 + 2)).to(
-            self.storage_device
-        )
+
+        # Raw mode stores the untransformed memory (counts) instead of the observed
+        # memory and no reward. The env encodes the memory according to its
+        # state_mode and recomputes the reward for the sampled rows only.
+        self.raw = raw
+        self.env = env
+        row_length = obs_length * 2 + 2
+        if raw:
+            self.state_length = len(env.state)
+            self.memory_length = len(env.memory)
+            row_length = 2 * (self.state_length + self.memory_length) + 1
+        if raw:
+            # Decoded on the CPU anyway, so the rows are kept in a NumPy array
+            self.memory = np.zeros((max_size, row_length), dtype=np.float32)
+        else:
+            self.memory = torch.zeros((max_size, row_length)).to(self.storage_device)
 
         self.num_states = obs_length
         self.min_size = min_size
         self.max_size = max_size
         self.memory_counter = 0
         self.full = False
+        # Guards insertion and sampling when actors and a learner share the buffer
+        self.lock = threading.Lock() if thread_safe else nullcontext()
         self._initialize(env)
 
+    @property
+    def nbytes(self) -> int:
+        if isinstance(self.memory, np.ndarray):
+            return self.memory.nbytes
+        return self.memory.element_size() * self.memory.nelement()
+
     # Run random policy for min_size steps to fill up the buffer
     def _initialize(self, env):
+        memory_key = "raw_memory" if self.raw else "memory"
         _, info = env.reset()
         state = info["state"]
-        memory = info["memory"]
+        memory = info[memory_key]
 
+        rng = getattr(env, "rng", None)
         for _ in range(self.min_size):
-            action = env.action_space.sample()
+            if rng is not None:
+                action = int(rng.integers(env.action_space.n))
+            else:
+                action = env.action_space.sample()
             _, reward, done, _, info = env.step(action)
             next_state = info["state"]
-            next_memory = info["memory"]
+            next_memory = info[memory_key]
             self.store_transition(
                 state, memory, action, reward, next_state, next_memory
             )
@@ -39,7 +252,7 @@ class ReplayMemory:
             if done:
                 _, info = env.reset()
                 state = info["state"]
-                memory = info["memory"]
+                memory = info[memory_key]
 
     def store_transition(
         self,
@@ -54,29 +267,44 @@ class ReplayMemory:
 
         Args:
             state (NDArray): The current state.
-            memory (NDArray): The current memory.
+            memory (NDArray): The current memory (raw in raw mode).
             action (int): The action taken.
-            reward (float): The reward received.
+            reward (float): The reward received (ignored in raw mode).
             next_state (NDArray): The next state.
-            next_memory (NDArray): The next memory.
+            next_memory (NDArray): The next memory (raw in raw mode).
         """
 
-        transition = np.hstack(
-            (state, memory, [action, reward], next_state, next_memory)
-        )
-        transition_t = torch.as_tensor(transition).to(
-            self.storage_device, non_blocking=True
-        )
-        index = self.memory_counter % self.max_size
-        self.memory[index, :] = transition_t
-        self.memory_counter += 1
-        self.full = self.memory_counter >= self.max_size
-
-    # Sample batch_size random transitions from the buffer
-    def sample(self, batch_size):
-        size = self.max_size if self.full else self.memory_counter
-        sample_index = np.random.choice(size, batch_size)
-        batch_memory = self.memory[sample_index, :].to(self.device)
+        if self.raw:
+            transition = np.hstack((state, memory, [action], next_state, next_memory))
+        else:
+            transition = np.hstack(
+                (state, memory, [action, reward], next_state, next_memory)
+            )
+            transition = torch.as_tensor(transition).to(
+                self.storage_device, non_blocking=True
+            )
+        with self.lock:
+            index = self.memory_counter % self.max_size
+            self.memory[index, :] = transition
+            self.memory_counter += 1
+            self.full = self.memory_counter >= self.max_size
+
+    # Sample batch_size random transitions from the buffer (optionally into a
+    # preallocated tensor on the storage device, not used in raw mode)
+    def sample(self, batch_size, out=None):
+        with self.lock:
+            size = self.max_size if self.full else self.memory_counter
+            sample_index = np.random.choice(size, batch_size)
+            if self.raw:
+                batch_memory = self.memory[sample_index, :]
+            elif out is None:
+                batch_memory = self.memory[sample_index, :].to(self.device)
+            else:
+                index_t = torch.from_numpy(sample_index).to(self.storage_device)
+                batch_memory = torch.index_select(self.memory, 0, index_t, out=out)
+        if self.raw:
+            return self._decode(batch_memory)
+
         batch_obs = batch_memory[:, : self.num_states]
         batch_action = batch_memory[:, self.num_states : self.num_states + 1].to(
             torch.long
@@ -85,3 +313,24 @@ class ReplayMemory:
         batch_next_obs = batch_memory[:, -self.num_states :]
 
         return batch_obs, batch_action, batch_reward, batch_next_obs
+
+    # Encode the raw memories and compute the rewards of a batch of raw rows
+    def _decode(self, batch_memory):
+        s, m = self.state_length, self.memory_length
+        state = batch_memory[:, :s]
+        memory = batch_memory[:, s : s + m]
+        action = batch_memory[:, s + m].astype(np.int64)
+        next_state = batch_memory[:, s + m + 1 : 2 * s + m + 1]
+        next_memory = batch_memory[:, 2 * s + m + 1 :]
+
+        encoded = self.env.encode_memories(np.concatenate([memory, next_memory]))
+        obs = np.concatenate([state, encoded[: len(state)]], axis=1)
+        next_obs = np.concatenate([next_state, encoded[len(state) :]], axis=1)
+        reward = self.env.get_rewards(state, action, next_memory)
+
+        return (
+            torch.from_numpy(obs).to(self.device),
+            torch.from_numpy(action[:, None]).to(self.device),
+            torch.from_numpy(reward[:, None]).to(self.device),
+            torch.from_numpy(next_obs).to(self.device),
+        )
@@ -0,0 +1,360 @@
+import random
+import multiprocessing
+import numpy as np
+import gymnasium
+from multiprocessing.connection import Connection
+from numpy.typing import NDArray
+from typing import Any, Callable, Sequence
+from gym import Env
+from stable_baselines3.common.vec_env.base_vec_env import (
+    VecEnv,
+    VecEnvIndices,
+    VecEnvObs,
+    VecEnvStepReturn,
+)
+
+
+def to_gymnasium(space: Any) -> gymnasium.Space:
+    """Convert a gym space to the equivalent gymnasium space (as SB3 expects).
+
+    Args:
+        space (Any): The gym (or gymnasium) space.
+
+    Returns:
+        gymnasium.Space: The gymnasium space.
+    """
+    if isinstance(space, gymnasium.Space):
+        return space
+    from shimmy.openai_gym_compatibility import _convert_space
+
+    return _convert_space(space)
+
+
+class SharedArray:
+    """A NumPy array in shared memory that can be passed to worker processes."""
+
+    def __init__(
+        self,
+        ctx: multiprocessing.context.BaseContext,
+        shape: tuple[int, ...],
+        dtype: Any,
+    ) -> None:
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * self.dtype.itemsize
+        self.raw = ctx.RawArray("b", max(size, 1))
+
+    def view(self) -> NDArray:
+        return np.frombuffer(
+            self.raw, dtype=self.dtype, count=int(np.prod(self.shape))
+        ).reshape(self.shape)
+
+
+def _worker(
+    remote: Connection,
+    parent_remote: Connection,
+    env_fn: Callable[[], Env],
+    index: int,
+    seed: int | None,
+    arrays: dict[str, SharedArray],
+    n_counterfactuals: int,
+    cf_kwargs: dict,
+) -> None:
+    parent_remote.close()
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    env = env_fn()
+    # Views of the row of this env (1-D arrays keep a length 1 slice to stay writable)
+    views = {}
+    for name, array in arrays.items():
+        view = array.view()
+        views[name] = view[index] if view.ndim > 1 else view[index : index + 1]
+    discrete = isinstance(to_gymnasium(env.action_space), gymnasium.spaces.Discrete)
+    state: NDArray | None = None
+
+    while True:
+        cmd, data = remote.recv()
+        if cmd == "step":
+            action = views["actions"].copy()
+            if discrete:
+                action = int(action[0])
+
+            # Store info for the counterfactual transitions
+            schedule_step = env.current_step
+            actual_state = env.state.copy()
+            actual_memory = env.memory.copy()
+
+            obs, reward, terminated, truncated, info = env.step(action)
+            count = 0
+            if n_counterfactuals > 0:
+                transitions = env.get_counterfactual_transitions(
+                    state,
+                    actual_state,
+                    action,
+                    actual_memory,
+                    schedule_step,
+                    n_counterfactuals,
+                    **cf_kwargs,
+                )
+                for (
+                    cf_state,
+                    cf_memory,
+                    _,
+                    cf_reward,
+                    cf_next_state,
+                    cf_next_memory,
+                ) in transitions:
+                    views["cf_obs"][count] = np.concatenate([cf_state, cf_memory])
+                    views["cf_next_obs"][count] = np.concatenate(
+                        [cf_next_state, cf_next_memory]
+                    )
+                    views["cf_rewards"][count] = cf_reward
+                    count += 1
+            views["cf_counts"][...] = count
+            state = info["state"]
+
+            views["rewards"][...] = reward
+            views["terminated"][...] = terminated
+            views["truncated"][...] = truncated
+            if terminated or truncated:
+                views["terminal_obs"][:] = obs
+                obs, info = env.reset()
+                state = info["state"]
+            views["obs"][:] = obs
+            remote.send(None)
+        elif cmd == "reset":
+            seed_i, options = data
+            obs, info = env.reset(seed=seed_i, options=options)
+            state = info["state"]
+            views["obs"][:] = obs
+            remote.send(None)
+        elif cmd == "get_attr":
+            try:
+                remote.send(getattr(env, data))
+            except AttributeError as e:
+                remote.send(e)
+        elif cmd == "set_attr":
+            remote.send(setattr(env, data[0], data[1]))
+        elif cmd == "env_method":
+            name, args, kwargs = data
+            remote.send(getattr(env, name)(*args, **kwargs))
+        elif cmd == "close":
+            env.close()
+            remote.close()
+            break
+        else:
+            raise NotImplementedError(f"Unknown command {cmd!r}")
+
+
+class SharedMemoryVecEnv(VecEnv):
+    """An SB3 `VecEnv` that runs each env in a worker process.
+
+    Observations, actions, rewards and termination flags are exchanged through arrays
+    in shared memory, so the pipes only carry the (unpickled) commands. Finished envs
+    are reset automatically (the last observation is in the "terminal_observation"
+    info, the env info dictionaries are not forwarded).
+
+    With `n_counterfactuals > 0` each worker also generates the counterfactual
+    transitions of its step (see `counterfactuals`), so the counterfactual
+    generation runs in parallel with the env steps.
+    """
+
+    def __init__(
+        self,
+        env_fns: Sequence[Callable[[], Env]],
+        seed: int | None = None,
+        n_counterfactuals: int = 0,
+        cf_kwargs: dict | None = None,
+        start_method: str = "spawn",
+    ) -> None:
+        """Start the workers.
+
+        Args:
+            env_fns (Sequence[Callable[[], Env]]): Picklable functions creating the envs.
+            seed (int | None, optional): Seed of the `random` and `np.random` modules of the workers (plus the env index). Defaults to None.
+            n_counterfactuals (int, optional): Number of counterfactual transitions to generate per step and env. Defaults to 0.
+            cf_kwargs (dict | None, optional): Keyword arguments of `get_counterfactual_transitions`. Defaults to None.
+            start_method (str, optional): Start method of the worker processes. Defaults to "spawn".
+        """
+        n_envs = len(env_fns)
+        probe = env_fns[0]()
+        observation_space = to_gymnasium(probe.observation_space)
+        action_space = to_gymnasium(probe.action_space)
+        obs, _ = probe.reset()
+        if observation_space.shape != np.shape(obs):
+            # Donut and lending give the observation size as a Discrete space
+            observation_space = gymnasium.spaces.Box(
+                -np.inf, np.inf, np.shape(obs), dtype=np.float32
+            )
+        probe.close()
+
+        ctx = multiprocessing.get_context(start_method)
+        obs_shape = observation_space.shape
+        self.n_counterfactuals = n_counterfactuals
+        self.arrays = {
+            "obs": SharedArray(ctx, (n_envs, *obs_shape), observation_space.dtype),
+            "terminal_obs": SharedArray(
+                ctx, (n_envs, *obs_shape), observation_space.dtype
+            ),
+            "actions": SharedArray(
+                ctx, (n_envs, *action_space.shape), action_space.dtype
+            ),
+            "rewards": SharedArray(ctx, (n_envs,), np.float32),
+            "terminated": SharedArray(ctx, (n_envs,), np.bool_),
+            "truncated": SharedArray(ctx, (n_envs,), np.bool_),
+            "cf_obs": SharedArray(
+                ctx, (n_envs, n_counterfactuals, *obs_shape), np.float32
+            ),
+            "cf_next_obs": SharedArray(
+                ctx, (n_envs, n_counterfactuals, *obs_shape), np.float32
+            ),
+            "cf_rewards": SharedArray(ctx, (n_envs, n_counterfactuals), np.float32),
+            "cf_counts": SharedArray(ctx, (n_envs,), np.int64),
+        }
+        self.views = {name: array.view() for name, array in self.arrays.items()}
+
+        self.waiting = False
+        self.closed = False
+        self.remotes, work_remotes = zip(*[ctx.Pipe() for _ in range(n_envs)])
+        self.processes = []
+        for index, (work_remote, remote, env_fn) in enumerate(
+            zip(work_remotes, self.remotes, env_fns)
+        ):
+            args = (
+                work_remote,
+                remote,
+                env_fn,
+                index,
+                None if seed is None else seed + index,
+                self.arrays,
+                n_counterfactuals,
+                cf_kwargs or {},
+            )
+            # daemon=True: the workers do not outlive a crashed main process
+            process = ctx.Process(target=_worker, args=args, daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+        super().__init__(n_envs, observation_space, action_space)
+
+    def reset(self) -> VecEnvObs:
+        for remote, seed, options in zip(self.remotes, self._seeds, self._options):
+            remote.send(("reset", (seed, options)))
+        for remote in self.remotes:
+            remote.recv()
+        self.reset_infos = [{} for _ in range(self.num_envs)]
+        self._reset_seeds()
+        self._reset_options()
+        return self.views["obs"].copy()
+
+    def step_async(self, actions: NDArray) -> None:
+        self.views["actions"][:] = np.asarray(actions).reshape(
+            self.views["actions"].shape
+        )
+        for remote in self.remotes:
+            remote.send(("step", None))
+        self.waiting = True
+
+    def step_wait(self) -> VecEnvStepReturn:
+        for remote in self.remotes:
+            remote.recv()
+        self.waiting = False
+        terminated = self.views["terminated"]
+        truncated = self.views["truncated"]
+        dones = terminated | truncated
+        infos: list[dict] = [{} for _ in range(self.num_envs)]
+        for i in np.flatnonzero(dones):
+            infos[i]["terminal_observation"] = self.views["terminal_obs"][i].copy()
+            infos[i]["TimeLimit.truncated"] = bool(truncated[i] and not terminated[i])
+        return (
+            self.views["obs"].copy(),
+            self.views["rewards"].copy(),
+            dones,
+            infos,
+        )
+
+    def next_observations(self, dones: NDArray) -> NDArray:
+        """Get the next observations of the last step (before the automatic resets).
+
+        Args:
+            dones (NDArray): The done flags returned by the last step.
+
+        Returns:
+            NDArray: The next observation of each env.
+        """
+        return np.where(
+            dones.reshape(-1, *[1] * (self.views["obs"].ndim - 1)),
+            self.views["terminal_obs"],
+            self.views["obs"],
+        )
+
+    def counterfactuals(
+        self, actions: NDArray
+    ) -> tuple[NDArray, NDArray, NDArray, NDArray]:
+        """Get the counterfactual transitions generated by the workers in the last step.
+
+        Args:
+            actions (NDArray): The actions of the last step.
+
+        Returns:
+            tuple[NDArray, NDArray, NDArray, NDArray]: The observations, actions, rewards and next observations.
+        """
+        counts = self.views["cf_counts"]
+        valid = np.arange(self.n_counterfactuals) < counts[:, None]
+        return (
+            self.views["cf_obs"][valid],
+            np.repeat(np.asarray(actions), counts, axis=0),
+            self.views["cf_rewards"][valid],
+            self.views["cf_next_obs"][valid],
+        )
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+    def get_attr(self, attr_name: str, indices: VecEnvIndices = None) -> list[Any]:
+        remotes = [self.remotes[i] for i in self._get_indices(indices)]
+        for remote in remotes:
+            remote.send(("get_attr", attr_name))
+        values = [remote.recv() for remote in remotes]
+        for value in values:
+            if isinstance(value, AttributeError):
+                raise value
+        return values
+
+    def set_attr(
+        self, attr_name: str, value: Any, indices: VecEnvIndices = None
+    ) -> None:
+        remotes = [self.remotes[i] for i in self._get_indices(indices)]
+        for remote in remotes:
+            remote.send(("set_attr", (attr_name, value)))
+        for remote in remotes:
+            remote.recv()
+
+    def env_method(
+        self,
+        method_name: str,
+        *method_args,
+        indices: VecEnvIndices = None,
+        **method_kwargs,
+    ) -> list[Any]:
+        remotes = [self.remotes[i] for i in self._get_indices(indices)]
+        for remote in remotes:
+            remote.send(("env_method", (method_name, method_args, method_kwargs)))
+        return [remote.recv() for remote in remotes]
+
+    def env_is_wrapped(
+        self, wrapper_class: type, indices: VecEnvIndices = None
+    ) -> list[bool]:
+        # The envs are never wrapped
+        return [False for _ in self._get_indices(indices)]
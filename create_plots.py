@@ -4,97 +4,159 @@ import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 import argparse
+import hashlib
 import pickle
 
 matplotlib.use("Agg")
 
 
-def plot_data(env, ax, smooth, root, data_type="reward", std=True):
+CACHE_FILE = ".stats_cache.pkl"
+
+
+class RunningStats:
+    """Welford's streaming mean and (population) standard deviation over experiments."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        self.n += 1
+        if self.mean is None:
+            self.mean = np.zeros_like(x, dtype=np.float64)
+            self.m2 = np.zeros_like(x, dtype=np.float64)
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.n)
+
+
+def smooth_series(data, smooth):
+    """Average windows of `smooth` values along the last axis (the last one may be shorter)."""
+    length = data.shape[-1]
+    starts = np.arange(0, length, smooth)
+    counts = np.diff(np.append(starts, length))
+    return np.add.reduceat(data, starts, axis=-1) / counts
+
+
+def read_experiments(path):
+    """Yield the results of each experiment (seed) in a result file, one at a time."""
+    if path.endswith(".csv"):
+        # One row per experiment, so only one row is in memory at a time
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield np.array(line.split(","), dtype=np.float64)
+        return
+
+    data = pickle.load(open(path, "rb"))
+    if data.ndim == 1 or (data.ndim == 2 and path.endswith("utility_vaccines.pkl")):
+        data = data[None]
+    for exp in data:
+        # Utility per region: (episodes, regions) -> (regions, episodes)
+        yield exp.T if exp.ndim == 2 else exp
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_cache(root):
+    try:
+        with open(os.path.join(root, CACHE_FILE), "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
+
+
+def save_cache(root, cache):
+    path = os.path.join(root, CACHE_FILE)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(cache, f)
+    os.replace(path + ".tmp", path)
+
+
+def get_stats(root, filename, smooth, cache):
+    """Get the smoothed mean and std over experiments of a result file.
+
+    The statistics are cached per file and smoothing window, and recomputed when the
+    modification time (or size) of the file changed and its content hash too.
+
+    Returns:
+        tuple: Mean, std (over experiments) and number of values before smoothing.
+    """
+    path = os.path.join(root, filename)
+    stat = os.stat(path)
+    key = (filename, smooth)
+    entry = cache.get(key)
+    if entry is not None and (entry["mtime"], entry["size"]) == (
+        stat.st_mtime_ns,
+        stat.st_size,
+    ):
+        return entry["mean"], entry["std"], entry["length"]
+
+    digest = file_hash(path)
+    if entry is None or entry["hash"] != digest:
+        stats = RunningStats()
+        length = 0
+        for exp in read_experiments(path):
+            length = exp.shape[-1]
+            stats.update(smooth_series(exp, smooth))
+        entry = {"hash": digest, "mean": stats.mean, "std": stats.std}
+        entry["length"] = length
+    entry.update(mtime=stat.st_mtime_ns, size=stat.st_size)
+    cache[key] = entry
+    return entry["mean"], entry["std"], entry["length"]
+
+
+def plot_data(env, ax, smooth, root, data_type="reward", std=True, cache=True):
+    stats_cache = load_cache(root) if cache else {}
+    versions = {key: (e["mtime"], e["size"]) for key, e in stats_cache.items()}
+
     for filename in sorted(os.listdir(f"{root}/")):
-        if filename.endswith(f"{data_type}.csv"):
-            data = np.genfromtxt(f"{root}/" + filename, delimiter=",")
+        if filename.endswith(f"{data_type}.csv") or (
+            filename.endswith(f"{data_type}.pkl") and data_type != "utility_vaccines"
+        ):
             name = filename.split(".")[0].split("_")[0]
-            # Smooth data
-            if data.ndim == 1:
-                data = data.reshape(1, -1)
-            exps, vals = data.shape
-            data = (
-                data.reshape(exps, -1, smooth).mean(axis=2, keepdims=True)
-                # .repeat(smooth, axis=2)
-                .reshape(exps, -1)
-            )
+            mean, dev, vals = get_stats(root, filename, smooth, stats_cache)
             # Plot
             xx = np.arange(0, vals, smooth)
-            ax.plot(xx, data.mean(axis=0), label=name, linewidth=2)
+            ax.plot(xx, mean, label=name, linewidth=2)
             if std:
-                ax.fill_between(
-                    xx,
-                    data.mean(axis=0) - data.std(axis=0),
-                    data.mean(axis=0) + data.std(axis=0),
-                    alpha=0.2,
-                )
+                ax.fill_between(xx, mean - dev, mean + dev, alpha=0.2)
         elif data_type == "utility_vaccines" and filename.endswith(
             f"utility_vaccines.pkl"
         ):
-            data = pickle.load(open(f"{root}/" + filename, "rb"))
             name = filename.split(".")[0].split("_")[0]
             if name != "Full":
                 continue
-            # Smooth data
-            if data.ndim == 2:
-                data = data.reshape(1, data.shape[0], data.shape[1])
-            exps, eps, regions = data.shape
-            data = data.transpose(2, 0, 1)
+            mean, dev, eps = get_stats(root, filename, smooth, stats_cache)
             # Plot
-            for i in range(regions):
-                data_i = (
-                    data[i]
-                    .reshape(exps, -1, smooth)
-                    .mean(axis=2, keepdims=True)
-                    # .repeat(smooth, axis=2)
-                    .reshape(exps, -1)
-                )
+            for i in range(len(mean)):
                 xx = np.arange(0, eps, smooth)
-                ax.plot(xx, data_i.mean(axis=0), label="Region " + str(i))
+                ax.plot(xx, mean[i], label="Region " + str(i))
                 ax.axhline(0, color="black", linestyle=(0, (5, 5)), linewidth=0.8)
                 if std:
-                    ax.fill_between(
-                        xx,
-                        data_i.mean(axis=0) - data_i.std(axis=0),
-                        data_i.mean(axis=0) + data_i.std(axis=0),
-                        alpha=0.2,
-                    )
-        elif filename.endswith(f"{data_type}.pkl"):
-            data = pickle.load(open(f"{root}/" + filename, "rb"))
-            name = filename.split(".")[0].split("_")[0]
-            # Smooth data
-            if data.ndim == 1:
-                data = data.reshape(1, -1)
-            exps, vals = data.shape
-            data = (
-                data.reshape(exps, -1, smooth).mean(axis=2, keepdims=True)
-                # .repeat(smooth, axis=2)
-                .reshape(exps, -1)
-            )
-            # Plot
-            xx = np.arange(0, vals, smooth)
-            ax.plot(xx, data.mean(axis=0), label=name, linewidth=2)
-            if std:
-                ax.fill_between(
-                    xx,
-                    data.mean(axis=0) - data.std(axis=0),
-                    data.mean(axis=0) + data.std(axis=0),
-                    alpha=0.2,
-                )
+                    ax.fill_between(xx, mean[i] - dev[i], mean[i] + dev[i], alpha=0.2)
         else:
             continue
 
+    if cache and versions != {
+        key: (e["mtime"], e["size"]) for key, e in stats_cache.items()
+    }:
+        save_cache(root, stats_cache)
+
 
-def create_plots(env, smooth, root, std=True, filename=None):
+def create_plots(env, smooth, root, std=True, filename=None, cache=True):
 
     if env == "lending":
         ax = plt.subplot(111)
-        plot_data(env, ax, smooth, root, std=std)
+        plot_data(env, ax, smooth, root, std=std, cache=cache)
         ax.legend()
         ax.set_xlabel("Number of Episodes")
         ax.set_ylabel("Accumulated Relaxed DP")
@@ -102,9 +164,19 @@ def create_plots(env, smooth, root, std=True, filename=None):
     elif env == "covid":
         # Comparing baselines
         _, axs = plt.subplots(1, 3, figsize=(12, 4), layout="tight")
-        plot_data(env, axs[0], smooth, root, data_type="reward", std=std)
-        plot_data(env, axs[1], smooth, root, data_type="new_infected", std=std)
-        plot_data(env, axs[2], smooth, root, data_type="utility_vaccines", std=std)
+        plot_data(env, axs[0], smooth, root, data_type="reward", std=std, cache=cache)
+        plot_data(
+            env, axs[1], smooth, root, data_type="new_infected", std=std, cache=cache
+        )
+        plot_data(
+            env,
+            axs[2],
+            smooth,
+            root,
+            data_type="utility_vaccines",
+            std=std,
+            cache=cache,
+        )
 
         for ax in axs:
             ax.legend()
@@ -118,8 +190,16 @@ def create_plots(env, smooth, root, std=True, filename=None):
 
     else:
         _, axs = plt.subplots(1, 2, figsize=(8, 4), layout="tight")
-        plot_data(env, axs[0], smooth, root, data_type="reward", std=std)
-        plot_data(env, axs[1], smooth, root, data_type="donuts_allocated", std=std)
+        plot_data(env, axs[0], smooth, root, data_type="reward", std=std, cache=cache)
+        plot_data(
+            env,
+            axs[1],
+            smooth,
+            root,
+            data_type="donuts_allocated",
+            std=std,
+            cache=cache,
+        )
 
         for ax in axs:
             ax.legend()
@@ -143,6 +223,9 @@ if __name__ == "__main__":
     prs.add_argument("--root", type=str, default="datasets")
     prs.add_argument("--std", type=lambda x: x.lower() == "true", default=True)
     prs.add_argument("--filename", type=str, default=None)
+    prs.add_argument("--cache", type=lambda x: x.lower() == "true", default=True)
     args = prs.parse_args()
 
-    create_plots(args.env, args.smooth, args.root, args.std, args.filename)
+    create_plots(
+        args.env, args.smooth, args.root, args.std, args.filename, cache=args.cache
+    )
@@ -4,6 +4,7 @@ import numpy as np
 from itertools import product
 from numpy.typing import ArrayLike, NDArray
 from core.aggregations import Aggregation, NSW
+from envs import kernels
 
 
 class CovidSEIREnv(gym.Env):
@@ -52,9 +53,13 @@ class CovidSEIREnv(gym.Env):
         novax: bool = False,
         continuous_actions: bool = False,
         aggregation: Aggregation | None = None,
+        jit: bool | None = None,
     ) -> None:
         super(CovidSEIREnv, self).__init__()
 
+        # Use the compiled kernels (by default when numba is installed)
+        self.jit = kernels.NUMBA_AVAILABLE if jit is None else jit
+
         # Set state mode
         self.state_mode = state_mode
 
@@ -215,6 +220,29 @@ class CovidSEIREnv(gym.Env):
 
         return state / np.sum(self.population) if self.normalize_obs else state
 
+    def get_utilities(
+        self, memory: NDArray, new_exposed: NDArray
+    ) -> tuple[NDArray, NDArray, NDArray]:
+        """Get the utility of each region (for one memory or a batch of memories).
+
+        Args:
+            memory (NDArray): The memory (or the memories, one row each).
+            new_exposed (NDArray): # of newly exposed people since last step (one row per memory for a batch).
+
+        Returns:
+            tuple[NDArray, NDArray, NDArray]: The utility, the exposure utility and the vaccination utility.
+        """
+        utility_exposed = -new_exposed / self.population.sum()
+        totals = memory.sum(axis=-1, keepdims=True)
+        utility_vaccines = np.where(
+            totals > 0,
+            memory / np.where(totals > 0, totals, 1)
+            - self.population / self.population.sum(),
+            0,
+        )
+        utility = utility_exposed + 0.04 * utility_vaccines
+        return utility, utility_exposed, utility_vaccines
+
     def get_reward(
         self, state: NDArray, memory: NDArray, new_exposed: NDArray, info: dict
     ) -> float:
@@ -231,13 +259,9 @@ class CovidSEIREnv(gym.Env):
         """
 
         # Utility
-        utility_exposed = -new_exposed / self.population.sum()
-        utility_vaccines = (
-            (memory / memory.sum()) - (self.population / self.population.sum())
-            if memory.sum() > 0
-            else np.zeros_like(memory)
+        utility, utility_exposed, utility_vaccines = self.get_utilities(
+            memory, new_exposed
         )
-        utility = utility_exposed + 0.04 * utility_vaccines
 
         # Save utilities
         info["utility_exposed"] = utility_exposed
@@ -248,32 +272,17 @@ class CovidSEIREnv(gym.Env):
 
         return reward
 
-    def get_transition(
-        self,
-        state: NDArray,
-        memory: NDArray,
-        action: int | NDArray,
-        schedule_step: int,
-    ) -> tuple[NDArray, NDArray, float, dict]:
-        """
-        Calculate a transition in the environment:
-          1. Allocate vaccines among k regions.
-          2. Move vaccinated individuals from S -> R (assuming perfect efficacy).
-          3. Apply SEIR updates in each region.
-          4. Compute reward, done, info.
+    def get_allocation(self, action: int | NDArray, schedule_step: int) -> NDArray:
+        """Get the number of vaccines allocated to each region.
 
         Args:
-            state (NDArray): Current state of the environment.
-            memory (NDArray): Current memory of the environment.
             action (int | NDArray): Index of the action in the allocation mapping (if discrete) or the continuous allocation vector.
             schedule_step (int): Current timestep in the vaccine schedule.
 
         Returns:
-            tuple[NDArray, NDArray, float, dict]: New state, new memory, reward, info dictionary.
+            NDArray: The (rounded) number of vaccines for each region.
         """
 
-        # -- 1. Distribute vaccines --
-
         # Map action index to allocation vector
         allocation: NDArray
         if self.continuous_actions:
@@ -299,71 +308,113 @@ class CovidSEIREnv(gym.Env):
             allocation * total_vaccines
         ).round()  # Scale allocation by available vaccines
 
+        return allocation
+
+    def get_transition(
+        self,
+        state: NDArray,
+        memory: NDArray,
+        action: int | NDArray,
+        schedule_step: int,
+    ) -> tuple[NDArray, NDArray, float, dict]:
+        """
+        Calculate a transition in the environment:
+          1. Allocate vaccines among k regions.
+          2. Move vaccinated individuals from S -> R (assuming perfect efficacy).
+          3. Apply SEIR updates in each region.
+          4. Compute reward, done, info.
+
+        Args:
+            state (NDArray): Current state of the environment.
+            memory (NDArray): Current memory of the environment.
+            action (int | NDArray): Index of the action in the allocation mapping (if discrete) or the continuous allocation vector.
+            schedule_step (int): Current timestep in the vaccine schedule.
+
+        Returns:
+            tuple[NDArray, NDArray, float, dict]: New state, new memory, reward, info dictionary.
+        """
+
+        # -- 1. Distribute vaccines --
+        allocation = self.get_allocation(action, schedule_step)
+
         # Current state is shape (4*k,)
         # We'll reshape it into (k,4) for clarity in calculations
         # region_state[i] = [S, E, I, R] for region i
         region_state = state[:-1].reshape((self.k, 4))
         susceptible = region_state[:, 1].copy()
 
-        # allocation = best_alloc * total_vaccines
-        used_vaccines = np.zeros(self.k, dtype=np.float32)
-        # -- 2. Vaccinate (move from S -> R) --
-        if not self.novax:
-            for i in range(self.k):
-                max_possible_vaccines = region_state[i, 0]  # S compartment
-                used_vaccines[i] = min(allocation[i], max_possible_vaccines)
-
-                # Move from S -> R
-                region_state[i, 0] -= used_vaccines[i]  # S
-                region_state[i, 3] += used_vaccines[i]  # R
-
-                # Clip to ensure no numeric drift
-                region_state[i, 0] = np.clip(
-                    region_state[i, 0], 0.0, self.population[i]
-                )
-                region_state[i, 3] = np.clip(
-                    region_state[i, 3], 0.0, self.population[i]
+        if self.jit:
+            region_state, used_vaccines, new_infected, newly_exposed = (
+                kernels.covid_transition(
+                    region_state,
+                    allocation,
+                    self.population,
+                    self.beta,
+                    self.sigma,
+                    self.gamma,
+                    self.novax,
                 )
+            )
+        else:
+            # allocation = best_alloc * total_vaccines
+            used_vaccines = np.zeros(self.k, dtype=np.float32)
+            # -- 2. Vaccinate (move from S -> R) --
+            if not self.novax:
+                for i in range(self.k):
+                    max_possible_vaccines = region_state[i, 0]  # S compartment
+                    used_vaccines[i] = min(allocation[i], max_possible_vaccines)
+
+                    # Move from S -> R
+                    region_state[i, 0] -= used_vaccines[i]  # S
+                    region_state[i, 3] += used_vaccines[i]  # R
+
+                    # Clip to ensure no numeric drift
+                    region_state[i, 0] = np.clip(
+                        region_state[i, 0], 0.0, self.population[i]
+                    )
+                    region_state[i, 3] = np.clip(
+                        region_state[i, 3], 0.0, self.population[i]
+                    )
 
-        # # -- 3. SEIR updates for each region --
-        # Basic compartmental update (Euler discrete approximation)
-        S_new = np.zeros(self.k, dtype=np.float32)
-        E_new = np.zeros(self.k, dtype=np.float32)
-        I_new = np.zeros(self.k, dtype=np.float32)
-        R_new = np.zeros(self.k, dtype=np.float32)
-        new_infected = np.zeros(self.k, dtype=np.float32)
-        newly_exposed = np.zeros(self.k, dtype=np.float32)
+            # # -- 3. SEIR updates for each region --
+            # Basic compartmental update (Euler discrete approximation)
+            S_new = np.zeros(self.k, dtype=np.float32)
+            E_new = np.zeros(self.k, dtype=np.float32)
+            I_new = np.zeros(self.k, dtype=np.float32)
+            R_new = np.zeros(self.k, dtype=np.float32)
+            new_infected = np.zeros(self.k, dtype=np.float32)
+            newly_exposed = np.zeros(self.k, dtype=np.float32)
 
-        for i in range(self.k):
-            S_i, E_i, I_i, R_i = region_state[i]
-
-            beta_i = self.beta[i]
-            sigma_i = self.sigma[i]
-            gamma_i = self.gamma[i]
-            pop_i = self.population[i]
-
-            dS = -beta_i * S_i * I_i / pop_i
-            dE = beta_i * S_i * I_i / pop_i - sigma_i * E_i
-            dI = sigma_i * E_i - gamma_i * I_i
-            dR = gamma_i * I_i
-
-            # Update
-            S_new[i] = S_i + dS
-            E_new[i] = E_i + dE
-            I_new[i] = I_i + dI
-            R_new[i] = R_i + dR
-            new_infected[i] = sigma_i * E_i
-            newly_exposed[i] = beta_i * S_i * I_i / pop_i
-
-        # Ensure fractions stay in [0, population]
-        S_new = np.clip(S_new, 0.0, self.population)
-        E_new = np.clip(E_new, 0.0, self.population)
-        I_new = np.clip(I_new, 0.0, self.population)
-        R_new = np.clip(R_new, 0.0, self.population)
-        susceptible = E_new - susceptible
-
-        # Recombine
-        region_state = np.stack([S_new, E_new, I_new, R_new], axis=1)
+            for i in range(self.k):
+                S_i, E_i, I_i, R_i = region_state[i]
+
+                beta_i = self.beta[i]
+                sigma_i = self.sigma[i]
+                gamma_i = self.gamma[i]
+                pop_i = self.population[i]
+
+                dS = -beta_i * S_i * I_i / pop_i
+                dE = beta_i * S_i * I_i / pop_i - sigma_i * E_i
+                dI = sigma_i * E_i - gamma_i * I_i
+                dR = gamma_i * I_i
+
+                # Update
+                S_new[i] = S_i + dS
+                E_new[i] = E_i + dE
+                I_new[i] = I_i + dI
+                R_new[i] = R_i + dR
+                new_infected[i] = sigma_i * E_i
+                newly_exposed[i] = beta_i * S_i * I_i / pop_i
+
+            # Ensure fractions stay in [0, population]
+            S_new = np.clip(S_new, 0.0, self.population)
+            E_new = np.clip(E_new, 0.0, self.population)
+            I_new = np.clip(I_new, 0.0, self.population)
+            R_new = np.clip(R_new, 0.0, self.population)
+            susceptible = E_new - susceptible
+
+            # Recombine
+            region_state = np.stack([S_new, E_new, I_new, R_new], axis=1)
         region_state_flat = region_state.flatten()
         vaccines = (
             0
@@ -412,6 +463,18 @@ class CovidSEIREnv(gym.Env):
         Returns:
             list[tuple[NDArray, NDArray, int, float, NDArray, NDArray]]: The generated counterfactual transitions, a list of (state, memory, action, reward, new_state, new_memory) tuples.
         """
+        if self.jit:
+            return self._batch_counterfactual_transitions(
+                state,
+                actual_state,
+                action,
+                actual_memory,
+                schedule_step,
+                n_counterfactuals,
+                distribution,
+                magnitude,
+            )
+
         transitions = []
         if not schedule_step == self.max_steps - 1:
             for _ in range(n_counterfactuals):
@@ -452,6 +515,71 @@ class CovidSEIREnv(gym.Env):
 
         return transitions
 
+    def _batch_counterfactual_transitions(
+        self,
+        state: NDArray,
+        actual_state: NDArray,
+        action: int | NDArray,
+        actual_memory: NDArray,
+        schedule_step: int,
+        n_counterfactuals: int,
+        distribution: str,
+        magnitude: float,
+    ) -> list[tuple[NDArray, NDArray, int, float, NDArray, NDArray]]:
+        # All counterfactual transitions at once with the compiled kernel (same
+        # memories and results as calling get_transition for each memory)
+        if schedule_step == self.max_steps - 1:
+            return []
+        assert distribution in ["normal", "uniform"], "Invalid distribution type"
+        cf_memories = []
+        for _ in range(n_counterfactuals):
+            if distribution == "normal":
+                cf_memory = np.random.normal(actual_memory, magnitude)
+            else:
+                cf_memory = np.random.uniform(
+                    actual_memory - magnitude, actual_memory + magnitude
+                )
+            cf_memories.append(cf_memory.round().astype(np.float32))
+        cf_memories = np.clip(np.array(cf_memories), a_min=0, a_max=None)
+
+        allocation = self.get_allocation(action, schedule_step)
+        region_states, used_vaccines, _, newly_exposed = (
+            kernels.covid_counterfactual_transitions(
+                actual_state[:-1].reshape((self.k, 4)),
+                allocation,
+                self.population,
+                self.beta,
+                self.sigma,
+                self.gamma,
+                self.novax,
+                n_counterfactuals,
+            )
+        )
+        vaccines = self.vaccine_schedule[schedule_step + 1]
+        new_states = np.concatenate(
+            [
+                region_states.reshape(n_counterfactuals, -1),
+                np.tile(np.asarray([vaccines]), (n_counterfactuals, 1)),
+            ],
+            axis=1,
+        )
+        new_memories = cf_memories + used_vaccines
+
+        utility, _, _ = self.get_utilities(new_memories, newly_exposed)
+        rewards = self.aggregation.forward_batch(utility)
+
+        return [
+            (
+                state,
+                self.get_transformed_memory(cf_memories[i]),
+                action,
+                rewards[i],
+                self.normalize_state(new_states[i]),
+                self.get_transformed_memory(new_memories[i]),
+            )
+            for i in range(n_counterfactuals)
+        ]
+
     def step(self, action: int | NDArray) -> tuple[NDArray, float, bool, bool, dict]:
         """
         Take one step in the environment.
@@ -3,8 +3,9 @@ import random
 import numpy as np
 from numpy.typing import NDArray
 from gym.spaces import Discrete, MultiBinary
-from itertools import product
 from core.aggregations import Aggregation, NSW
+from core.cache import EncodingCache
+from envs import kernels
 
 
 class Donut(gym.Env):
@@ -19,26 +20,68 @@ class Donut(gym.Env):
         distribution: str | None = None,
         binarize_memory: bool = True,
         dynamic_prob: bool = False,
+        incremental_reward: bool = False,
+        own_rng: bool = False,
+        predraw: bool = False,
+        jit: bool | None = None,
+        memory_cache_size: int = 4096,
+        memory_encoding: str = "binary",
+        n_quantiles: int = 5,
+        sparse_arrivals: bool = False,
     ) -> None:
         # full: number of donuts for each person so far as a list [d1, d2, ...]
         # compact: full but as one number
         # binary: binary state of full
         # reset: number of donuts for person i - min number of donuts
 
+        # Memory encodings (compact ones for many people):
+        # binary: bits of each count -> people * ceil(log2(episode_length + 1)) values
+        # counts: counts / episode_length -> people values
+        # quantiles: quantiles of counts / episode_length -> n_quantiles values
+        assert memory_encoding in ["binary", "counts", "quantiles"]
+        self.memory_encoding = memory_encoding
+        self.quantiles = np.linspace(0, 1, n_quantiles)
+
+        # Draw the indices of the present customers with vectorized sampling (see
+        # draw_arrivals) instead of a uniform number per person. Only the sampling
+        # changes: the state (and so the observations and replay) stays dense, the
+        # indices are only returned in info["present"]
+        self.sparse_arrivals = sparse_arrivals
+
         self.people = people
         self.episode_length = episode_length
         self.state_mode = state_mode
         self.aggregation = aggregation if aggregation is not None else NSW()
+        # Update the welfare of the own memory with the change of each step
+        self.incremental = (
+            self.aggregation.incremental(episode_length) if incremental_reward else None
+        )
         self.distribution = distribution
         self.d_param1 = [50, 50, 50, 75, 25]
         self.d_param2 = [0.9, -0.9, 0.1, 0.6, 0.5]
+        assert (
+            distribution is None or people <= 5
+        ), "The distributions are only defined for up to 5 people"
         self.current_step = 0
 
+        # Draw the arrivals from an own generator instead of the global random module
+        # (and optionally draw the arrivals of a whole episode at reset)
+        assert own_rng or not predraw, "Pre-drawing the arrivals requires own_rng"
+        self.rng = np.random.default_rng(seed) if own_rng else None
+        self.predraw = predraw
+        self.arrivals: NDArray | None = None
+
+        # Use the compiled kernels (by default when numba is installed)
+        self.jit = kernels.NUMBA_AVAILABLE if jit is None else jit
+
+        # LRU cache of the transformed counterfactual memories
+        self.memory_cache = EncodingCache(memory_cache_size)
+
         self.dynamic_prob = dynamic_prob
         if self.dynamic_prob:
             print("Dynamic probability is enabled.")
-        self.prob_tracker = {}
-        self.initial_prob = {}
+        # Steps since the probability of each person was raised (-1 if it is not)
+        self.prob_tracker = np.full(people, -1, dtype=np.int64)
 
         # Action space: Discrete choice between customers
         self.action_space = Discrete(self.people, seed=seed)
@@ -49,6 +92,10 @@ class Donut(gym.Env):
         memory_size = people
         if binarize_memory:
             memory_size = self.people * int(np.ceil(np.log2(self.episode_length + 1)))
+        if memory_encoding == "counts":
+            memory_size = people
+        elif memory_encoding == "quantiles":
+            memory_size = n_quantiles
         if state_mode == "none":
             memory_size = 0
         self.observation_space = Discrete(people + memory_size, seed=seed)
@@ -60,11 +107,19 @@ class Donut(gym.Env):
         # Set customer probabilities
         if p is None:
             self.prob = [0.8 for _ in range(self.people)]
+        elif len(p) == 1:
+            # The same probability for everyone
+            self.prob = [p[0] for _ in range(self.people)]
         else:
             self.prob = p
+        self.prob = np.array(self.prob, dtype=np.float64)
+        self.initial_prob = self.prob.copy()
 
-        for i in range(self.people):
-            self.initial_prob[i] = self.prob[i]
+        # Binary representation of every possible count (for encode_memories)
+        bits = int(np.ceil(np.log2(self.episode_length)))
+        shifts = np.arange(bits - 1, -1, -1)
+        counts = np.arange(self.episode_length + 1)
+        self.bit_table = ((counts[:, None] >> shifts) & 1).astype(np.float32)
 
         # Set running values
         self.running_values = ["donuts_allocated"]
@@ -86,11 +141,105 @@ class Donut(gym.Env):
     def uniform_interval_prob(self, t, start, end):
         """Uniform probability function."""
 
-        if t >= start and t <= end:
-            prob = 1.0
-        else:
-            prob = 0.0
-        return prob
+        return np.where((t >= start) & (t <= end), 1.0, 0.0)
+
+    def update_prob(self, episode: int) -> None:
+        """Set the arrival probabilities of the distribution at a step.
+
+        Args:
+            episode (int): The step of the episode.
+        """
+        prob = self.distribution_prob(episode)
+        if prob is not None:
+            self.prob[:] = prob
+
+    def distribution_prob(self, episode: int) -> NDArray | None:
+        """Get the arrival probabilities of the distribution at a step.
+
+        The parameters are the middle point and steepness (logistic), the mean and
+        std (bell) or the start and end (uniform-interval) of each person.
+
+        Args:
+            episode (int): The step of the episode.
+
+        Returns:
+            NDArray | None: The arrival probabilities (None without a distribution).
+        """
+        if self.distribution is None:
+            return None
+        prob_fn = {
+            "logistic": self.logistic_prob,
+            "bell": self.bell_prob,
+            "uniform-interval": self.uniform_interval_prob,
+        }[self.distribution]
+        d_param1 = np.array(self.d_param1[: self.people], dtype=np.float64)
+        d_param2 = np.array(self.d_param2[: self.people], dtype=np.float64)
+        return prob_fn(episode, d_param1, d_param2)
+
+    def age_prob_tracker(self, prob: NDArray, tracker: NDArray) -> None:
+        """Advance the recovery timers and restore the probabilities after 2 steps (in place).
+
+        Args:
+            prob (NDArray): The arrival probabilities.
+            tracker (NDArray): The steps since the probability of each person was raised (-1 if it is not).
+        """
+        tracker[tracker >= 0] += 1
+        expired = tracker > 2
+        prob[expired] = self.initial_prob[expired]
+        tracker[expired] = -1
+
+    def draw_uniforms(self, step: int | None = None) -> NDArray:
+        """Draw a uniform number for the arrival of each person.
+
+        Args:
+            step (int | None, optional): The step of the episode of the env itself, to use the pre-drawn arrivals. Defaults to None.
+
+        Returns:
+            NDArray: The uniform numbers.
+        """
+        if self.rng is None:
+            return np.array([random.random() for _ in range(self.people)])
+        if step is not None and self.arrivals is not None:
+            return self.arrivals[step]
+        return self.rng.random(self.people)
+
+    def draw_arrivals(self, step: int | None = None) -> NDArray:
+        """Draw the indices of the customers that arrive.
+
+        When every person has the same probability, the number of arrivals is drawn
+        from a binomial and the arrivals are sampled without replacement, so rare
+        arrivals among many people do not need a uniform number per person.
+
+        Args:
+            step (int | None, optional): The step of the episode of the env itself, to use the pre-drawn arrivals. Defaults to None.
+
+        Returns:
+            NDArray: The sorted indices of the present customers.
+        """
+        if step is not None and self.arrivals is not None:
+            return np.flatnonzero(self.arrivals[step] <= self.prob)
+        rng = self.rng if self.rng is not None else np.random
+        if self.prob.min() == self.prob.max():
+            count = rng.binomial(self.people, self.prob[0])
+            return np.sort(rng.choice(self.people, count, replace=False))
+        return np.flatnonzero(rng.random(self.people) <= self.prob)
+
+    def encode_counts(self, memory: NDArray) -> NDArray:
+        """Compact encoding of memories (the last axis) as normalized counts or quantiles.
+
+        Args:
+            memory (NDArray): The memory or memories.
+
+        Returns:
+            NDArray: The encoded memory or memories.
+        """
+        counts = memory.astype(np.float32) / self.episode_length
+        if self.memory_encoding == "counts":
+            return counts
+        if counts.shape[-1] == 0:
+            return counts
+        quantiles = np.quantile(counts, self.quantiles, axis=-1)
+        return np.moveaxis(quantiles, 0, -1).astype(np.float32)
 
     def binarize_memory(self, memory: NDArray) -> NDArray:
         zero_fill = int(np.ceil(np.log2(self.episode_length)))
@@ -104,6 +253,44 @@ class Donut(gym.Env):
             int_ans.append(int(t))
         return np.array(int_ans, dtype=np.float32)
 
+    def encode_memories(self, memory: NDArray) -> NDArray:
+        """Vectorized `get_transformed_memory` for a batch of raw memories.
+
+        The memories are assumed to be already reset (reset mode only resets the memory
+        of the env itself).
+
+        Args:
+            memory (NDArray): The memories, one row each.
+
+        Returns:
+            NDArray: The transformed memories.
+        """
+        if self.state_mode == "none":
+            return np.zeros((len(memory), 0), dtype=np.float32)
+        memory = memory.astype(np.int64)
+        if self.state_mode == "min":
+            memory = memory - memory.min(axis=1, keepdims=True)
+        if self.memory_encoding != "binary":
+            return self.encode_counts(memory)
+        return self.bit_table[memory].reshape(len(memory), -1)
+
+    def get_rewards(
+        self, state: NDArray, action: NDArray, next_memory: NDArray
+    ) -> NDArray:
+        """Vectorized reward of `get_transition` for a batch of transitions.
+
+        Args:
+            state (NDArray): The customers at the counter, one row each.
+            action (NDArray): The actions taken.
+            next_memory (NDArray): The raw next memories, one row each.
+
+        Returns:
+            NDArray: The rewards.
+        """
+        served = state[np.arange(len(state)), action] == 1
+        rewards = self.aggregation.forward_batch(next_memory.astype(np.float32))
+        return np.where(served, rewards, 0).astype(np.float32)
+
     def get_transformed_memory(self, memory: NDArray | None = None) -> NDArray:
         """Transform memory based on state mode.
 
@@ -143,17 +330,33 @@ class Donut(gym.Env):
         #     memory /= memory.sum()
         #     assert memory is not None
 
-        if self.binarize_memory:
+        if self.memory_encoding != "binary":
+            memory = self.encode_counts(memory)
+        elif self.binarize_memory:
             memory = self.binarize_memory(memory)
 
         return memory
 
+    def get_cached_memory(self, memory: NDArray) -> NDArray:
+        """`get_transformed_memory` of a memory (not of the env) through the LRU cache.
+
+        Args:
+            memory (NDArray): The memory to transform.
+
+        Returns:
+            NDArray: The transformed memory (read-only).
+        """
+        return self.memory_cache.get(
+            memory, self.state_mode, self.get_transformed_memory
+        )
+
     def get_transition(
         self,
         state: NDArray,
         memory: NDArray,
         action: int | NDArray,
         episode: int,
+        track: bool = False,
     ) -> tuple[NDArray, NDArray, float, dict]:
         """Get a transition. Simulate the donut distribution and calculate the reward.
 
@@ -162,66 +365,86 @@ class Donut(gym.Env):
             memory (NDArray): The current memory.
             action (int | NDArray): The action taken.
             episode (int): The current episode.
+            track (bool, optional): Whether memory is the memory of the env, so the reward can be updated incrementally. Defaults to False.
 
         Returns:
             tuple[NDArray, NDArray, float, dict]: The next state, next memory, the reward, and the info dictionary.
         """
 
         # Simulate donut distribution
+        present = None
+        if self.jit and not self.sparse_arrivals:
+            # Compiled step (same random numbers and results)
+            uniforms = self.draw_uniforms(episode if track else None)
+            dist_prob = self.distribution_prob(episode)
+            new_state, new_memory, drop = kernels.donut_step(
+                state,
+                memory,
+                int(action),
+                uniforms,
+                self.prob,
+                self.initial_prob,
+                self.prob_tracker,
+                self.dynamic_prob,
+                self.prob if dist_prob is None else dist_prob,
+                dist_prob is not None,
+            )
+        else:
+            new_state, new_memory, drop, present = self._step_arrivals(
+                state, memory, action, episode, track
+            )
+
+        if drop:
+            reward = 0
+        elif track and self.incremental is not None:
+            self.incremental.update(action, 1)
+            reward = self.incremental.value()
+        else:
+            utilities = new_memory.copy()
+            reward = self.aggregation(utilities)
+
+        info = {}
+        info["donuts_allocated"] = 0 if drop else 1
+        if present is not None:
+            info["present"] = present
+
+        return new_state, new_memory, reward, info
+
+    def _step_arrivals(
+        self,
+        state: NDArray,
+        memory: NDArray,
+        action: int | NDArray,
+        episode: int,
+        track: bool,
+    ) -> tuple[NDArray, NDArray, bool, NDArray | None]:
+        # NumPy version of kernels.donut_step (and the sparse arrivals)
         drop = True
         new_memory = memory.copy()
         if state[action]:
             drop = False
             new_memory[action] += 1
 
-
             if self.dynamic_prob:
-                self.prob[action] = min(self.prob[action] + 0.1, 1.0) 
+                self.prob[action] = min(self.prob[action] + 0.1, 1.0)
                 self.prob_tracker[action] = 0  # Reset timer for recovery
 
-        # Update probability tracker (increment counters for all tracked people)
-        for i in list(self.prob_tracker.keys()):
-            self.prob_tracker[i] += 1  # Increment step counter
-
-            # If 2 steps have passed, restore probability to initial value
-            if self.prob_tracker[i] > 2:
-                self.prob[i] = self.initial_prob[i]  # Restore probability
-                del self.prob_tracker[i] 
+        # Update probability tracker (restore the probabilities raised 2 steps ago)
+        self.age_prob_tracker(self.prob, self.prob_tracker)
 
         # Get next state
         new_state = np.zeros_like(state)
-        for i in range(self.people):
-            p = random.random()
-            if self.distribution == "logistic":
-                self.prob[i] = self.logistic_prob(
-                    episode,
-                    self.d_param1[i],  # middle point
-                    self.d_param2[i],  # steepness
-                )
-            elif self.distribution == "bell":
-                self.prob[i] = self.bell_prob(
-                    episode,
-                    self.d_param1[i],  # mean
-                    self.d_param2[i],  # std
-                )
-            elif self.distribution == "uniform-interval":
-                self.prob[i] = self.uniform_interval_prob(
-                    episode,
-                    self.d_param1[i],  # start
-                    self.d_param2[i],  # end
-                )
-            if p <= self.prob[i]:
-                new_state[i] = 1
-            else:
-                new_state[i] = 0
-
-        utilities = new_memory.copy()
-        reward = 0 if drop else self.aggregation(utilities)
-
-        info = {}
-        info["donuts_allocated"] = 0 if drop else 1
+        present = None
+        if self.sparse_arrivals:
+            self.update_prob(episode)
+            present = self.draw_arrivals(episode if track else None)
+            new_state[present] = 1
+        else:
+            uniforms = self.draw_uniforms(episode if track else None)
+            self.update_prob(episode)
+            new_state[:] = uniforms <= self.prob
 
-        return new_state, new_memory, reward, info
+        return new_state, new_memory, drop, present
 
     def get_counterfactual_transitions(
         self,
@@ -231,43 +454,47 @@ class Donut(gym.Env):
         actual_memory: NDArray,
         schedule_step: int,
         n_counterfactuals: int,
+        raw: bool = False,
     ) -> list[tuple[NDArray, NDArray, int, float, NDArray, NDArray]]:
         
-        all_possible = []
         actual_memory = actual_memory.astype(np.int32)
 
-        for i in range(len(actual_memory)):
-            tmp = []
-            ed = min(self.episode_length, actual_memory[i] + 2)
-            for j in range(actual_memory[i] + 1, ed):
-                tmp.append(j)
-            all_possible.append(tmp)
-        possible_memories = list(product(*all_possible))
+        # The counterfactual counts of each person are between the actual count + 1
+        # and the episode length (excluded), and only the actual count + 1 fits, so
+        # the only counterfactual memory gives everyone one more donut
+        cf_memory = actual_memory + 1
+        possible_memories = []
+        if np.all(cf_memory < self.episode_length):
+            possible_memories.append(cf_memory)
 
         original_prob = self.prob.copy()
         original_tracker = self.prob_tracker.copy()
         
         transitions = []
         n_counterfactuals = min(n_counterfactuals, len(possible_memories))
+        if self.jit and not self.dynamic_prob and not self.sparse_arrivals:
+            return self._batch_counterfactual_transitions(
+                state,
+                actual_state,
+                action,
+                np.array(possible_memories[:n_counterfactuals], dtype=np.float32),
+                schedule_step,
+                raw,
+            )
+
         
         for i in range(n_counterfactuals):
             
-            cf_memory = np.array(list(possible_memories[i]), dtype=np.float32)
+            cf_memory = np.array(possible_memories[i], dtype=np.float32)
             
             if self.dynamic_prob:
-                temp_prob = original_prob.copy()  
+                temp_prob = original_prob.copy()
                 temp_tracker = original_tracker.copy()
 
-                for j in range(self.people):
-                    if cf_memory[j] > actual_memory[j]:  
-                        temp_prob[j] = min(temp_prob[j] + 0.1, 1.0)
-                        temp_tracker[j] = 0 
-                
-                for j in list(temp_tracker.keys()):
-                    temp_tracker[j] += 1
-                    if temp_tracker[j] > 2:
-                        temp_prob[j] = self.initial_prob[j]
-                        del temp_tracker[j]
+                raised = cf_memory > actual_memory
+                temp_prob[raised] = np.minimum(temp_prob[raised] + 0.1, 1.0)
+                temp_tracker[raised] = 0
+                self.age_prob_tracker(temp_prob, temp_tracker)
                 backup_prob = self.prob.copy()
                 self.prob = temp_prob.copy()
                 
@@ -279,8 +506,9 @@ class Donut(gym.Env):
             if self.dynamic_prob:
                 self.prob = backup_prob.copy()
 
-            cf_memory = self.get_transformed_memory(cf_memory)
-            new_memory = self.get_transformed_memory(new_memory)
+            if not raw:
+                cf_memory = self.get_cached_memory(cf_memory)
+                new_memory = self.get_cached_memory(new_memory)
 
             transitions.append(
                 (state, cf_memory, action, reward, new_state, new_memory)
@@ -291,23 +519,70 @@ class Donut(gym.Env):
 
         return transitions
 
+    def _batch_counterfactual_transitions(
+        self,
+        state: NDArray,
+        actual_state: NDArray,
+        action: int | NDArray,
+        cf_memories: NDArray,
+        schedule_step: int,
+        raw: bool,
+    ) -> list[tuple[NDArray, NDArray, int, float, NDArray, NDArray]]:
+        # All counterfactual transitions at once with the compiled kernel (same
+        # random numbers as calling get_transition for each memory)
+        n = len(cf_memories)
+        uniforms = np.array([self.draw_uniforms() for _ in range(n)]).reshape(
+            n, self.people
+        )
+        original_prob = self.prob.copy()
+        self.update_prob(schedule_step)
+        prob = self.prob
+        self.prob = original_prob
+
+        new_states, new_memories, served = kernels.donut_transitions(
+            actual_state, cf_memories, int(action), uniforms, prob
+        )
+        rewards = np.zeros(n)
+        if served.any():
+            rewards = self.aggregation.forward_batch(new_memories)
+        if not raw:
+            cf_memories = self.encode_memories(cf_memories)
+            new_memories = self.encode_memories(new_memories)
+
+        return [
+            (
+                state,
+                cf_memories[i],
+                action,
+                float(rewards[i]) if served[i] else 0,
+                new_states[i],
+                new_memories[i],
+            )
+            for i in range(n)
+        ]
+
     def step(self, action: int) -> tuple[NDArray, float, bool, bool, dict]:
         self.current_step += 1
         state = self.state
         memory = self.memory
 
         new_state, new_memory, reward, info = self.get_transition(
-            state, memory, action, self.current_step
+            state, memory, action, self.current_step, track=True
         )
 
         done = self.current_step >= self.episode_length
         self.state = new_state
         self.memory = new_memory
+        memory_before_reset = self.memory
 
         new_memory = self.get_transformed_memory()
+        if self.incremental is not None and self.memory is not memory_before_reset:
+            # The memory was reset
+            self.incremental.reset(self.memory)
         obs = np.concatenate((new_state, new_memory))
         info["state"] = new_state.copy()
         info["memory"] = new_memory.copy()
+        info["raw_memory"] = memory_before_reset.copy()
 
         return obs, reward, done, False, info
 
@@ -319,19 +594,30 @@ class Donut(gym.Env):
         self.state = np.zeros(self.people, dtype=np.float32)
         self.current_step = 0
 
-        for i in range(self.people):
-            p = random.random()
-            if p <= self.prob[i]:
-                self.state[i] = 1
-            else:
-                self.state[i] = 0
+        if seed is not None and self.rng is not None:
+            self.rng = np.random.default_rng(seed)
+        if self.predraw:
+            # Row 0 is used here, row t by step t
+            self.arrivals = self.rng.random((self.episode_length + 1, self.people))
+        present = None
+        if self.sparse_arrivals:
+            present = self.draw_arrivals(0)
+            self.state[present] = 1
+        else:
+            uniforms = self.draw_uniforms(0)
+            self.state[:] = uniforms <= self.prob
 
         memory = self.get_transformed_memory()
+        if self.incremental is not None:
+            self.incremental.reset(self.memory)
         obs = np.concatenate((self.state, memory))
         info = {
             "state": self.state.copy(),
             "memory": memory.copy(),
+            "raw_memory": self.memory.copy(),
             "donuts_allocated": 0,
         }
+        if present is not None:
+            info["present"] = present
 
         return obs, info
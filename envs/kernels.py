@@ -0,0 +1,262 @@
+"""Numba-compiled kernels of the env transitions (used when numba is installed).
+
+The kernels only cover the deterministic part of the transitions: the random numbers
+are drawn by the envs and passed in, so the compiled and the NumPy code paths draw the
+same numbers in the same order. Without numba the envs keep their NumPy code; the
+kernels can still be run as plain Python (e.g. to check them against the NumPy code).
+"""
+
+import numpy as np
+from numpy.typing import NDArray
+
+try:
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+except ImportError:  # pragma: no cover - depends on the environment
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        # Without numba the kernels are plain Python functions
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
+
+
+@njit(cache=True)
+def donut_transitions(
+    state: NDArray,
+    memories: NDArray,
+    action: int,
+    uniforms: NDArray,
+    prob: NDArray,
+) -> tuple[NDArray, NDArray, NDArray]:
+    """Donut transitions of a batch of memories from the same customers and action.
+
+    Args:
+        state (NDArray): The customers at the counter.
+        memories (NDArray): The memories, one row each.
+        action (int): The action taken.
+        uniforms (NDArray): The uniform numbers of the arrivals, one row per memory.
+        prob (NDArray): The arrival probability of each person.
+
+    Returns:
+        tuple[NDArray, NDArray, NDArray]: The next customers, the next memories and whether the donut was given.
+    """
+    n, people = memories.shape
+    new_states = np.zeros((n, people), dtype=np.float32)
+    new_memories = memories.copy()
+    served = np.zeros(n, dtype=np.bool_)
+    for i in range(n):
+        if state[action] != 0:
+            served[i] = True
+            new_memories[i, action] += 1
+        for j in range(people):
+            if uniforms[i, j] <= prob[j]:
+                new_states[i, j] = 1
+    return new_states, new_memories, served
+
+
+@njit(cache=True)
+def donut_step(
+    state: NDArray,
+    memory: NDArray,
+    action: int,
+    uniforms: NDArray,
+    prob: NDArray,
+    initial_prob: NDArray,
+    tracker: NDArray,
+    dynamic: bool,
+    dist_prob: NDArray,
+    has_distribution: bool,
+) -> tuple[NDArray, NDArray, bool]:
+    """Donut transition of the env itself, including the arrival probability updates.
+
+    As in `Donut.get_transition`, prob and tracker are updated in place: the
+    probability of a served person is raised (with dynamic probabilities) and restored
+    2 steps later, then replaced by the distribution (if any).
+
+    Args:
+        state (NDArray): The customers at the counter.
+        memory (NDArray): The memory.
+        action (int): The action taken.
+        uniforms (NDArray): The uniform numbers of the arrivals.
+        prob (NDArray): The arrival probability of each person.
+        initial_prob (NDArray): The arrival probability each person is restored to.
+        tracker (NDArray): The steps since the probability of each person was raised (-1 if it is not).
+        dynamic (bool): Whether serving a person raises their probability.
+        dist_prob (NDArray): The probabilities of the distribution at the step (unused without one).
+        has_distribution (bool): Whether the probabilities follow a distribution.
+
+    Returns:
+        tuple[NDArray, NDArray, bool]: The next customers, the next memory and whether the donut was dropped.
+    """
+    new_state = np.zeros_like(state)
+    new_memory = memory.copy()
+    drop = state[action] == 0
+    if not drop:
+        new_memory[action] += 1
+        if dynamic:
+            prob[action] = min(prob[action] + 0.1, 1.0)
+            tracker[action] = 0
+    for j in range(len(state)):
+        if tracker[j] >= 0:
+            tracker[j] += 1
+            if tracker[j] > 2:
+                prob[j] = initial_prob[j]
+                tracker[j] = -1
+        if has_distribution:
+            prob[j] = dist_prob[j]
+        if uniforms[j] <= prob[j]:
+            new_state[j] = 1
+    return new_state, new_memory, drop
+
+
+@njit(cache=True)
+def lending_transitions(
+    customers: NDArray,
+    success: float,
+    credit: NDArray,
+    memories: NDArray,
+    action: int,
+    group: int,
+    repayments: NDArray,
+    uniforms: NDArray,
+    prob: NDArray,
+) -> tuple[NDArray, NDArray, NDArray, NDArray]:
+    """Lending transitions of a batch of memories from the same state and action.
+
+    Args:
+        customers (NDArray): The applicants.
+        success (float): The number of successful repayments.
+        credit (NDArray): The credit score of each applicant.
+        memories (NDArray): The memories (loans per group), one row each.
+        action (int): The applicant given a loan.
+        group (int): The group of the applicant.
+        repayments (NDArray): The uniform number of the repayment of each transition (unused for a wrong action).
+        uniforms (NDArray): The uniform numbers of the arrivals, one row per memory.
+        prob (NDArray): The arrival probability of each applicant.
+
+    Returns:
+        tuple[NDArray, NDArray, NDArray, NDArray]: The next applicants, numbers of successful repayments, credit scores and memories.
+    """
+    n, people = uniforms.shape
+    new_customers = np.zeros((n, people), dtype=np.float32)
+    new_success = np.full(n, success, dtype=np.float32)
+    new_credit = np.empty((n, len(credit)), dtype=np.float32)
+    new_memories = memories.copy()
+    for i in range(n):
+        new_credit[i] = credit
+        if customers[action] != 0:
+            new_memories[i, group] += 1
+            if repayments[i] <= np.float32((credit[action] + 2) / 10):
+                new_success[i] += 1
+                new_credit[i, action] = min(credit[action] + 1, 7)
+            else:
+                new_success[i] -= 1
+                new_credit[i, action] = max(credit[action] - 1, 0)
+        for j in range(people):
+            if uniforms[i, j] <= prob[j]:
+                new_customers[i, j] = 1
+    return new_customers, new_success, new_credit, new_memories
+
+
+@njit(cache=True)
+def covid_transition(
+    region_state: NDArray,
+    allocation: NDArray,
+    population: NDArray,
+    beta: NDArray,
+    sigma: NDArray,
+    gamma: NDArray,
+    novax: bool,
+) -> tuple[NDArray, NDArray, NDArray, NDArray]:
+    """Vaccination and SEIR update of every region.
+
+    As in `CovidSEIREnv.get_transition`, the vaccination updates region_state in place.
+
+    Args:
+        region_state (NDArray): The [S, E, I, R] compartments of each region, shape (k, 4).
+        allocation (NDArray): The vaccines allocated to each region.
+        population (NDArray): The population of each region.
+        beta (NDArray): The contact rate of each region.
+        sigma (NDArray): The incubation rate of each region.
+        gamma (NDArray): The recovery rate of each region.
+        novax (bool): Whether the vaccines are not used.
+
+    Returns:
+        tuple[NDArray, NDArray, NDArray, NDArray]: The new compartments, the used vaccines, the newly infected and the newly exposed people of each region.
+    """
+    k = region_state.shape[0]
+    used_vaccines = np.zeros(k, dtype=np.float32)
+    if not novax:
+        for i in range(k):
+            used_vaccines[i] = min(allocation[i], region_state[i, 0])
+            region_state[i, 0] -= used_vaccines[i]
+            region_state[i, 3] += used_vaccines[i]
+            region_state[i, 0] = min(max(region_state[i, 0], 0.0), population[i])
+            region_state[i, 3] = min(max(region_state[i, 3], 0.0), population[i])
+
+    new_state = np.zeros((k, 4), dtype=np.float32)
+    new_infected = np.zeros(k, dtype=np.float32)
+    newly_exposed = np.zeros(k, dtype=np.float32)
+    for i in range(k):
+        s = region_state[i, 0]
+        e = region_state[i, 1]
+        infected = region_state[i, 2]
+        r = region_state[i, 3]
+        exposed = beta[i] * s * infected / population[i]
+        new_state[i, 0] = s - exposed
+        new_state[i, 1] = e + (exposed - sigma[i] * e)
+        new_state[i, 2] = infected + (sigma[i] * e - gamma[i] * infected)
+        new_state[i, 3] = r + gamma[i] * infected
+        new_infected[i] = sigma[i] * e
+        newly_exposed[i] = exposed
+        for c in range(4):
+            new_state[i, c] = min(max(new_state[i, c], 0.0), population[i])
+    return new_state, used_vaccines, new_infected, newly_exposed
+
+
+@njit(cache=True)
+def covid_counterfactual_transitions(
+    region_state: NDArray,
+    allocation: NDArray,
+    population: NDArray,
+    beta: NDArray,
+    sigma: NDArray,
+    gamma: NDArray,
+    novax: bool,
+    n: int,
+) -> tuple[NDArray, NDArray, NDArray, NDArray]:
+    """`covid_transition` repeated for n counterfactual transitions of the same state.
+
+    Like calling `CovidSEIREnv.get_transition` for each counterfactual memory, each
+    transition starts from the compartments left by the vaccination of the previous one.
+
+    Args:
+        region_state (NDArray): The [S, E, I, R] compartments of each region, shape (k, 4).
+        allocation (NDArray): The vaccines allocated to each region.
+        population (NDArray): The population of each region.
+        beta (NDArray): The contact rate of each region.
+        sigma (NDArray): The incubation rate of each region.
+        gamma (NDArray): The recovery rate of each region.
+        novax (bool): Whether the vaccines are not used.
+        n (int): The number of transitions.
+
+    Returns:
+        tuple[NDArray, NDArray, NDArray, NDArray]: The new compartments, used vaccines, newly infected and newly exposed people of each transition.
+    """
+    k = region_state.shape[0]
+    new_states = np.zeros((n, k, 4), dtype=np.float32)
+    used_vaccines = np.zeros((n, k), dtype=np.float32)
+    new_infected = np.zeros((n, k), dtype=np.float32)
+    newly_exposed = np.zeros((n, k), dtype=np.float32)
+    for t in range(n):
+        state_t, used_t, infected_t, exposed_t = covid_transition(
+            region_state, allocation, population, beta, sigma, gamma, novax
+        )
+        new_states[t] = state_t
+        used_vaccines[t] = used_t
+        new_infected[t] = infected_t
+        newly_exposed[t] = exposed_t
+    return new_states, used_vaccines, new_infected, newly_exposed
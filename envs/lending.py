@@ -3,7 +3,8 @@ from gym.spaces import Discrete, MultiBinary
 import random
 import numpy as np
 from numpy.typing import NDArray
-from core.aggregations import Aggregation, RDP
+from core.aggregations import Aggregation, GroupParity, RDP
+from envs import kernels
 
 
 class Lending(gym.Env):
@@ -16,8 +17,23 @@ class Lending(gym.Env):
         p: list[float] | None = None,
         aggregation: Aggregation | None = None,
         binarize: bool = True,
+        incremental_reward: bool = False,
+        own_rng: bool = False,
+        predraw: bool = False,
+        jit: bool | None = None,
+        groups: int | list[int] | NDArray | None = None,
     ):
         self.people = people
+
+        # Group of each applicant (by default the first half is group 0 and the rest
+        # group 1, a number of groups splits the applicants in contiguous groups)
+        if groups is None:
+            groups = np.arange(people) >= people // 2
+        elif isinstance(groups, int):
+            groups = np.arange(people) * groups // people
+        self.groups = np.asarray(groups, dtype=np.int64)
+        assert len(self.groups) == people, "Every applicant needs a group"
+        self.n_groups = int(self.groups.max()) + 1
         self.seed = seed
         self.episode_length = episode_length
         self.state_mode = state_mode
@@ -31,30 +47,54 @@ class Lending(gym.Env):
         # With memory: Binary representation of customers at the counter + success + credit + memory -> shape (k + 1 + k + k // 2,)
         self.success_size = 1
         self.credit_size = people
-        self.memory_size = people
+        self.memory_size = self.n_groups
         if binarize:
             self.success_size = int(np.ceil(np.log2((episode_length + 1) * 2)))
             self.credit_size = people * int(np.ceil(np.log2(7)))
-            self.memory_size = (people // 2) * int(np.ceil(np.log2(episode_length + 1)))
+            self.memory_size = self.n_groups * int(np.ceil(np.log2(episode_length + 1)))
         if state_mode == "none":
             self.memory_size = 0
         self.observation_space = Discrete(
             people + self.success_size + self.credit_size + self.memory_size, seed=seed
         )
 
-        self.aggregation = aggregation if aggregation is not None else RDP()
+        if aggregation is None:
+            aggregation = RDP() if self.n_groups == 2 else GroupParity()
+        assert (
+            type(aggregation) != RDP or self.n_groups == 2
+        ), "RDP is only defined for two groups, use GroupParity"
+        self.aggregation = aggregation
+        # Update the welfare of the own memory with the change of each step
+        self.incremental = (
+            self.aggregation.incremental(episode_length) if incremental_reward else None
+        )
 
-        self.default_credit = np.array([4, 4, 7, 7], dtype=np.float32)
+        # Initial credit of each group from 4 to 7 ([4, 4, 7, 7] for 4 applicants)
+        group_credit = np.round(np.linspace(4, 7, self.n_groups))
+        self.default_credit = group_credit[self.groups].astype(np.float32)
         self.credit = self.default_credit.copy()
 
-        self.memory = np.zeros(people // 2, dtype=np.float32)
+        self.memory = np.zeros(self.n_groups, dtype=np.float32)
         self.success = self.episode_length
 
         self.current_step = 0
         self.state = np.zeros(2 * people + 1, dtype=np.float32)
 
+        # Draw the repayments and arrivals from an own generator instead of the global
+        # random module (and optionally draw those of a whole episode at reset)
+        assert own_rng or not predraw, "Pre-drawing the arrivals requires own_rng"
+        self.rng = np.random.default_rng(seed) if own_rng else None
+        self.predraw = predraw
+        self.arrivals: NDArray | None = None
+
+        # Use the compiled kernels (by default when numba is installed)
+        self.jit = kernels.NUMBA_AVAILABLE if jit is None else jit
+
         if p is None:
             self.prob = [0.9 for _ in range(self.people)]
+        elif len(p) == 1:
+            # The same probability for everyone
+            self.prob = [p[0] for _ in range(self.people)]
         else:
             self.prob = p
 
@@ -64,17 +104,51 @@ class Lending(gym.Env):
 
         self.reset()
 
-    def binarize(self, s: NDArray, length: int) -> NDArray:
-        zero_fill = int(np.ceil(np.log2(length)))
-        ans = ""
-        for i in s.astype(int):
-            ans += bin(i)[2:].zfill(zero_fill)
+    def draw_uniforms(
+        self, repayment: bool, step: int | None = None
+    ) -> tuple[float | None, NDArray]:
+        """Draw the uniform numbers of a repayment and of the arrival of each person.
+
+        Args:
+            repayment (bool): Whether a loan was given (so a repayment is drawn).
+            step (int | None, optional): The step of the episode of the env itself, to use the pre-drawn numbers. Defaults to None.
+
+        Returns:
+            tuple[float | None, NDArray]: The number of the repayment (None without a loan when using the global random module) and of the arrivals.
+        """
+        if self.rng is None:
+            repayment_p = random.random() if repayment else None
+            return repayment_p, np.array([random.random() for _ in range(self.people)])
+        if step is not None and self.arrivals is not None:
+            uniforms = self.arrivals[step]
+        else:
+            uniforms = self.rng.random(self.people + 1)
+        return uniforms[0], uniforms[1:]
 
-        int_ans = []
-        for t in ans:
-            int_ans.append(int(t))
+    def draw_batch_uniforms(self, repayment: bool, n: int) -> tuple[NDArray, NDArray]:
+        """`draw_uniforms` for n transitions (not of the env itself).
 
-        return np.array(int_ans, dtype=np.float32)
+        Args:
+            repayment (bool): Whether a loan was given (so repayments are drawn).
+            n (int): The number of transitions.
+
+        Returns:
+            tuple[NDArray, NDArray]: The numbers of the repayments (0 without a loan when using the global random module) and of the arrivals, one row per transition.
+        """
+        if self.rng is not None:
+            # The same numbers as n calls of draw_uniforms
+            uniforms = self.rng.random((n, self.people + 1))
+            return uniforms[:, 0], uniforms[:, 1:]
+        repayments, uniforms = zip(*[self.draw_uniforms(repayment) for _ in range(n)])
+        # In get_transition these Python floats are compared with the float32 credit
+        # in float32
+        repayments = np.array(
+            [0.0 if r is None else r for r in repayments], dtype=np.float32
+        )
+        return repayments, np.array(uniforms).reshape(n, self.people)
+
+    def binarize(self, s: NDArray, length: int) -> NDArray:
+        return self.binarize_rows(np.asarray(s)[None], length)[0]
 
     def get_transformed_memory(self, memory: NDArray | None = None) -> NDArray:
         """Transform memory based on state mode.
@@ -122,6 +196,7 @@ class Lending(gym.Env):
         memory: NDArray,
         action: int | NDArray,
         episode: int,
+        track: bool = False,
     ) -> tuple[NDArray, NDArray, float, dict]:
 
         # possible actions are 0, 1, 2, 3
@@ -133,28 +208,48 @@ class Lending(gym.Env):
 
         wrong_action = customers[action] == 0
 
-        subg = 0 if action <= 1 else 1
-
-        new_memory = memory.copy()
-        if not wrong_action:
-            new_memory[subg] += 1
-            repayment = random.random()
-            if repayment <= ((credit[action] + 2) / 10):
-                success += 1
-                credit[action] = min(credit[action] + 1, 7)
-            else:
-                success -= 1
-                credit[action] = max(credit[action] - 1, 0)
-
-        customers = np.zeros_like(customers, dtype=np.float32)
-        for i in range(self.people):
-            p = random.random()
-            if p <= self.prob[i]:
-                customers[i] = 1
-            else:
-                customers[i] = 0
-
-        reward = self.aggregation(new_memory)
+        subg = self.groups[action]
+
+        repayment, uniforms = self.draw_uniforms(
+            not wrong_action, episode if track else None
+        )
+        if self.jit:
+            new_customers, new_success, new_credit, new_memories = (
+                kernels.lending_transitions(
+                    customers,
+                    success[0],
+                    credit,
+                    memory[None],
+                    int(action),
+                    int(subg),
+                    np.array([0.0 if repayment is None else repayment]),
+                    uniforms[None],
+                    np.asarray(self.prob, dtype=np.float64),
+                )
+            )
+            customers, success = new_customers[0], new_success
+            credit, new_memory = new_credit[0], new_memories[0]
+        else:
+            new_memory = memory.copy()
+            if not wrong_action:
+                new_memory[subg] += 1
+                if repayment <= ((credit[action] + 2) / 10):
+                    success += 1
+                    credit[action] = min(credit[action] + 1, 7)
+                else:
+                    success -= 1
+                    credit[action] = max(credit[action] - 1, 0)
+
+            customers = (uniforms <= np.asarray(self.prob, dtype=np.float64)).astype(
+                np.float32
+            )
+
+        if track and self.incremental is not None:
+            if not wrong_action:
+                self.incremental.update(subg, 1)
+            reward = self.incremental.value()
+        else:
+            reward = self.aggregation(new_memory)
         if wrong_action:
             reward = -1 * self.episode_length
         if done and success[0] < self.episode_length + int(self.episode_length / 10):
@@ -173,37 +268,152 @@ class Lending(gym.Env):
         schedule_step: int,
         n_counterfactuals: int,
     ) -> list[tuple[NDArray, NDArray, int, float, NDArray, NDArray]]:
-        transitions = []
-        for i in range(len(actual_memory)):
-            for k in range(1, n_counterfactuals // 2 + 1):
-                cf_memory = actual_memory.copy()
-                cf_memory[i] += k
-                if cf_memory[i] >= self.episode_length + 1:
-                    break
-
-                new_state, new_memory, reward, _ = self.get_transition(
-                    actual_state, cf_memory, action, schedule_step
-                )
-                cf_memory = self.get_transformed_memory(cf_memory)
-                new_memory = self.get_transformed_memory(new_memory)
+        # Add 1 to n_counterfactuals // 2 loans to each group (while below the
+        # episode length), in the order of the memories of get_transition calls
+        loans = np.arange(1, n_counterfactuals // 2 + 1)
+        rows = np.repeat(np.arange(self.n_groups), len(loans))
+        cf_memories = np.repeat(actual_memory[None], len(rows), axis=0)
+        cf_memories[np.arange(len(rows)), rows] += np.tile(loans, self.n_groups)
+        cf_memories = cf_memories[
+            cf_memories[np.arange(len(rows)), rows] < self.episode_length + 1
+        ]
+        n = len(cf_memories)
+        if n == 0:
+            return []
+
+        # All counterfactual transitions at once (same random numbers as calling
+        # get_transition for each memory)
+        customers = actual_state[: self.people]
+        success = actual_state[self.people]
+        credit = actual_state[self.people + 1 :]
+        wrong_action = customers[action] == 0
+        repayments, uniforms = self.draw_batch_uniforms(not wrong_action, n)
+        transitions = kernels.lending_transitions if self.jit else self.transitions
+        new_customers, new_success, new_credit, new_memories = transitions(
+            customers,
+            success,
+            credit,
+            cf_memories,
+            int(action),
+            int(self.groups[action]),
+            repayments,
+            uniforms,
+            np.asarray(self.prob, dtype=np.float64),
+        )
 
-                customers = new_state[: self.people]
-                success = new_state[self.people : self.people + 1]
-                credit = new_state[self.people + 1 :]
+        if wrong_action:
+            rewards = np.full(n, -1.0 * self.episode_length)
+        else:
+            rewards = self.aggregation.forward_batch(new_memories)
+        done = schedule_step >= self.episode_length
+        threshold = self.episode_length + int(self.episode_length / 10)
+        if done:
+            rewards = np.where(
+                new_success < threshold, -10 * self.episode_length, rewards
+            )
+
+        success_bits = new_success[:, None]
+        credit_bits = new_credit
+        if self.binarize_obs:
+            success_bits = self.binarize_rows(
+                success_bits, (self.episode_length + 1) * 2
+            )
+            credit_bits = self.binarize_rows(credit_bits, 7)
+        new_states = np.concatenate(
+            [new_customers, success_bits, credit_bits], axis=1, dtype=np.float32
+        )
+        cf_memories = self.encode_memories(cf_memories)
+        new_memories = self.encode_memories(new_memories)
+
+        return [
+            (
+                state,
+                cf_memories[i],
+                action,
+                float(rewards[i]),
+                new_states[i],
+                new_memories[i],
+            )
+            for i in range(n)
+        ]
+
+    def encode_memories(self, memory: NDArray) -> NDArray:
+        """Vectorized `get_transformed_memory` for a batch of memories (not of the env).
 
-                if self.binarize_obs:
-                    success = self.binarize(success, (self.episode_length + 1) * 2)
-                    credit = self.binarize(credit, 7)
+        Args:
+            memory (NDArray): The memories, one row each.
 
-                new_state = np.concatenate(
-                    [customers, success, credit], dtype=np.float32
-                )
+        Returns:
+            NDArray: The transformed memories.
+        """
+        if self.state_mode == "none":
+            return np.zeros((len(memory), 0), dtype=np.float32)
+        if self.state_mode == "min":
+            memory = memory - memory.min(axis=1, keepdims=True)
+        if not self.binarize_obs:
+            return memory.astype(np.float32)
+        return self.binarize_rows(memory, self.episode_length + 1)
+
+    def transitions(
+        self,
+        customers: NDArray,
+        success: float,
+        credit: NDArray,
+        memories: NDArray,
+        action: int,
+        group: int,
+        repayments: NDArray,
+        uniforms: NDArray,
+        prob: NDArray,
+    ) -> tuple[NDArray, NDArray, NDArray, NDArray]:
+        """NumPy version of `kernels.lending_transitions` (a batch of transitions from the same state and action).
 
-                transitions.append(
-                    (state, cf_memory, action, reward, new_state, new_memory)
-                )
+        Args:
+            customers (NDArray): The applicants.
+            success (float): The number of successful repayments.
+            credit (NDArray): The credit score of each applicant.
+            memories (NDArray): The memories (loans per group), one row each.
+            action (int): The applicant given a loan.
+            group (int): The group of the applicant.
+            repayments (NDArray): The uniform number of the repayment of each transition (unused for a wrong action).
+            uniforms (NDArray): The uniform numbers of the arrivals, one row per memory.
+            prob (NDArray): The arrival probability of each applicant.
+
+        Returns:
+            tuple[NDArray, NDArray, NDArray, NDArray]: The next applicants, numbers of successful repayments, credit scores and memories.
+        """
+        n = len(memories)
+        new_success = np.full(n, success, dtype=np.float32)
+        new_credit = np.repeat(credit[None], n, axis=0).astype(np.float32)
+        new_memories = memories.copy()
+        if customers[action] != 0:
+            new_memories[:, group] += 1
+            repaid = repayments <= ((credit[action] + 2) / 10)
+            new_success += np.where(repaid, 1, -1).astype(np.float32)
+            new_credit[:, action] = np.where(
+                repaid, min(credit[action] + 1, 7), max(credit[action] - 1, 0)
+            )
+        new_customers = (uniforms <= prob).astype(np.float32)
+        return new_customers, new_success, new_credit, new_memories
+
+    def binarize_rows(self, values: NDArray, length: int) -> NDArray:
+        """Vectorized `binarize` of each row.
 
-        return transitions
+        Args:
+            values (NDArray): Non-negative integer values, one row each.
+            length (int): The number of values (the bits are ceil(log2(length))).
+
+        Returns:
+            NDArray: The bits of each row.
+        """
+        bits = int(np.ceil(np.log2(length)))
+        shifts = np.arange(bits - 1, -1, -1)
+        values = values.astype(np.int64)
+        return (
+            ((values[..., None] >> shifts) & 1)
+            .reshape(len(values), -1)
+            .astype(np.float32)
+        )
 
     def step(self, action: int | NDArray) -> tuple[NDArray, float, bool, bool, dict]:
         self.current_step += 1
@@ -211,11 +421,12 @@ class Lending(gym.Env):
         memory = self.memory
 
         new_state, new_memory, reward, info = self.get_transition(
-            state, memory, action, self.current_step
+            state, memory, action, self.current_step, track=True
         )
         done = self.current_step >= self.episode_length
         self.state = new_state
         self.memory = new_memory
+        memory_before_reset = self.memory
 
         customers = new_state[: self.people]
         success = new_state[self.people : self.people + 1]
@@ -227,6 +438,9 @@ class Lending(gym.Env):
 
         new_state = np.concatenate([customers, success, credit], dtype=np.float32)
         new_memory = self.get_transformed_memory()
+        if self.incremental is not None and self.memory is not memory_before_reset:
+            # The memory was reset
+            self.incremental.reset(self.memory)
 
         obs = np.concatenate([new_state, new_memory], dtype=np.float32)
         info = {
@@ -238,22 +452,26 @@ class Lending(gym.Env):
     def reset(
         self, *, seed: int | None = None, options: dict | None = None
     ) -> tuple[NDArray, dict]:
-        self.memory = np.zeros(self.people // 2, dtype=np.float32)
+        self.memory = np.zeros(self.n_groups, dtype=np.float32)
         self.current_step = 0
         self.success = self.episode_length
         self.credit = self.default_credit.copy()
 
-        customers = np.zeros(self.people, dtype=np.float32)
-        for i in range(self.people):
-            p = random.random()
-            if p <= self.prob[i]:
-                customers[i] = 1
-            else:
-                customers[i] = 0
+        if seed is not None and self.rng is not None:
+            self.rng = np.random.default_rng(seed)
+        if self.predraw:
+            # Row 0 is used here, row t by step t
+            self.arrivals = self.rng.random((self.episode_length + 1, self.people + 1))
+        _, uniforms = self.draw_uniforms(False, 0)
+        customers = (uniforms <= np.asarray(self.prob, dtype=np.float64)).astype(
+            np.float32
+        )
         self.state = np.concatenate(
             [customers, np.array([self.success], dtype=np.float32), self.credit]
         )
         memory = self.get_transformed_memory()
+        if self.incremental is not None:
+            self.incremental.reset(self.memory)
         success = np.array([self.success], dtype=np.float32)
         credit = self.credit
         if self.binarize_obs:
@@ -1,32 +1,53 @@
+from __future__ import annotations
+
 from collections import deque
 import argparse
 import numpy as np
 from tqdm import tqdm
 import torch
-import numpy as np
 import csv
+import json
 import random
 from argparse import Namespace
 from gym.spaces import Discrete, Box, MultiBinary
 import pickle
+import os
+import socket
+import sys
+import traceback
+import hashlib
 from gym import Env
 import warnings
-from envs.covid import CovidSEIREnv
-from envs.donut import Donut
-from envs.lending import Lending
-from core.agents import Agent, DQN, SAC, Random
-from core.aggregations import (
-    Aggregation,
-    NSW,
-    Utilitarian,
-    Rawlsian,
-    Egalitarian,
-    Gini,
-    RDP,
+import threading
+import time
+import multiprocessing
+from functools import partial
+from typing import TYPE_CHECKING, Callable
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from core.registry import AGENTS, AGGREGATIONS, ENVS, resolve
+from core.utils import (
+    EpisodeProfiler,
+    PhaseTimer,
+    format_bytes,
+    object_bytes,
+    peak_rss_bytes,
 )
 
+# The agents, aggregations and the modules of the optional run modes are imported
+# where they are used, so a run only imports what it needs
+if TYPE_CHECKING:
+    from core.agents import Agent, EnsembleDQN
+    from core.aggregations import Aggregation
+    from core.counterfactuals import CounterfactualProducer
+    from core.dataset import DatasetRecorder
+    from core.dp import DonutDP
+    from core.jobqueue import JobQueue
+
 warnings.filterwarnings("ignore")  # Suppress stable_baselines3 gym wrapper warnings
 
+# The experiments of a run use the seeds SEED + 1, ..., SEED + num_exps
+SEED = 2024
+
 
 def set_seed(seed: int) -> None:
     """Set the random seed for reproducibility.
@@ -41,47 +62,25 @@ def set_seed(seed: int) -> None:
         torch.cuda.manual_seed_all(seed)
 
 
-def run(
-    k: int,
-    max_ep_len: int,
-    memory_capacity: int,
-    learn_freq: int,
-    device: torch.device | str,
-    args: Namespace,
-    seed=42,
-) -> tuple[list, dict]:
-    """Run the training loop.
+def make_env(k: int, max_ep_len: int, args: Namespace, seed: int = 42) -> Env:
+    """Create the environment (and its aggregation function) selected by the arguments.
 
     Args:
         k (int): Number of regions.
         max_ep_len (int): Maximum episode length.
-        memory_capacity (int): Memory capacity.
-        learn_freq (int): Frequency of learning.
-        device (torch.device | str): Device to run on.
         args (Namespace): Arguments.
         seed (int, optional): Random seed. Defaults to 42.
 
     Returns:
-        tuple[list, dict]: List of rewards, dictionary of running values.
+        Env: The environment.
     """
-    # Create aggregation function
+    # Create aggregation function (None for the default of the env)
     aggregation: Aggregation | None = None
-    match args.reward_type:
-        case "nsw":
-            aggregation = NSW()
-        case "utilitarian":
-            aggregation = Utilitarian()
-        case "rawlsian":
-            aggregation = Rawlsian()
-        case "egalitarian":
-            aggregation = Egalitarian()
-        case "gini":
-            aggregation = Gini()
-        case "rdp":
-            aggregation = RDP()
-    assert aggregation is not None, "Invalid aggregation function"
+    if args.reward_type is not None:
+        aggregation = resolve("aggregation", args.reward_type)()
 
     # Create env
+    env_cls = resolve("env", args.env_type)
     env: Env | None = None
     if args.env_type == "covid":
 
@@ -99,7 +98,7 @@ def run(
         gamma = [0.262, 0.085, 0.087]
         sigma = 0.2
 
-        env = CovidSEIREnv(
+        env = env_cls(
             render_mode="human",
             state_mode=args.state_mode,
             k=k,
@@ -117,8 +116,8 @@ def run(
             aggregation=aggregation,
         )
     elif args.env_type == "donut":
-        env = Donut(
-            people=5,
+        env = env_cls(
+            people=args.people or 5,
             episode_length=100,
             seed=seed,
             state_mode=args.state_mode,
@@ -126,19 +125,63 @@ def run(
             distribution=args.distribution,
             dynamic_prob=args.dynamic,
             aggregation=aggregation,
+            incremental_reward=args.incremental_reward,
+            own_rng=args.env_rng,
+            predraw=args.predraw,
+            memory_encoding=args.memory_encoding,
+            sparse_arrivals=args.sparse_arrivals,
         )
     elif args.env_type == "lending":
-        env = Lending(
-            people=4,
+        env = env_cls(
+            people=args.people or 4,
             episode_length=max_ep_len,
             seed=seed,
             state_mode=args.state_mode,
             p=args.p,
+            incremental_reward=args.incremental_reward,
+            own_rng=args.env_rng,
+            predraw=args.predraw,
+            groups=args.groups,
+            aggregation=aggregation,
         )
 
     assert env is not None
 
-    set_seed(seed)
+    return env
+
+
+def get_episode_seed(args: Namespace, seed: int, episode: int) -> int | None:
+    """Get the seed of the env generator for a training episode.
+
+    The seed only depends on the run seed and the episode, so the arrivals of each
+    episode are the same however many actors run.
+
+    Args:
+        args (Namespace): Arguments.
+        seed (int): Random seed of the run.
+        episode (int): The episode.
+
+    Returns:
+        int | None: The seed, or None if the env uses the global random module.
+    """
+    if not args.env_rng:
+        return None
+    assert args.env_type in [
+        "donut",
+        "lending",
+    ], "Env generators are only supported for donut and lending"
+    return int(np.random.SeedSequence([seed, episode]).generate_state(1)[0])
+
+
+def get_space_sizes(env: Env) -> tuple[int, int]:
+    """Get the observation and action sizes of an environment.
+
+    Args:
+        env (Env): The environment.
+
+    Returns:
+        tuple[int, int]: Number of states, number of actions.
+    """
     num_states: int | None = None
     if type(env.observation_space) == Box:
         num_states = env.observation_space.shape[0]
@@ -155,9 +198,257 @@ def run(
         num_actions = env.action_space.shape[0]
     assert num_actions is not None
 
+    return num_states, num_actions
+
+
+def get_replay_mode(args: Namespace) -> tuple[str, dict]:
+    """Get the info key of the memory to store and the extra counterfactual arguments.
+
+    In raw replay mode the untransformed memory is stored and encoded at sample time.
+
+    Args:
+        args (Namespace): Arguments.
+
+    Returns:
+        tuple[str, dict]: Info key of the memory, keyword arguments for the counterfactuals.
+    """
+    if not args.raw_replay:
+        return "memory", {}
+    assert args.env_type == "donut", "Raw replay is only supported for donut"
+    assert args.agent_type == "dqn", "Raw replay is only supported for DQN"
+    return "raw_memory", {"raw": True}
+
+
+def evaluate(
+    agent: Agent,
+    env: Env,
+    args: Namespace,
+    device: torch.device | str,
+    n_episodes: int = 1,
+) -> tuple[float, dict]:
+    """Play greedy evaluation episodes.
+
+    Args:
+        agent (Agent): The agent.
+        env (Env): The environment.
+        args (Namespace): Arguments.
+        device (torch.device | str): Device to run on.
+        n_episodes (int, optional): Number of episodes. Defaults to 1.
+
+    Returns:
+        tuple[float, dict]: Reward and running values (averaged over the episodes).
+    """
+    rewards = []
+    values = {key: [] for key in env.running_values + env.running_values_done}
+    for _ in range(n_episodes):
+        obs, info = env.reset()
+        ep_reward = 0
+        ep_values = {key: info[key] for key in env.running_values}
+        hidden = (
+            None
+            if args.net_type == "linear"
+            else torch.zeros([1, args.hidden_size], device=device)
+        )
+
+        while True:
+            # Take step
+            action, hidden = agent.choose_action(obs, greedy=True, hidden=hidden)
+            obs, reward, done, _, info = env.step(action)
+            ep_reward += reward
+
+            # Update running values
+            for key in env.running_values:
+                ep_values[key] += info[key]
+            if done:
+                for key in env.running_values_done:
+                    ep_values[key] = info[key]
+                break
+
+        rewards.append(ep_reward)
+        for key in values:
+            values[key].append(ep_values[key])
+
+    if n_episodes == 1:
+        return rewards[0], {key: values[key][0] for key in values}
+    return float(np.mean(rewards)), {
+        key: np.mean(values[key], axis=0) for key in values
+    }
+
+
+def evaluate_ensemble(
+    agent: EnsembleDQN, envs: list[Env], n_episodes: int = 1
+) -> list[tuple[float, dict]]:
+    """Play greedy evaluation episodes of every ensemble member (in lockstep).
+
+    Args:
+        agent (EnsembleDQN): The ensemble.
+        envs (list[Env]): The env of each member.
+        n_episodes (int, optional): Number of episodes. Defaults to 1.
+
+    Returns:
+        list[tuple[float, dict]]: Reward and running values (averaged over the episodes) of each member.
+    """
+    members = len(envs)
+    rewards = np.zeros((n_episodes, members))
+    values = [
+        {key: [] for key in env.running_values + env.running_values_done}
+        for env in envs
+    ]
+    for e in range(n_episodes):
+        obs = []
+        for m, env in enumerate(envs):
+            obs_m, info = env.reset()
+            obs.append(obs_m)
+            for key in env.running_values:
+                values[m][key].append(info[key])
+
+        while True:
+            actions = agent.choose_action(np.stack(obs), greedy=True)
+            done = False
+            for m, env in enumerate(envs):
+                next_obs, reward, done, _, info = env.step(actions[m])
+                rewards[e, m] += reward
+
+                # Update running values
+                for key in env.running_values:
+                    values[m][key][-1] += info[key]
+                if done:
+                    for key in env.running_values_done:
+                        values[m][key].append(info[key])
+                obs[m] = next_obs
+            if done:
+                break
+
+    if n_episodes == 1:
+        return [
+            (rewards[0, m], {key: values[m][key][0] for key in values[m]})
+            for m in range(members)
+        ]
+    return [
+        (
+            float(np.mean(rewards[:, m])),
+            {key: np.mean(values[m][key], axis=0) for key in values[m]},
+        )
+        for m in range(members)
+    ]
+
+
+def evaluate_snapshot(
+    agent: Agent,
+    k: int,
+    max_ep_len: int,
+    args: Namespace,
+    seed: int,
+    n_episodes: int = 1,
+) -> tuple[float, dict]:
+    """Evaluate a policy snapshot in a fresh env (runs in an evaluation worker process).
+
+    Args:
+        agent (Agent): The policy snapshot.
+        k (int): Number of regions.
+        max_ep_len (int): Maximum episode length.
+        args (Namespace): Arguments.
+        seed (int): Random seed of the evaluation.
+        n_episodes (int, optional): Number of episodes. Defaults to 1.
+
+    Returns:
+        tuple[float, dict]: Reward and running values (averaged over the episodes).
+    """
+    torch.set_num_threads(1)
+    env = make_env(k, max_ep_len, args, seed)
+    set_seed(seed)
+    result = evaluate(agent, env, args, "cpu", n_episodes)
+    env.close()
+    return result
+
+
+def merge_evaluations(
+    evaluations: dict[int, tuple[float, dict]], episodes: int, keys: list[str]
+) -> tuple[list, dict]:
+    """Expand evaluations keyed by episode index into per-episode lists.
+
+    Episodes without an evaluation of their own repeat the latest earlier one, so the
+    lists stay aligned with the training episodes. Episodes before the first evaluation
+    (the first `eval_freq - 1` episodes) have NaN rewards and running values, since no
+    policy was evaluated yet.
+
+    Args:
+        evaluations (dict[int, tuple[float, dict]]): Reward and running values by episode index.
+        episodes (int): Number of episodes.
+        keys (list[str]): Running value keys.
+
+    Returns:
+        tuple[list, dict]: List of rewards, dictionary of running values.
+    """
+    indices = sorted(evaluations)
+    reward_list = []
+    running_values = {key: [] for key in keys}
+    _, first_values = evaluations[indices[0]]
+    missing = (
+        np.nan,
+        {key: np.full(np.shape(first_values[key]), np.nan) for key in keys},
+    )
+    pos = -1
+    for i in range(episodes):
+        while pos + 1 < len(indices) and indices[pos + 1] <= i:
+            pos += 1
+        reward, values = missing if pos < 0 else evaluations[indices[pos]]
+        reward_list.append(reward)
+        for key in keys:
+            running_values[key].append(values[key])
+
+    return reward_list, running_values
+
+
+def run(
+    k: int,
+    max_ep_len: int,
+    memory_capacity: int,
+    learn_freq: int,
+    device: torch.device | str,
+    args: Namespace,
+    seed=42,
+    stop: Callable[[int, float], bool] | None = None,
+) -> tuple[list, dict]:
+    """Run the training loop.
+
+    Args:
+        k (int): Number of regions.
+        max_ep_len (int): Maximum episode length.
+        memory_capacity (int): Memory capacity.
+        learn_freq (int): Frequency of learning.
+        device (torch.device | str): Device to run on.
+        args (Namespace): Arguments.
+        seed (int, optional): Random seed. Defaults to 42.
+        stop (Callable[[int, float], bool] | None, optional): Called after each episode with the episode and the mean evaluation reward (NaN before the first evaluation), training stops early if it returns True. Defaults to None.
+
+    Returns:
+        tuple[list, dict]: List of rewards, dictionary of running values (up to the last episode played).
+    """
+    from core.agents import DQN, SAC
+
+    env = make_env(k, max_ep_len, args, seed)
+    memory_key, cf_kwargs = get_replay_mode(args)
+
+    # Set up the exact evaluation before training, so unsupported configurations
+    # fail before any episode is played
+    dp: DonutDP | None = None
+    if args.exact:
+        assert args.env_type == "donut", "Exact evaluation is only supported for donut"
+        assert (
+            args.agent_type == "dqn" and args.net_type == "linear"
+        ), "Exact evaluation is only supported for linear DQN policies"
+        from core.dp import DonutDP
+
+        dp = DonutDP(env)
+
+    set_seed(seed)
+    num_states, num_actions = get_space_sizes(env)
+
     agent: Agent | None = None
+    agent_cls = resolve("agent", args.agent_type)
     if args.agent_type == "dqn":
-        agent = DQN(
+        agent = agent_cls(
             env,
             num_states,
             num_actions,
@@ -169,29 +460,73 @@ def run(
             # normalize=True,
         )
     elif args.agent_type == "sac":
-        agent = SAC(env, args, memory_capacity, args.lr, device, args.net_arch)
+        agent = agent_cls(env, args, memory_capacity, args.lr, device, args.net_arch)
     elif args.agent_type in ["random", "random_cont"]:
-        agent = Random(env)
+        agent = agent_cls(env)
 
     assert agent is not None
 
     episodes = args.episodes
 
     # Initilize running values
-    reward_list = []
-    running_values = {}
-    for key in env.running_values:
-        running_values[key] = []
-    for key in env.running_values_done:
-        running_values[key] = []
+    evaluations: dict[int, tuple[float, dict]] = {}
+    pending: dict[int, Future] = {}
+    evaluator: ProcessPoolExecutor | None = None
+    if args.async_eval:
+        # Fail before training if the agent has no policy snapshots
+        agent.snapshot()
+        evaluator = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    producer: CounterfactualProducer | None = None
+    if args.counterfactual and args.cf_workers > 0:
+        from core.counterfactuals import CounterfactualProducer
+
+        producer = CounterfactualProducer(
+            partial(make_env, k, max_ep_len, args, seed),
+            args.num_counterfactuals,
+            cf_kwargs,
+            workers=args.cf_workers,
+            executor=args.cf_executor,
+            seed=seed,
+        )
+
+    recorder: DatasetRecorder | None = None
+    if args.record is not None:
+        from core.dataset import DatasetRecorder
+
+        recorder = DatasetRecorder(
+            os.path.join(args.record, f"seed_{seed}"),
+            args.shard_size,
+            meta={
+                "env_type": args.env_type,
+                "state_mode": args.state_mode,
+                "memory_key": memory_key,
+                "seed": seed,
+            },
+        )
 
     reward_buffer = deque(maxlen=100)
     loss_buffer = deque(maxlen=100)
+    timer = PhaseTimer(args.timing)
+    values_bytes = 0
+    profiler: EpisodeProfiler | None = None
+    if args.profile is not None:
+        root, name = get_results_path(args)
+        profiler = EpisodeProfiler(
+            args.profile,
+            f"{root}/{name}_profile_{seed}",
+            args.profile_start,
+            args.profile_episodes,
+        )
 
     for i in (t := tqdm(range(episodes))):
-        obs, info = env.reset()
+        if profiler is not None:
+            profiler.start_episode(i)
+        obs, info = env.reset(seed=get_episode_seed(args, seed, i))
         state = info["state"].copy()
-        memory = info["memory"].copy()
+        memory = info[memory_key].copy()
         step = 0
         hidden = (
             None
@@ -206,32 +541,44 @@ def run(
             actual_memory = env.memory.copy()
 
             # Take step
-            action, hidden = agent.choose_action(obs, hidden=hidden)
-            next_obs, reward, done, _, info = env.step(action)
+            with timer.phase("act"):
+                action, hidden = agent.choose_action(obs, hidden=hidden)
+            with timer.phase("env"):
+                next_obs, reward, done, _, info = env.step(action)
+            timer.steps += 1
             next_state = info["state"].copy()
-            next_memory = info["memory"].copy()
-
-            # Store actual experience
-            agent.store_transition(
-                state, memory, action, reward, next_state, next_memory
-            )
+            next_memory = info[memory_key].copy()
 
-            # Store counterfactual experiences
-            if args.counterfactual:
-                cf_transitions = env.get_counterfactual_transitions(
-                    state,
-                    actual_state,
-                    action,
-                    actual_memory,
-                    schedule_step,
-                    args.num_counterfactuals,
-                )
-                for transition in cf_transitions:
-                    agent.store_transition(*transition)
+            # Store actual and counterfactual experiences
+            transitions = [(state, memory, action, reward, next_state, next_memory)]
+            if producer is not None:
+                # Store the counterfactual transitions that are ready
+                with timer.phase("counterfactual"):
+                    producer.submit(
+                        env, state, actual_state, action, actual_memory, schedule_step
+                    )
+                    transitions += producer.collect()
+            elif args.counterfactual:
+                with timer.phase("counterfactual"):
+                    transitions += env.get_counterfactual_transitions(
+                        state,
+                        actual_state,
+                        action,
+                        actual_memory,
+                        schedule_step,
+                        args.num_counterfactuals,
+                        **cf_kwargs,
+                    )
+            with timer.phase("store"):
+                agent.store_transitions(transitions)
+                if recorder is not None:
+                    recorder.add(transitions[:1])
+                    recorder.add(transitions[1:], counterfactual=True)
 
             # Learn
             if step % learn_freq == 0:
-                loss = agent.learn()
+                with timer.phase("learn"):
+                    loss = agent.learn()
                 loss_buffer.append(loss)
             if done:
                 break
@@ -246,110 +593,1086 @@ def run(
         if type(agent) == DQN and agent.epsilon > 0.01:
             agent.epsilon = agent.epsilon * 0.999
 
-        # Evaluate
-        obs, info = env.reset()
-        state = info["state"]
-        memory = info["memory"]
-        ep_reward = 0
-        curr_step = 0
-        for key in env.running_values:
-            running_values[key].append(info[key])
-        hidden = (
-            None
-            if args.net_type == "linear"
-            else torch.zeros([1, args.hidden_size], device=device)
-        )
+        # Evaluate (every eval_freq episodes and after the last one)
+        if (i + 1) % args.eval_freq == 0 or i == episodes - 1:
+            with timer.phase("evaluate"):
+                if evaluator is not None:
+                    pending[i] = evaluator.submit(
+                        evaluate_snapshot,
+                        agent.snapshot(),
+                        k,
+                        max_ep_len,
+                        args,
+                        seed + i + 1,
+                        args.eval_episodes,
+                    )
+                else:
+                    evaluations[i] = evaluate(
+                        agent, env, args, device, args.eval_episodes
+                    )
+                    reward_buffer.append(evaluations[i][0])
+                    values_bytes += object_bytes(evaluations[i])
+        for j in [j for j, future in pending.items() if future.done()]:
+            evaluations[j] = pending.pop(j).result()
+            reward_buffer.append(evaluations[j][0])
+            values_bytes += object_bytes(evaluations[j])
 
-        while True:
-            # Take step
-            action, hidden = agent.choose_action(obs, greedy=True, hidden=hidden)
-            next_obs, reward, done, _, info = env.step(action)
-            next_state = info["state"]
-            next_memory = info["memory"]
+        # Set tqdm description
+        description = f"[EP {i+1}/{episodes}] Reward: {np.mean(reward_buffer):,.4f}"
+        if type(agent) == DQN:
+            description += f" | Loss: {np.mean(loss_buffer):.4f}"
+        if type(agent) == DQN:
+            description += f" | Epsilon: {agent.epsilon:.2f}"
+        if type(agent) == DQN:
+            description += f" | LR: {agent.optimizer.param_groups[0]['lr']:.7f}"
+        if type(agent) == SAC:
+            description += f" | Buffer: {agent.model.replay_buffer.size():,}"
+        description += f" | Replay: {format_bytes(agent.replay_bytes())}"
+        description += f" | Values: {format_bytes(values_bytes)}"
+        description += f" | Peak RSS: {format_bytes(peak_rss_bytes())}"
+        if timer.enabled:
+            description += f" | {timer.describe()}"
+        t.set_description(description)
+        t.refresh()
 
-            # Transition to next state
-            curr_step += 1
-            ep_reward += reward
+        if profiler is not None:
+            profiler.end_episode(i)
 
-            # Update running values
-            for key in env.running_values:
-                running_values[key][-1] += info[key]
+        mean_reward = np.mean(reward_buffer) if reward_buffer else np.nan
+        if stop is not None and stop(i, float(mean_reward)):
+            # Keep the results of the episodes played so far
+            episodes = i + 1
+            break
+    if profiler is not None:
+        profiler.close()
+    if producer is not None:
+        # Store the transitions of the outstanding jobs
+        transitions = producer.close()
+        agent.store_transitions(transitions)
+        if recorder is not None:
+            recorder.add(transitions, counterfactual=True)
+    if recorder is not None:
+        recorder.close()
+
+    # Wait for the outstanding evaluations
+    if evaluator is not None:
+        for j, future in pending.items():
+            evaluations[j] = future.result()
+        evaluator.shutdown()
+
+    reward_list, running_values = merge_evaluations(
+        evaluations, episodes, env.running_values + env.running_values_done
+    )
+
+    # Exact expected return of the final greedy policy
+    if dp is not None:
+        assert type(agent) == DQN
+        exact_return = dp.evaluate_policy(agent.greedy_actions)
+        running_values["exact_return"] = [exact_return]
+        print(f"Exact expected return: {exact_return:,.4f}")
+
+    # Save the time spent in each phase next to the results
+    if timer.enabled:
+        root, name = get_results_path(args)
+        with open(f"{root}/{name}_timing_{seed}.json", "w") as f:
+            json.dump(timer.summary(), f, indent=2)
+
+    write_manifest(args, seed, agent, running_values, [env])
+    env.close()
+
+    return reward_list, running_values
+
+
+def run_offline(
+    k: int,
+    max_ep_len: int,
+    memory_capacity: int,
+    learn_freq: int,
+    device: torch.device | str,
+    args: Namespace,
+    seed=42,
+    stop: Callable[[int, float], bool] | None = None,
+) -> tuple[list, dict]:
+    """Train DQN on a recorded dataset (see `-record`) without stepping the env.
+
+    An episode is as many learning steps as a training episode of `run` takes, so the
+    evaluations (which still play the env) line up with the online runs. If the
+    dataset directory holds one recording per seed, each experiment trains on the
+    recording of its seed. The counterfactual transitions of the dataset are only
+    sampled with `-cf`.
+
+    Args:
+        k (int): Number of regions.
+        max_ep_len (int): Maximum episode length.
+        memory_capacity (int): Memory capacity (unused, the dataset is the replay memory).
+        learn_freq (int): Frequency of learning.
+        device (torch.device | str): Device to run on.
+        args (Namespace): Arguments.
+        seed (int, optional): Random seed. Defaults to 42.
+        stop (Callable[[int, float], bool] | None, optional): As in `run`. Defaults to None.
+
+    Returns:
+        tuple[list, dict]: List of rewards, dictionary of running values (up to the last episode played).
+    """
+    assert args.agent_type == "dqn", "Offline training is only supported for DQN"
+    from core.agents import DQN
+    from core.dataset import META_FILE, OfflineDataset
+
+    path = args.offline
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        path = os.path.join(path, f"seed_{seed}")
+
+    env = make_env(k, max_ep_len, args, seed)
+    set_seed(seed)
+    num_states, num_actions = get_space_sizes(env)
+    dataset = OfflineDataset(path, device, counterfactuals=args.counterfactual, env=env)
+    assert (
+        dataset.meta["env_type"] == args.env_type
+        and dataset.meta["state_mode"] == args.state_mode
+    ), f"The dataset was recorded with another env or state mode: {dataset.meta}"
+    agent = DQN(
+        env,
+        num_states,
+        num_actions,
+        0,
+        args.lr,
+        device,
+        args,
+        args.net_arch,
+        replay_memory=dataset,
+    )
+    episodes = args.episodes
+    learn_steps = len(range(0, max_ep_len, learn_freq))
+
+    evaluations: dict[int, tuple[float, dict]] = {}
+    reward_buffer = deque(maxlen=100)
+    loss_buffer = deque(maxlen=100)
+    timer = PhaseTimer(args.timing)
+    for i in (t := tqdm(range(episodes))):
+        for _ in range(learn_steps):
+            with timer.phase("learn"):
+                loss_buffer.append(agent.learn())
+            timer.steps += 1
+
+        if (i + 1) % args.eval_freq == 0 or i == episodes - 1:
+            with timer.phase("evaluate"):
+                evaluations[i] = evaluate(agent, env, args, device, args.eval_episodes)
+            reward_buffer.append(evaluations[i][0])
+
+        description = f"[EP {i+1}/{episodes}] Reward: {np.mean(reward_buffer):,.4f}"
+        description += f" | Loss: {np.mean(loss_buffer):.4f}"
+        description += f" | Dataset: {len(dataset):,}"
+        description += f" | Peak RSS: {format_bytes(peak_rss_bytes())}"
+        if timer.enabled:
+            description += f" | {timer.describe()}"
+        t.set_description(description)
+        t.refresh()
+
+        mean_reward = np.mean(reward_buffer) if reward_buffer else np.nan
+        if stop is not None and stop(i, float(mean_reward)):
+            episodes = i + 1
+            break
+
+    reward_list, running_values = merge_evaluations(
+        evaluations, episodes, env.running_values + env.running_values_done
+    )
+    if timer.enabled:
+        root, name = get_results_path(args)
+        with open(f"{root}/{name}_timing_{seed}.json", "w") as f:
+            json.dump(timer.summary(), f, indent=2)
+    write_manifest(args, seed, agent, running_values, [env])
+    env.close()
+
+    return reward_list, running_values
+
+
+def run_actor_learner(
+    k: int,
+    max_ep_len: int,
+    memory_capacity: int,
+    learn_freq: int,
+    device: torch.device | str,
+    args: Namespace,
+    seed=42,
+) -> tuple[list, dict]:
+    """Run the training loop with concurrent actor threads and a learner.
+
+    Each actor thread steps its own env, stores the actual and counterfactual
+    experience in the shared (thread-safe) replay memory and plays a greedy
+    evaluation episode every `args.eval_freq` training episodes. Meanwhile, the learner (the
+    calling thread) takes `args.replay_ratio` gradient steps per env step and syncs
+    the acting weights every `args.sync_freq` gradient steps. Actors pause when the
+    learner falls more than one episode behind the replay ratio.
+
+    Args:
+        k (int): Number of regions.
+        max_ep_len (int): Maximum episode length.
+        memory_capacity (int): Memory capacity.
+        learn_freq (int): Frequency of learning (used if no replay ratio is given).
+        device (torch.device | str): Device to run on.
+        args (Namespace): Arguments.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Returns:
+        tuple[list, dict]: List of rewards, dictionary of running values.
+    """
+    assert args.agent_type == "dqn", "Actor/learner mode is only supported for DQN"
+    from core.agents import DQN
+
+    env = make_env(k, max_ep_len, args, seed)
+    memory_key, cf_kwargs = get_replay_mode(args)
+
+    set_seed(seed)
+    num_states, num_actions = get_space_sizes(env)
+
+    agent = DQN(
+        env,
+        num_states,
+        num_actions,
+        memory_capacity,
+        args.lr,
+        device,
+        args,
+        args.net_arch,
+    )
+    envs = [env] + [make_env(k, max_ep_len, args, seed) for _ in range(args.actors - 1)]
+    replay_ratio = (
+        args.replay_ratio if args.replay_ratio is not None else 1 / learn_freq
+    )
+    episodes = args.episodes
+
+    # Shared counters (claimed episodes, env and learn steps) and per-episode results
+    counter_lock = threading.Lock()
+    next_episode = 0
+    env_steps = 0
+    learn_steps = 0
+    max_lag = max_ep_len * replay_ratio
+    finished = 0
+    evaluations: dict[int, tuple[float, dict]] = {}
+
+    def claim_episode() -> int | None:
+        nonlocal next_episode
+        with counter_lock:
+            if next_episode >= episodes:
+                return None
+            next_episode += 1
+            return next_episode - 1
+
+    def act(actor_env: Env) -> None:
+        nonlocal env_steps, finished
+        while (i := claim_episode()) is not None:
+            obs, info = actor_env.reset(seed=get_episode_seed(args, seed, i))
+            state = info["state"].copy()
+            memory = info[memory_key].copy()
+            hidden = (
+                None
+                if args.net_type == "linear"
+                else torch.zeros([1, args.hidden_size], device=device)
+            )
+
+            while True:
+                # Store info for CF update
+                schedule_step = actor_env.current_step
+                actual_state = actor_env.state.copy()
+                actual_memory = actor_env.memory.copy()
+
+                # Take step
+                action, hidden = agent.choose_action(obs, hidden=hidden)
+                next_obs, reward, done, _, info = actor_env.step(action)
+                next_state = info["state"].copy()
+                next_memory = info[memory_key].copy()
+
+                # Store actual and counterfactual experiences
+                transitions = [(state, memory, action, reward, next_state, next_memory)]
+                if args.counterfactual:
+                    transitions += actor_env.get_counterfactual_transitions(
+                        state,
+                        actual_state,
+                        action,
+                        actual_memory,
+                        schedule_step,
+                        args.num_counterfactuals,
+                        **cf_kwargs,
+                    )
+                agent.store_transitions(transitions)
+                with counter_lock:
+                    env_steps += 1
+
+                # Wait if the learner lags behind by more than one episode
+                while env_steps * replay_ratio - learn_steps > max_lag:
+                    time.sleep(1e-4)
+                if done:
+                    break
+
+                # Transition to next state
+                obs = next_obs
+                state = next_state
+                memory = next_memory
+
+            # Update epsilon
+            with counter_lock:
+                if agent.epsilon > 0.01:
+                    agent.epsilon = agent.epsilon * 0.999
+
+            # Evaluate (every eval_freq episodes and after the last one)
+            if (i + 1) % args.eval_freq == 0 or i == episodes - 1:
+                evaluations[i] = evaluate(
+                    agent, actor_env, args, device, args.eval_episodes
+                )
+            with counter_lock:
+                finished += 1
+
+    # Start the actors and learn until all of them are finished
+    reward_buffer = deque(maxlen=100)
+    loss_buffer = deque(maxlen=100)
+    # Evaluated episodes whose rewards are in the reward buffer (they finish in any
+    # order)
+    reported: set[int] = set()
+    with ThreadPoolExecutor(max_workers=len(envs)) as executor:
+        actors = [executor.submit(act, actor_env) for actor_env in envs]
+        with tqdm(total=episodes) as t:
+            while not all(actor.done() for actor in actors):
+                if learn_steps < env_steps * replay_ratio:
+                    loss_buffer.append(agent.learn())
+                    learn_steps += 1
+                    if learn_steps % args.sync_freq == 0:
+                        agent.sync_acting_net()
+                else:
+                    time.sleep(1e-4)
+
+                # Set tqdm description
+                if finished > t.n:
+                    for i in sorted(i for i in list(evaluations) if i not in reported):
+                        reward_buffer.append(evaluations[i][0])
+                        reported.add(i)
+                    t.update(finished - t.n)
+                    description = (
+                        f"[EP {t.n}/{episodes}] Reward: {np.mean(reward_buffer):,.4f}"
+                    )
+                    description += f" | Loss: {np.mean(loss_buffer):.4f}"
+                    description += f" | Epsilon: {agent.epsilon:.2f}"
+                    description += f" | Actors: {len(envs)}"
+                    description += f" | Learn steps: {learn_steps:,}"
+                    description += f" | Replay: {format_bytes(agent.replay_bytes())}"
+                    description += f" | Peak RSS: {format_bytes(peak_rss_bytes())}"
+                    t.set_description(description)
+
+        # Re-raise any exception from the actor threads
+        for actor in actors:
+            actor.result()
+
+    for actor_env in envs:
+        actor_env.close()
+
+    reward_list, running_values = merge_evaluations(
+        evaluations, episodes, env.running_values + env.running_values_done
+    )
+    write_manifest(args, seed, agent, running_values, [env])
+
+    return reward_list, running_values
+
+
+def run_vectorized(
+    k: int,
+    max_ep_len: int,
+    memory_capacity: int,
+    learn_freq: int,
+    device: torch.device | str,
+    args: Namespace,
+    seed=42,
+) -> tuple[list, dict]:
+    """Run the SAC training loop on several envs in worker processes at once.
+
+    The envs step in lockstep in a `SharedMemoryVecEnv`, so each round trains
+    `n_envs` episodes; the workers also generate the counterfactual transitions.
+    The agent takes `n_envs` learning steps every `learn_freq` steps to keep the
+    number of learning steps per transition, and is evaluated on a local env.
+
+    Args:
+        k (int): Number of regions.
+        max_ep_len (int): Maximum episode length.
+        memory_capacity (int): Memory capacity.
+        learn_freq (int): Frequency of learning.
+        device (torch.device | str): Device to run on.
+        args (Namespace): Arguments.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Returns:
+        tuple[list, dict]: List of rewards, dictionary of running values.
+    """
+    assert args.agent_type == "sac", "Vectorized envs are only supported for SAC"
+    from core.agents import SAC
+    from core.vec_env import SharedMemoryVecEnv
+
+    env = make_env(k, max_ep_len, args, seed)
+    _, cf_kwargs = get_replay_mode(args)
+    n_envs = args.n_envs
+    vec_env = SharedMemoryVecEnv(
+        [partial(make_env, k, max_ep_len, args, seed + j + 1) for j in range(n_envs)],
+        seed=seed,
+        n_counterfactuals=args.num_counterfactuals if args.counterfactual else 0,
+        cf_kwargs=cf_kwargs,
+    )
+
+    set_seed(seed)
+    agent = SAC(
+        env, args, memory_capacity, args.lr, device, args.net_arch, vec_env=vec_env
+    )
+    episodes = args.episodes
+
+    evaluations: dict[int, tuple[float, dict]] = {}
+    reward_buffer = deque(maxlen=100)
+    timer = PhaseTimer(args.timing)
+    profiler: EpisodeProfiler | None = None
+    if args.profile is not None:
+        root, name = get_results_path(args)
+        profiler = EpisodeProfiler(
+            args.profile,
+            f"{root}/{name}_profile_{seed}",
+            args.profile_start,
+            args.profile_episodes,
+        )
+    obs = vec_env.reset()
+    for first in (t := tqdm(range(0, episodes, n_envs))):
+        last = min(first + n_envs, episodes) - 1
+        # The profiled window is extended to whole rounds
+        if profiler is not None:
+            for i in range(first, last + 1):
+                profiler.start_episode(i)
+        step = 0
+        while True:
+            with timer.phase("act"):
+                actions = agent.choose_actions(obs)
+            with timer.phase("env"):
+                vec_env.step_async(actions)
+                next_obs, rewards, dones, _ = vec_env.step_wait()
+            timer.steps += n_envs
+            assert dones.all() or not dones.any(), "The episodes must end together"
+
+            # Store actual and counterfactual experiences
+            with timer.phase("store"):
+                agent.store_arrays(
+                    obs, actions, rewards, vec_env.next_observations(dones)
+                )
+            if args.counterfactual:
+                with timer.phase("counterfactual"):
+                    counterfactuals = vec_env.counterfactuals(actions)
+                with timer.phase("store"):
+                    agent.store_arrays(*counterfactuals)
+
+            # Learn
+            if step % learn_freq == 0:
+                with timer.phase("learn"):
+                    for _ in range(n_envs):
+                        agent.learn()
+            obs = next_obs
+            if dones.all():
+                break
+            step += 1
+
+        # Evaluate (when the round contains an evaluation episode and after the last one)
+        if (
+            last + 1
+        ) // args.eval_freq > first // args.eval_freq or last == episodes - 1:
+            with timer.phase("evaluate"):
+                evaluations[last] = evaluate(
+                    agent, env, args, device, args.eval_episodes
+                )
+            reward_buffer.append(evaluations[last][0])
+
+        description = f"[EP {last+1}/{episodes}] Reward: {np.mean(reward_buffer):,.4f}"
+        description += f" | Envs: {n_envs}"
+        description += f" | Buffer: {agent.model.replay_buffer.size() * n_envs:,}"
+        description += f" | Replay: {format_bytes(agent.replay_bytes())}"
+        description += f" | Peak RSS: {format_bytes(peak_rss_bytes())}"
+        if timer.enabled:
+            description += f" | {timer.describe()}"
+        t.set_description(description)
+        t.refresh()
+
+        if profiler is not None:
+            for i in range(first, last + 1):
+                profiler.end_episode(i)
+    if profiler is not None:
+        profiler.close()
+
+    reward_list, running_values = merge_evaluations(
+        evaluations, episodes, env.running_values + env.running_values_done
+    )
+
+    # Save the time spent in each phase next to the results
+    if timer.enabled:
+        root, name = get_results_path(args)
+        with open(f"{root}/{name}_timing_{seed}.json", "w") as f:
+            json.dump(timer.summary(), f, indent=2)
+
+    write_manifest(args, seed, agent, running_values, [env])
+    vec_env.close()
+    env.close()
+
+    return reward_list, running_values
+
+
+def run_ensemble(
+    k: int,
+    max_ep_len: int,
+    memory_capacity: int,
+    learn_freq: int,
+    device: torch.device | str,
+    args: Namespace,
+    seeds: list[int],
+) -> tuple[list[list], list[dict]]:
+    """Run the training loop for several seeds at once with a vmapped DQN ensemble.
+
+    Args:
+        k (int): Number of regions.
+        max_ep_len (int): Maximum episode length.
+        memory_capacity (int): Memory capacity (per member).
+        learn_freq (int): Frequency of learning.
+        device (torch.device | str): Device to run on.
+        args (Namespace): Arguments.
+        seeds (list[int]): Random seed of each member.
+
+    Returns:
+        tuple[list[list], list[dict]]: List of rewards and dictionary of running values for each seed.
+    """
+    assert args.agent_type == "dqn", "Ensembles are only supported for DQN"
+    from core.agents import EnsembleDQN
+
+    envs = [make_env(k, max_ep_len, args, seed) for seed in seeds]
+    memory_key, cf_kwargs = get_replay_mode(args)
+
+    set_seed(seeds[0])
+    num_states, num_actions = get_space_sizes(envs[0])
+
+    agent = EnsembleDQN(
+        envs,
+        num_states,
+        num_actions,
+        memory_capacity,
+        args.lr,
+        device,
+        args,
+        args.net_arch,
+        seeds=seeds,
+    )
+    members = len(envs)
+    episodes = args.episodes
+
+    # Evaluations of each member by episode index
+    evaluations: list[dict[int, tuple[float, dict]]] = [{} for _ in range(members)]
+
+    reward_buffer = deque(maxlen=100)
+    loss_buffer = deque(maxlen=100)
+    timer = PhaseTimer(args.timing)
+    profiler: EpisodeProfiler | None = None
+    if args.profile is not None:
+        root, name = get_results_path(args)
+        profiler = EpisodeProfiler(
+            args.profile,
+            f"{root}/{name}_profile_{seeds[0]}-{seeds[-1]}",
+            args.profile_start,
+            args.profile_episodes,
+        )
+
+    for i in (t := tqdm(range(episodes))):
+        if profiler is not None:
+            profiler.start_episode(i)
+        obs, states, memories = [], [], []
+        for env, member_seed in zip(envs, seeds):
+            obs_m, info = env.reset(seed=get_episode_seed(args, member_seed, i))
+            obs.append(obs_m)
+            states.append(info["state"].copy())
+            memories.append(info[memory_key].copy())
+        step = 0
+
+        while True:
+            # Take a step in every member's env
+            with timer.phase("act"):
+                actions = agent.choose_action(np.stack(obs))
+            done = False
+            for m, env in enumerate(envs):
+                # Store info for CF update
+                schedule_step = env.current_step
+                actual_state = env.state.copy()
+                actual_memory = env.memory.copy()
+
+                with timer.phase("env"):
+                    next_obs, reward, done, _, info = env.step(actions[m])
+                timer.steps += 1
+                next_state = info["state"].copy()
+                next_memory = info[memory_key].copy()
+
+                # Store actual experience
+                with timer.phase("store"):
+                    agent.store_transition(
+                        m,
+                        states[m],
+                        memories[m],
+                        actions[m],
+                        reward,
+                        next_state,
+                        next_memory,
+                    )
+
+                # Store counterfactual experiences
+                if args.counterfactual:
+                    with timer.phase("counterfactual"):
+                        cf_transitions = env.get_counterfactual_transitions(
+                            states[m],
+                            actual_state,
+                            actions[m],
+                            actual_memory,
+                            schedule_step,
+                            args.num_counterfactuals,
+                            **cf_kwargs,
+                        )
+                    with timer.phase("store"):
+                        for transition in cf_transitions:
+                            agent.store_transition(m, *transition)
+
+                # Transition to next state
+                obs[m] = next_obs
+                states[m] = next_state
+                memories[m] = next_memory
+
+            # Learn
+            if step % learn_freq == 0:
+                with timer.phase("learn"):
+                    loss = agent.learn()
+                loss_buffer.append(loss.mean())
+            if done:
+                break
+            step += 1
+
+        # Update epsilon
+        agent.decay_epsilon()
+
+        # Evaluate (every eval_freq episodes and after the last one)
+        if (i + 1) % args.eval_freq == 0 or i == episodes - 1:
+            with timer.phase("evaluate"):
+                results = evaluate_ensemble(agent, envs, args.eval_episodes)
+            for m, result in enumerate(results):
+                evaluations[m][i] = result
+            reward_buffer.append(np.mean([reward for reward, _ in results]))
+
+        # Set tqdm description
+        description = f"[EP {i+1}/{episodes}] Reward: {np.mean(reward_buffer):,.4f}"
+        description += f" | Loss: {np.mean(loss_buffer):.4f}"
+        description += f" | Epsilon: {agent.epsilon.mean():.2f}"
+        description += f" | Members: {members}"
+        description += f" | Replay: {format_bytes(agent.replay_bytes())}"
+        description += f" | Peak RSS: {format_bytes(peak_rss_bytes())}"
+        if timer.enabled:
+            description += f" | {timer.describe()}"
+        t.set_description(description)
+        t.refresh()
+
+        if profiler is not None:
+            profiler.end_episode(i)
+    if profiler is not None:
+        profiler.close()
+
+    reward_lists: list[list] = []
+    running_values_list: list[dict] = []
+    for env, member_evaluations in zip(envs, evaluations):
+        reward_list, running_values = merge_evaluations(
+            member_evaluations, episodes, env.running_values + env.running_values_done
+        )
+        reward_lists.append(reward_list)
+        running_values_list.append(running_values)
+
+    # Save the time spent in each phase next to the results
+    if timer.enabled:
+        root, name = get_results_path(args)
+        with open(f"{root}/{name}_timing_{seeds[0]}-{seeds[-1]}.json", "w") as f:
+            json.dump(timer.summary(), f, indent=2)
+
+    write_manifest(args, seeds, agent, running_values_list, envs)
+    for env in envs:
+        env.close()
+
+    return reward_lists, running_values_list
+
+
+def get_results_path(args: Namespace) -> tuple[str, str]:
+    """Get the directory of the results and the name of the configuration.
+
+    Args:
+        args (Namespace): Arguments.
+
+    Returns:
+        tuple[str, str]: Results directory, configuration name (prefix of the result files).
+    """
+    name = args.state_mode.capitalize()
+    if args.counterfactual:
+        if args.agent_type in ["sac", "random_cont"]:
+            name = f"FairSCM ({name})"
+        else:
+            name = f"FairQCM ({name})"
+    if args.agent_type == "random":
+        name = "Random"
+    if args.agent_type == "random_cont":
+        name = "Random"
+    if args.novax:
+        name = "NoVax"
+    if args.net_type == "rnn":
+        name = "RNN"
+    if args.root == "datasets/":
+        root = f"datasets/{args.env_type}/"
+    else:
+        root = args.root
+
+    return root, name
+
+
+def write_manifest(
+    args: Namespace,
+    seed: int | list[int],
+    agent: Agent | EnsembleDQN,
+    running_values: dict | list[dict],
+    envs: list[Env],
+) -> None:
+    """Write the manifest of a run (configuration, memory usage and cache hit rates) next to the results (with -manifest).
+
+    Args:
+        args (Namespace): Arguments.
+        seed (int | list[int]): Random seed (or seeds of an ensemble).
+        agent (Agent | EnsembleDQN): The trained agent.
+        running_values (dict | list[dict]): The running values of the run.
+        envs (list[Env]): The envs of the run (in this process).
+    """
+    if not args.manifest:
+        return
+    root, name = get_results_path(args)
+    suffix = seed if isinstance(seed, int) else f"{seed[0]}-{seed[-1]}"
+    manifest = {
+        "config": name,
+        "seed": seed,
+        "args": vars(args),
+        "memory": {
+            "replay_bytes": agent.replay_bytes(),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "running_values_bytes": object_bytes(running_values),
+        },
+    }
+    caches = [env.memory_cache for env in envs if hasattr(env, "memory_cache")]
+    if caches:
+        hits = sum(cache.hits for cache in caches)
+        misses = sum(cache.misses for cache in caches)
+        manifest["memory_cache"] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.0,
+        }
+    with open(f"{root}/{name}_manifest_{suffix}.json", "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+
+
+def save_data(
+    num_exps: int,
+    reward_list_all: list,
+    running_values_list_all: list,
+    args: Namespace,
+) -> None:
+    """Save the training curves to a CSV file.
+
+    Args:
+        num_exps (int): Number of experiments.
+        reward_list_all (list): List of rewards for each experiment.
+        running_values_list_all (list): List of running values for each experiment.
+        args (Namespace): Arguments.
+    """
+
+    root, name = get_results_path(args)
+    rewards_dataset_path = f"{root}/{name}_reward.csv"
+    with open(rewards_dataset_path, "w", newline="") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        for i in range(num_exps):
+            csv_writer.writerow(reward_list_all[i])
+
+    keys = running_values_list_all[0].keys()
+    for key in keys:
+        arr = np.array([running_values_list_all[i][key] for i in range(num_exps)])
+        pickle.dump(arr, open(f"{root}/{name}_{key}.pkl", "wb"))
+
+
+def prepare_args(args: Namespace) -> None:
+    """Parse the comma-separated list arguments (in place).
+
+    Args:
+        args (Namespace): Arguments.
+    """
+    if args.d_param1 and args.d_param2:
+        args.d_param1 = [float(x) for x in args.d_param1.split(",")]
+        args.d_param2 = [float(x) for x in args.d_param2.split(",")]
+    if args.p:
+        args.p = [float(x) for x in args.p.split(",")]
+    if args.groups:
+        args.groups = [int(x) for x in args.groups.split(",")]
+        if len(args.groups) == 1:
+            # A number of groups
+            args.groups = args.groups[0]
+
+
+def get_run_settings(args: Namespace) -> tuple[int, int, int]:
+    """Get the episode length, replay memory capacity and learning frequency of a run.
+
+    Args:
+        args (Namespace): Arguments.
+
+    Returns:
+        tuple[int, int, int]: Episode length, memory capacity, learning frequency.
+    """
+    learn_freq = 5
+    if args.env_type == "donut":
+        max_ep_len = 100
+        memory_capacity = 400
+        learn_freq = 1
+        if args.counterfactual:
+            memory_capacity = 6400
+        elif args.net_type == "rnn":
+            memory_capacity = 1000
+    elif args.env_type == "lending":
+        max_ep_len = 40
+        memory_capacity = 1000
+        if args.net_type == "rnn":
+            memory_capacity = 2000
+        if args.counterfactual:
+            memory_capacity = 8000
+    else:
+        max_ep_len = 24
+        memory_capacity = 5_000 * (
+            args.num_counterfactuals if args.counterfactual else 1
+        )
+        if args.net_type == "rnn":
+            memory_capacity = 10_000
+
+    return max_ep_len, memory_capacity, learn_freq
+
+
+def get_run_fn(args: Namespace) -> Callable[..., tuple[list, dict]]:
+    """Get the training loop of an experiment (not for ensembles).
+
+    Args:
+        args (Namespace): Arguments.
+
+    Returns:
+        Callable[..., tuple[list, dict]]: The training loop.
+    """
+    run_fn = run
+    if args.offline is not None:
+        run_fn = run_offline
+    elif args.actors > 0:
+        run_fn = run_actor_learner
+    elif args.n_envs > 1:
+        run_fn = run_vectorized
+    assert (
+        args.record is None or run_fn is run
+    ), "Recording is only supported by the standard training loop"
+    assert (
+        not args.async_eval or run_fn is run
+    ), "Asynchronous evaluation is only supported by the standard training loop"
+    assert (
+        args.cf_workers == 0 or run_fn is run
+    ), "Counterfactual workers are only supported by the standard training loop"
+    assert (
+        not args.timing or run_fn is not run_actor_learner
+    ), "Phase timing is not supported with concurrent actors"
+    assert (
+        args.profile is None or run_fn is not run_actor_learner
+    ), "Profiling is not supported with concurrent actors"
+    return run_fn
+
+
+def submit_jobs(queue: JobQueue, argv: list[str]) -> list[str]:
+    """Add a job per experiment (seed) of a configuration to a queue.
+
+    Args:
+        queue (JobQueue): The queue.
+        argv (list[str]): main.py arguments of the configuration.
+
+    Returns:
+        list[str]: The ids of the added jobs (jobs already in the queue are skipped).
+    """
+    args = get_parser().parse_args(argv)
+    assert not args.ensemble, "Ensembles train all the seeds in one job"
+    config = hashlib.sha1(json.dumps(argv).encode()).hexdigest()[:12]
+    seeds = [SEED + i + 1 for i in range(args.num_exps)]
+    added = []
+    for seed in seeds:
+        job = {"id": f"{config}-{seed}", "config": config, "argv": argv}
+        job.update({"seed": seed, "seeds": seeds})
+        if queue.submit(job):
+            added.append(job["id"])
+    return added
+
+
+def run_job(job: dict) -> tuple[list, dict]:
+    """Run the experiment of a job.
+
+    Args:
+        job (dict): The job.
+
+    Returns:
+        tuple[list, dict]: List of rewards, dictionary of running values.
+    """
+    args = get_parser().parse_args(job["argv"])
+    prepare_args(args)
+    max_ep_len, memory_capacity, learn_freq = get_run_settings(args)
+    return get_run_fn(args)(
+        k=3,
+        max_ep_len=max_ep_len,
+        memory_capacity=memory_capacity,
+        learn_freq=learn_freq,
+        device=args.device,
+        args=args,
+        seed=job["seed"],
+    )
 
-            obs = next_obs
-            state = next_state
-            memory = next_memory
-            if done:
-                for key in env.running_values_done:
-                    running_values[key].append(info[key])
-                break
 
-        reward_list.append(ep_reward)
-        reward_buffer.append(ep_reward)
+def save_job_results(queue: JobQueue, job: dict) -> bool:
+    """Save the results of a configuration once all its jobs are done.
 
-        # Set tqdm description
-        description = f"[EP {i+1}/{episodes}] Reward: {np.mean(reward_buffer):,.4f}"
-        if type(agent) == DQN:
-            description += f" | Loss: {np.mean(loss_buffer):.4f}"
-        if type(agent) == DQN:
-            description += f" | Epsilon: {agent.epsilon:.2f}"
-        if type(agent) == DQN:
-            description += f" | LR: {agent.optimizer.param_groups[0]['lr']:.7f}"
-        if type(agent) == SAC:
-            description += f" | Buffer: {agent.model.replay_buffer.size():,}"
-        t.set_description(description)
-        t.refresh()
+    The results are saved like a run of main.py (see `save_data`) by the worker
+    that finishes the last job.
 
-    env.close()
+    Args:
+        queue (JobQueue): The queue.
+        job (dict): A finished job of the configuration.
 
-    return reward_list, running_values
+    Returns:
+        bool: Whether the results were saved.
+    """
+    job_ids = [f"{job['config']}-{seed}" for seed in job["seeds"]]
+    if any(queue.state(job_id) != "done" for job_id in job_ids):
+        return False
+    if not queue.lock(f"{job['config']}.saved"):
+        return False
+    results = [queue.result(job_id) for job_id in job_ids]
+    args = get_parser().parse_args(job["argv"])
+    prepare_args(args)
+    save_data(
+        len(results),
+        [reward_list for reward_list, _ in results],
+        [running_values for _, running_values in results],
+        args,
+    )
+    return True
 
 
-def save_data(
-    num_exps: int,
-    reward_list_all: list,
-    running_values_list_all: list,
-    args: Namespace,
-) -> None:
-    """Save the training curves to a CSV file.
+def work(
+    queue: JobQueue, heartbeat: float = 30.0, poll: float = 10.0, wait: bool = False
+) -> int:
+    """Run the jobs of a queue until none is left.
 
     Args:
-        num_exps (int): Number of experiments.
-        reward_list_all (list): List of rewards for each experiment.
-        running_values_list_all (list): List of running values for each experiment.
-        args (Namespace): Arguments.
+        queue (JobQueue): The queue.
+        heartbeat (float, optional): Seconds between the heartbeats of the running job. Defaults to 30.0.
+        poll (float, optional): Seconds between checks when no job is pending. Defaults to 10.0.
+        wait (bool, optional): Whether to keep waiting for new jobs when the queue is empty. Defaults to False.
+
+    Returns:
+        int: Number of jobs run.
     """
+    from core.jobqueue import Heartbeat
 
-    name = args.state_mode.capitalize()
-    if args.counterfactual:
-        if args.agent_type in ["sac", "random_cont"]:
-            name = f"FairSCM ({name})"
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    count = 0
+    while True:
+        for job_id in queue.requeue_stale():
+            print(f"Requeued stale job {job_id}")
+        job = queue.claim(worker)
+        if job is None:
+            # Stay while jobs run elsewhere, they are requeued if their worker dies
+            if wait or queue.jobs("running") or queue.jobs("pending"):
+                time.sleep(poll)
+                continue
+            return count
+
+        print(f"[{worker}] Job {job['id']} (attempt {job['attempts']}): {job['argv']}")
+        try:
+            with Heartbeat(queue, job["id"], heartbeat):
+                result = run_job(job)
+        except Exception:
+            queue.fail(job, traceback.format_exc())
+            print(f"[{worker}] Job {job['id']} failed")
         else:
-            name = f"FairQCM ({name})"
-    if args.agent_type == "random":
-        name = "Random"
-    if args.agent_type == "random_cont":
-        name = "Random"
-    if args.novax:
-        name = "NoVax"
-    if args.net_type == "rnn":
-        name = "RNN"
-    if args.root == "datasets/":
-        root = f"datasets/{args.env_type}/"
+            queue.complete(job, result)
+            if save_job_results(queue, job):
+                print(f"[{worker}] Saved the results of {job['config']}")
+        count += 1
+
+
+def get_queue_parser() -> argparse.ArgumentParser:
+    """Create the parser of the job queue commands (`python main.py submit|worker|status`).
+
+    Returns:
+        argparse.ArgumentParser: The argument parser.
+    """
+    prs = argparse.ArgumentParser(
+        prog="main.py",
+        description="Job queue in a shared directory: submit the experiments of a configuration as (config, seed) jobs and run them with any number of workers on any hosts sharing the directory",
+    )
+    commands = prs.add_subparsers(dest="command", required=True)
+    submit = commands.add_parser("submit", help="Submit a job per seed")
+    submit.add_argument("--queue", required=True, help="Queue directory")
+    submit.add_argument(
+        "main_args", nargs=argparse.REMAINDER, help="main.py arguments after --"
+    )
+    worker = commands.add_parser("worker", help="Run jobs until the queue is empty")
+    worker.add_argument("--queue", required=True, help="Queue directory")
+    worker.add_argument(
+        "--timeout",
+        type=float,
+        default=600.0,
+        help="Seconds without a heartbeat before a job is requeued",
+    )
+    worker.add_argument(
+        "--heartbeat", type=float, default=30.0, help="Seconds between heartbeats"
+    )
+    worker.add_argument(
+        "--attempts", type=int, default=3, help="Claims of a job before it fails"
+    )
+    worker.add_argument(
+        "--poll", type=float, default=10.0, help="Seconds between queue checks"
+    )
+    worker.add_argument(
+        "--wait", action="store_true", help="Keep waiting when the queue is empty"
+    )
+    status = commands.add_parser("status", help="Count the jobs in each state")
+    status.add_argument("--queue", required=True, help="Queue directory")
+    return prs
+
+
+def queue_main(argv: list[str]) -> None:
+    from core.jobqueue import JobQueue
+
+    args = get_queue_parser().parse_args(argv)
+    if args.command == "worker":
+        queue = JobQueue(args.queue, args.timeout, args.attempts)
+        count = work(queue, args.heartbeat, args.poll, args.wait)
+        print(f"Ran {count} jobs")
+    elif args.command == "submit":
+        main_args = args.main_args
+        if main_args and main_args[0] == "--":
+            main_args = main_args[1:]
+        added = submit_jobs(JobQueue(args.queue), main_args)
+        print(f"Submitted {len(added)} jobs")
     else:
-        root = args.root
-    rewards_dataset_path = f"{root}/{name}_reward.csv"
-    with open(rewards_dataset_path, "w", newline="") as csv_file:
-        csv_writer = csv.writer(csv_file)
-        for i in range(num_exps):
-            csv_writer.writerow(reward_list_all[i])
+        queue = JobQueue(args.queue)
+        print(queue.counts())
+        for job_id in queue.jobs("failed"):
+            error = queue.job("failed", job_id).get("error", "").strip()
+            print(f"Failed {job_id}: {error.splitlines()[-1] if error else ''}")
 
-    keys = running_values_list_all[0].keys()
-    for key in keys:
-        arr = np.array([running_values_list_all[i][key] for i in range(num_exps)])
-        pickle.dump(arr, open(f"{root}/{name}_{key}.pkl", "wb"))
 
+def get_parser() -> argparse.ArgumentParser:
+    """Create the command line argument parser.
 
-if __name__ == "__main__":
+    Returns:
+        argparse.ArgumentParser: The argument parser.
+    """
     prs = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description="""Fair Covid""",
@@ -442,12 +1765,30 @@ if __name__ == "__main__":
         required=False,
         help="Number of counterfactual experiences to generate per step\n",
     )
+    prs.add_argument(
+        "-cfworkers",
+        dest="cf_workers",
+        type=int,
+        default=0,
+        required=False,
+        help="Number of workers generating the counterfactual experiences asynchronously (0 generates them in the step loop, standard training loop only)\n",
+    )
+    prs.add_argument(
+        "-cfexecutor",
+        dest="cf_executor",
+        type=str,
+        default="process",
+        choices=["process", "thread"],
+        required=False,
+        help="Whether the counterfactual workers are processes or threads\n",
+    )
     prs.add_argument(
         "-agent",
         dest="agent_type",
         type=str,
         default="dqn",
         required=False,
+        choices=list(AGENTS),
         help="Agent type\n",
     )
     prs.add_argument(
@@ -470,7 +1811,7 @@ if __name__ == "__main__":
         "-env",
         dest="env_type",
         type=str,
-        choices=["donut", "lending", "covid"],
+        choices=list(ENVS),
         required=True,
         help="Environment Type\n",
     )
@@ -516,6 +1857,39 @@ if __name__ == "__main__":
         choices=["logistic", "bell", "uniform-interval"],
         help="Distribution\n",
     )
+    prs.add_argument(
+        "-people",
+        dest="people",
+        type=int,
+        default=None,
+        required=False,
+        help="Number of people (donut: 5 by default, lending: 4 by default)\n",
+    )
+    prs.add_argument(
+        "-groups",
+        dest="groups",
+        type=str,
+        default=None,
+        required=False,
+        help="Group of each applicant as a comma-separated list of ints, or a number of contiguous groups (lending only, by default the first half is group 0 and the rest group 1)\n",
+    )
+    prs.add_argument(
+        "-menc",
+        dest="memory_encoding",
+        type=str,
+        default="binary",
+        choices=["binary", "counts", "quantiles"],
+        required=False,
+        help="Memory encoding of the observations: bits of each count, normalized counts or quantiles of the normalized counts (donut only)\n",
+    )
+    prs.add_argument(
+        "-sparse",
+        dest="sparse_arrivals",
+        type=bool,
+        default=False,
+        required=False,
+        help="Draw the indices of the arriving customers with vectorized sampling instead of a uniform number per person (donut only). Observations and replay stay dense, the indices are only in info['present']\n",
+    )
     prs.add_argument(
         "-d1",
         dest="d_param1",
@@ -544,12 +1918,16 @@ if __name__ == "__main__":
         "-rt",
         "--reward_type",
         type=str,
-        default="nsw",
-        choices=["nsw", "utilitarian", "rawlsian", "egalitarian", "gini", "rdp"],
+        default=None,
+        choices=list(AGGREGATIONS),
         help="Select the reward function to use: 'nsw' for Nash Social Welfare, "
         "'utilitarian' for Utilitarian Welfare, 'rawlsian' for Rawlsian Welfare, "
         "'egalitarian' for Egalitarian Welfare, "
-        "or 'gini' for Gini Coefficient based Social Welfare.",
+        "'gini' for Gini Coefficient based Social Welfare, "
+        "'rdp' for Relaxed Demographic Parity (two groups) "
+        "or 'parity' for Demographic Parity over any number of groups. "
+        "Defaults to 'nsw' for donut and covid, and to 'rdp' (two groups) or "
+        "'parity' for lending.",
     )
     prs.add_argument(
         "-root",
@@ -567,7 +1945,191 @@ if __name__ == "__main__":
         required=False,
         help="Dynamic probability adjustment\n",
     )
-    args = prs.parse_args()
+    prs.add_argument(
+        "-compile",
+        dest="compile",
+        type=bool,
+        default=False,
+        required=False,
+        help="Compile the policy networks and the DQN learning step\n",
+    )
+    prs.add_argument(
+        "-ensemble",
+        dest="ensemble",
+        type=bool,
+        default=False,
+        required=False,
+        help="Train all experiments at once as a vmapped DQN ensemble\n",
+    )
+    prs.add_argument(
+        "-actors",
+        dest="actors",
+        type=int,
+        default=0,
+        required=False,
+        help="Number of actor threads running concurrently with the learner (0: sequential)\n",
+    )
+    prs.add_argument(
+        "-nenvs",
+        dest="n_envs",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of envs stepped in parallel worker processes (SAC only, 1: a single env in the main process)\n",
+    )
+    prs.add_argument(
+        "-record",
+        dest="record",
+        type=str,
+        default=None,
+        required=False,
+        help="Record the actual and counterfactual transitions of each experiment in memory-mapped .npy shards in <dir>/seed_<seed> (standard training loop only)\n",
+    )
+    prs.add_argument(
+        "-shardsize",
+        dest="shard_size",
+        type=int,
+        default=65_536,
+        required=False,
+        help="Transitions per recorded shard\n",
+    )
+    prs.add_argument(
+        "-offline",
+        dest="offline",
+        type=str,
+        default=None,
+        required=False,
+        help="Train DQN on a dataset recorded with -record (a recording or a directory of recordings per seed) instead of stepping the env, counterfactual transitions are only used with -cf\n",
+    )
+    prs.add_argument(
+        "-rr",
+        dest="replay_ratio",
+        type=float,
+        default=None,
+        required=False,
+        help="Gradient steps per env step in actor/learner mode (default: 1 / learn frequency)\n",
+    )
+    prs.add_argument(
+        "-sync",
+        dest="sync_freq",
+        type=int,
+        default=100,
+        required=False,
+        help="Gradient steps between acting weight syncs in actor/learner mode\n",
+    )
+    prs.add_argument(
+        "-evalfreq",
+        dest="eval_freq",
+        type=int,
+        default=1,
+        required=False,
+        help="Training episodes between evaluations (episodes in between repeat the latest evaluation, episodes before the first one are NaN)\n",
+    )
+    prs.add_argument(
+        "-evaleps",
+        dest="eval_episodes",
+        type=int,
+        default=1,
+        required=False,
+        help="Greedy episodes per evaluation\n",
+    )
+    prs.add_argument(
+        "-asynceval",
+        dest="async_eval",
+        type=bool,
+        default=False,
+        required=False,
+        help="Run evaluations on weight snapshots in a worker process while training continues (standard training loop only)\n",
+    )
+    prs.add_argument(
+        "-exact",
+        dest="exact",
+        type=bool,
+        default=False,
+        required=False,
+        help="Compute the exact expected return of each final policy and the optimal return (donut only)\n",
+    )
+    prs.add_argument(
+        "-incr",
+        dest="incremental_reward",
+        type=bool,
+        default=False,
+        required=False,
+        help="Update the welfare reward incrementally instead of aggregating the whole memory each step (donut and lending)\n",
+    )
+    prs.add_argument(
+        "-rawreplay",
+        dest="raw_replay",
+        type=bool,
+        default=False,
+        required=False,
+        help="Store raw memories in the replay memory and encode them and compute the rewards at sample time (donut with DQN)\n",
+    )
+    prs.add_argument(
+        "-envrng",
+        dest="env_rng",
+        type=bool,
+        default=False,
+        required=False,
+        help="Draw the arrivals (and repayments) from a generator of the env seeded per episode instead of the global random module (donut and lending)\n",
+    )
+    prs.add_argument(
+        "-predraw",
+        dest="predraw",
+        type=bool,
+        default=False,
+        required=False,
+        help="Draw the arrivals of a whole episode at reset (requires -envrng)\n",
+    )
+    prs.add_argument(
+        "-timing",
+        dest="timing",
+        type=bool,
+        default=False,
+        required=False,
+        help="Time each phase of the training loop (shown in the progress bar and saved per seed next to the results, not with -actors)\n",
+    )
+    prs.add_argument(
+        "-manifest",
+        dest="manifest",
+        type=bool,
+        default=False,
+        required=False,
+        help="Save a manifest per seed next to the results (arguments, replay buffer bytes, peak RSS, running value size and memory cache hit rate)\n",
+    )
+    prs.add_argument(
+        "-profile",
+        dest="profile",
+        type=str,
+        default=None,
+        required=False,
+        choices=["cprofile", "torch"],
+        help="Profile a window of episodes with cProfile (.prof) or torch.profiler (Chrome trace .json), saved per seed next to the results (not with -actors)\n",
+    )
+    prs.add_argument(
+        "-profstart",
+        dest="profile_start",
+        type=int,
+        default=0,
+        required=False,
+        help="First episode (0-indexed) of the profiled window\n",
+    )
+    prs.add_argument(
+        "-profeps",
+        dest="profile_episodes",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of profiled episodes\n",
+    )
+    return prs
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] in [["submit"], ["worker"], ["status"]]:
+        queue_main(sys.argv[1:])
+        sys.exit()
+    args = get_parser().parse_args()
 
     # reward_t, donut_t, rewards_to_plot, infected_records = run(
     #     k=3, max_ep_len=10, memory_capacity=400, args=args
@@ -575,54 +2137,50 @@ if __name__ == "__main__":
     # plot_mean_and_std(np.expand_dims(rewards_to_plot, axis=-1), "rewards")
     # plot_mean_and_std(infected_records, "infected_records")
 
-    seed = 2024
+    seed = SEED
     num_exps = args.num_exps
-    learn_freq = 5
     reward_list = []
     running_values_list = []
-    if args.d_param1 and args.d_param2:
-        args.d_param1 = [float(x) for x in args.d_param1.split(",")]
-        args.d_param2 = [float(x) for x in args.d_param2.split(",")]
-    if args.p:
-        args.p = [float(x) for x in args.p.split(",")]
-    if args.env_type == "donut":
-        max_ep_len = 100
-        memory_capacity = 400
-        learn_freq = 1
-        if args.counterfactual:
-            memory_capacity = 6400
-        elif args.net_type == "rnn":
-            memory_capacity = 1000
-    elif args.env_type == "lending":
-        max_ep_len = 40
-        memory_capacity = 1000
-        if args.net_type == "rnn":
-            memory_capacity = 2000
-        if args.counterfactual:
-            memory_capacity = 8000
-    else:
-        max_ep_len = 24
-        memory_capacity = 5_000 * (
-            args.num_counterfactuals if args.counterfactual else 1
-        )
-        if args.net_type == "rnn":
-            memory_capacity = 10_000
+    prepare_args(args)
+    max_ep_len, memory_capacity, learn_freq = get_run_settings(args)
     device = args.device
-    for i in range(num_exps):
-        print(f"Experiment {i+1}/{num_exps}")
-        experiment_seed = seed + i + 1
-        reward_t, running_values_t = run(
+    if args.ensemble:
+        assert args.record is None and args.offline is None
+        assert not args.async_eval, "Ensembles evaluate synchronously"
+        assert (
+            args.cf_workers == 0
+        ), "Ensembles generate counterfactuals in the step loop"
+        print(f"Experiments 1-{num_exps}/{num_exps} (ensemble)")
+        reward_list, running_values_list = run_ensemble(
             k=3,
             max_ep_len=max_ep_len,
             memory_capacity=memory_capacity,
             learn_freq=learn_freq,
             device=device,
             args=args,
-            seed=experiment_seed,
+            seeds=[seed + i + 1 for i in range(num_exps)],
         )
-        reward_list.append(reward_t)
-        running_values_list.append(running_values_t)
+    else:
+        for i in range(num_exps):
+            print(f"Experiment {i+1}/{num_exps}")
+            experiment_seed = seed + i + 1
+            reward_t, running_values_t = get_run_fn(args)(
+                k=3,
+                max_ep_len=max_ep_len,
+                memory_capacity=memory_capacity,
+                learn_freq=learn_freq,
+                device=device,
+                args=args,
+                seed=experiment_seed,
+            )
+            reward_list.append(reward_t)
+            running_values_list.append(running_values_t)
     save_data(num_exps, reward_list, running_values_list, args)
+    if args.exact:
+        from core.dp import DonutDP
+
+        optimal_return = DonutDP(make_env(3, max_ep_len, args, seed)).solve()
+        print(f"Optimal expected return: {optimal_return:,.4f}")
 
     # print(infected_records[-1][-1])
     # k = 3
@@ -0,0 +1,245 @@
+"""Hyperparameter sweeps with asynchronous successive halving (ASHA).
+
+Every combination of the swept values of main.py flags is a trial. The trials run in
+parallel worker processes, and at each rung (min_episodes * eta^i episodes) a trial
+only keeps training if its mean evaluation reward is in the top 1/eta of the rewards
+recorded at that rung so far. Stopped trials keep the results of the episodes they
+played. The flags after `--` are the (fixed) main.py arguments of every trial:
+
+    python sweep.py --param lr=0.001,0.0001 --param "arch=32 16 8,64 64" \\
+        --min-episodes 50 --eta 3 --workers 4 -- -env donut -cf True -ep 500 -root sweeps/
+
+With -nexp the first seed of a trial (SEED + 1) is compared at the rungs, and the
+trials that complete it also train the other seeds. Trials are ranked by the mean over
+their seeds of the windowed mean reward that the rungs compare. Each trial saves its
+results in a trial_<n> directory of the root and the ranking of the trials is saved as
+sweep.json.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.managers import DictProxy
+from threading import Lock
+
+import numpy as np
+
+from main import (
+    SEED,
+    get_parser,
+    get_run_fn,
+    get_run_settings,
+    prepare_args,
+    run,
+    run_offline,
+    save_data,
+)
+
+
+def get_rungs(min_episodes: int, eta: int, episodes: int) -> list[int]:
+    """Get the episodes at which the trials are compared.
+
+    Args:
+        min_episodes (int): Episodes of the first rung.
+        eta (int): Reduction factor between rungs.
+        episodes (int): Maximum number of episodes of a trial.
+
+    Returns:
+        list[int]: The rungs (numbers of episodes played).
+    """
+    rungs = []
+    rung = min_episodes
+    while rung < episodes:
+        rungs.append(rung)
+        rung *= eta
+    return rungs
+
+
+class ASHAStopper:
+    """Stops a trial at a rung unless its reward is in the top 1/eta of the rung.
+
+    The rewards of the rungs are shared by the trials (through a manager), so the
+    decisions of a trial depend on the trials that reached the rung before it. The
+    last reward it was called with is kept (also when disabled) to rank the trials.
+    """
+
+    def __init__(
+        self, rungs: list[int], eta: int, recorded: DictProxy, lock: Lock
+    ) -> None:
+        """Create the stopper of a trial.
+
+        Args:
+            rungs (list[int]): The rungs.
+            eta (int): Reduction factor between rungs.
+            recorded (DictProxy): Rewards recorded at each rung.
+            lock (Lock): Lock of the recorded rewards.
+        """
+        self.rungs = rungs
+        self.eta = eta
+        self.recorded = recorded
+        self.lock = lock
+        self.reached: list[int] = []
+        self.enabled = True
+        self.last_reward = np.nan
+
+    def __call__(self, episode: int, reward: float) -> bool:
+        self.last_reward = reward
+        rung = episode + 1
+        if not self.enabled or rung not in self.rungs or np.isnan(reward):
+            return False
+        with self.lock:
+            rewards = self.recorded.get(rung, []) + [reward]
+            self.recorded[rung] = rewards
+        self.reached.append(rung)
+        cutoff = np.percentile(rewards, (1 - 1 / self.eta) * 100)
+        return reward < cutoff
+
+
+def run_trial(
+    trial: int, argv: list[str], params: dict[str, str], stopper: ASHAStopper
+) -> dict:
+    """Train the seeds of a trial until they finish or the first one is stopped at a rung, and save the results.
+
+    Args:
+        trial (int): Index of the trial.
+        argv (list[str]): main.py arguments of the trial.
+        params (dict[str, str]): The swept values of the trial.
+        stopper (ASHAStopper): The stopper of the trial.
+
+    Returns:
+        dict: Summary of the trial.
+    """
+    args = get_parser().parse_args(argv)
+    prepare_args(args)
+    run_fn = get_run_fn(args)
+    assert run_fn in [run, run_offline], "Only run and run_offline can be stopped"
+    max_ep_len, memory_capacity, learn_freq = get_run_settings(args)
+    reward_lists, running_values_list, rewards = [], [], []
+    for j in range(args.num_exps):
+        reward_list, running_values = run_fn(
+            k=3,
+            max_ep_len=max_ep_len,
+            memory_capacity=memory_capacity,
+            learn_freq=learn_freq,
+            device=args.device,
+            args=args,
+            seed=SEED + j + 1,
+            stop=stopper,
+        )
+        reward_lists.append(reward_list)
+        running_values_list.append(running_values)
+        rewards.append(stopper.last_reward)
+        if len(reward_list) < args.episodes:
+            break
+        # The other seeds of a trial that reached the end are not compared
+        stopper.enabled = False
+    save_data(len(reward_lists), reward_lists, running_values_list, args)
+    return {
+        "trial": trial,
+        "params": params,
+        "root": args.root,
+        "episodes": sum(len(reward_list) for reward_list in reward_lists),
+        "seeds": len(reward_lists),
+        "completed": len(reward_lists[-1]) == args.episodes,
+        "rungs": stopper.reached,
+        "reward": float(np.mean(rewards)),
+    }
+
+
+def get_trials(params: list[str]) -> list[dict[str, str]]:
+    """Get every combination of the swept values.
+
+    Args:
+        params (list[str]): "flag=value,value,..." specifications (flags without the dash).
+
+    Returns:
+        list[dict[str, str]]: The values of each trial by flag.
+    """
+    names, values = [], []
+    for param in params:
+        name, _, spec = param.partition("=")
+        names.append(name.lstrip("-"))
+        values.append(spec.split(","))
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def sweep(args: argparse.Namespace, base_argv: list[str]) -> list[dict]:
+    """Run the trials of a sweep and save their ranking.
+
+    Args:
+        args (argparse.Namespace): Arguments of the sweep.
+        base_argv (list[str]): main.py arguments shared by the trials.
+
+    Returns:
+        list[dict]: Summaries of the trials, completed trials first, best first.
+    """
+    base = get_parser().parse_args(base_argv)
+    assert (
+        base.actors == 0 and base.n_envs <= 1 and not base.ensemble
+    ), "Actor/learner, vectorized and ensemble runs cannot be stopped early"
+    rungs = get_rungs(args.min_episodes, args.eta, base.episodes)
+    trials = get_trials(args.param)
+    print(f"{len(trials)} trials, rungs at {rungs} of {base.episodes} episodes")
+
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Manager() as manager, ProcessPoolExecutor(
+        max_workers=args.workers, mp_context=ctx
+    ) as executor:
+        recorded, lock = manager.dict(), manager.Lock()
+        futures = []
+        for trial, params in enumerate(trials):
+            root = os.path.join(base.root, f"trial_{trial}")
+            os.makedirs(root, exist_ok=True)
+            argv = [*base_argv, "-root", root]
+            for name, value in params.items():
+                argv += [f"-{name}", *value.split()]
+            stopper = ASHAStopper(rungs, args.eta, recorded, lock)
+            futures.append(executor.submit(run_trial, trial, argv, params, stopper))
+        for future in as_completed(futures):
+            result = future.result()
+            status = "completed" if result["completed"] else "stopped"
+            print(
+                f"Trial {result['trial']} {result['params']} {status} after"
+                f" {result['episodes']} episodes, reward {result['reward']:,.4f}"
+            )
+            results.append(result)
+
+    results.sort(key=lambda result: (result["completed"], result["reward"]))
+    results.reverse()
+    played = sum(result["episodes"] for result in results)
+    print(
+        f"Played {played:,} of {len(trials) * base.episodes * base.num_exps:,} episodes,"
+        f" best trial {results[0]['trial']} {results[0]['params']}"
+    )
+    with open(os.path.join(base.root, "sweep.json"), "w") as f:
+        json.dump({"rungs": rungs, "eta": args.eta, "trials": results}, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    prs = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__,
+        allow_abbrev=False,
+    )
+    prs.add_argument(
+        "--param",
+        action="append",
+        required=True,
+        help='Swept flag of main.py and its comma-separated values, e.g. "lr=0.001,0.0001"',
+    )
+    prs.add_argument(
+        "--min-episodes", type=int, default=50, help="Episodes of the first rung"
+    )
+    prs.add_argument("--eta", type=int, default=3, help="Reduction factor")
+    prs.add_argument("--workers", type=int, default=2, help="Parallel trials")
+    prs.add_argument("main_args", nargs=argparse.REMAINDER)
+    args = prs.parse_args()
+    main_args = args.main_args
+    if main_args and main_args[0] == "--":
+        main_args = main_args[1:]
+    sweep(args, main_args)
@@ -0,0 +1,152 @@
+"""Equivalence of the (numba) kernels and the NumPy code paths of the envs.
+
+The kernels are run as plain Python (their `py_func` when numba is installed), so
+these tests check the kernel code itself whether or not numba is available.
+"""
+
+import numpy as np
+import pytest
+
+from envs import kernels
+from main import get_parser, make_env, prepare_args
+
+KERNELS = [
+    "donut_transitions",
+    "donut_step",
+    "lending_transitions",
+    "covid_transition",
+    "covid_counterfactual_transitions",
+]
+
+
+@pytest.fixture
+def plain_kernels(monkeypatch):
+    for name in KERNELS:
+        kernel = getattr(kernels, name)
+        monkeypatch.setattr(kernels, name, getattr(kernel, "py_func", kernel))
+
+
+def make(env_type: str, *argv: str, jit: bool = False):
+    args = get_parser().parse_args(["-env", env_type, *argv])
+    prepare_args(args)
+    env = make_env(3, 50, args, seed=0)
+    env.jit = jit
+    return env
+
+
+@pytest.mark.parametrize("action", [0, 2, 4])
+def test_donut_transitions(plain_kernels, action):
+    env = make("donut")
+    rng = np.random.default_rng(0)
+    n = 8
+    state = (rng.random(env.people) < 0.5).astype(np.float32)
+    state[action] = action != 2
+    memories = rng.integers(0, 20, (n, env.people)).astype(np.float32)
+    uniforms = rng.random((n, env.people))
+    prob = np.asarray(env.prob, dtype=np.float64)
+
+    new_states, new_memories, served = kernels.donut_transitions(
+        state, memories, action, uniforms, prob
+    )
+    for i in range(n):
+        env.draw_uniforms = lambda *_, u=uniforms[i]: u
+        new_state, new_memory, _, info = env.get_transition(
+            state, memories[i], action, 1
+        )
+        np.testing.assert_array_equal(new_states[i], new_state)
+        np.testing.assert_array_equal(new_memories[i], new_memory)
+        assert served[i] == info["donuts_allocated"]
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        [],
+        ["-dynamic", "True"],
+        ["-dis", "logistic"],
+        ["-dis", "uniform-interval", "-dynamic", "True"],
+    ],
+)
+def test_donut_step(plain_kernels, argv):
+    numpy_env = make("donut", "-envrng", "True", *argv)
+    kernel_env = make("donut", "-envrng", "True", *argv, jit=True)
+    rng = np.random.default_rng(4)
+    for env in [numpy_env, kernel_env]:
+        env.reset(seed=5)
+    for _ in range(30):
+        # Serve a present customer most of the time
+        present = np.flatnonzero(numpy_env.state)
+        action = int(rng.choice(present) if len(present) else 0)
+        expected = numpy_env.step(action)
+        result = kernel_env.step(action)
+        np.testing.assert_array_equal(result[0], expected[0])
+        assert result[1] == expected[1]
+        np.testing.assert_array_equal(kernel_env.prob, numpy_env.prob)
+        np.testing.assert_array_equal(kernel_env.prob_tracker, numpy_env.prob_tracker)
+
+
+@pytest.mark.parametrize("people,groups", [("4", []), ("12", ["-groups", "3"])])
+@pytest.mark.parametrize("absent", [False, True])
+def test_lending_transitions(plain_kernels, people, groups, absent):
+    env = make("lending", "-people", people, *groups)
+    rng = np.random.default_rng(1)
+    n = 16
+    action = env.people - 1
+    customers = np.ones(env.people, dtype=np.float32)
+    customers[action] = 0 if absent else 1
+    credit = rng.integers(0, 8, env.people).astype(np.float32)
+    memories = rng.integers(0, 10, (n, env.n_groups)).astype(np.float32)
+    repayments = rng.random(n).astype(np.float32)
+    uniforms = rng.random((n, env.people))
+    prob = np.asarray(env.prob, dtype=np.float64)
+    args = (customers, 3.0, credit, memories, action, int(env.groups[action]))
+
+    expected = env.transitions(*args, repayments, uniforms, prob)
+    result = kernels.lending_transitions(*args, repayments, uniforms, prob)
+    for r, e in zip(result, expected):
+        np.testing.assert_array_equal(r, e)
+
+
+@pytest.mark.parametrize("argv", [[], ["-novax", "True"], ["-agent", "sac"]])
+def test_covid_transition(plain_kernels, argv):
+    numpy_env = make("covid", *argv)
+    kernel_env = make("covid", *argv, jit=True)
+    _, info = numpy_env.reset()
+    state = numpy_env.state.copy()
+    memory = numpy_env.memory.copy()
+    rng = np.random.default_rng(2)
+    for step in range(5):
+        if kernel_env.action_space.shape:
+            action = rng.uniform(-1, 1, kernel_env.action_space.shape)
+            action = action.astype(np.float32)
+        else:
+            action = int(rng.integers(kernel_env.action_space.n))
+        expected = numpy_env.get_transition(state.copy(), memory, action, step)
+        result = kernel_env.get_transition(state.copy(), memory, action, step)
+        np.testing.assert_array_equal(result[0], expected[0])
+        np.testing.assert_array_equal(result[1], expected[1])
+        assert result[2] == expected[2]
+        state, memory = expected[0], expected[1]
+
+
+def test_covid_counterfactual_transitions(plain_kernels):
+    numpy_env = make("covid")
+    kernel_env = make("covid", jit=True)
+    _, info = numpy_env.reset()
+    kernel_env.reset()
+    state = info["state"].copy()
+    actual_state = numpy_env.state.copy()
+    memory = np.array([1e6, 2e6, 3e6], dtype=np.float32)
+
+    transitions = []
+    for env in [numpy_env, kernel_env]:
+        np.random.seed(3)
+        transitions.append(
+            env.get_counterfactual_transitions(
+                state, actual_state.copy(), 1, memory, 2, 6
+            )
+        )
+    assert len(transitions[0]) == len(transitions[1]) == 6
+    for expected, result in zip(*transitions):
+        for e, r in zip(expected, result):
+            np.testing.assert_allclose(r, e, rtol=1e-6)